@@ -5,13 +5,17 @@ Permite guardar imágenes junto con sus metadatos en formato JSON y visualizar u
 
 import os
 import importlib
-import pkgutil
 import sys
 
 # Asegúrate de que los scripts se carguen correctamente
 scripts_dir = os.path.dirname(os.path.realpath(__file__))
 sys.path.insert(0, scripts_dir)
 
-# Importar submódulos automáticamente
-for _, name, _ in pkgutil.iter_modules([scripts_dir]):
-    importlib.import_module(f'scripts.{name}')
\ No newline at end of file
+
+def __getattr__(name):
+    # Los submódulos se importan al usarlos: la WebUI ya carga los scripts de la extensión
+    # y no hace falta pagar aquí el coste de importarlos todos
+    try:
+        return importlib.import_module(f'scripts.{name}')
+    except ModuleNotFoundError as e:
+        raise AttributeError(name) from e
\ No newline at end of file
@@ -0,0 +1,285 @@
+"""
+Benchmark reproducible del guardado y del historial de Image Metadata Saver
+
+Importa la extensión fuera de la WebUI (ver webui_stubs.py) sobre un directorio de datos
+temporal y, con el historial lleno hasta cada escala (1k, 10k y 100k registros por defecto),
+mide:
+- guardados: imágenes por segundo y latencia, uno a uno y por lotes
+- historial: carga completa (load_history) y refresco de la galería (primera página, en frío
+  y en caliente, y páginas siguientes)
+- búsqueda: latencia de la búsqueda de texto y de los filtros
+- borrado: coste de delete_saved_image
+
+El resultado se guarda en JSON junto con el commit, de modo que dos informes se puedan comparar.
+
+Uso:
+    python benchmarks/bench_pipeline.py [--scales 1000 10000 100000] [--json informe.json] [--compare anterior.json]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import webui_stubs
+
+# Registros que se insertan por transacción al llenar el historial
+FILL_BATCH_SIZE = 1000
+
+# Imágenes distintas a las que apuntan los registros de relleno
+FILL_IMAGES = 32
+
+
+def summarize(durations):
+    """Recuento, media y percentiles (ms) de una lista de duraciones en segundos"""
+    if not durations:
+        return {"n": 0}
+    ordered = sorted(durations)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return {
+        "n": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": round(pick(0.5), 3),
+        "p95_ms": round(pick(0.95), 3),
+        "p99_ms": round(pick(0.99), 3)
+    }
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Pipeline:
+    """Extensión cargada sobre un directorio de datos temporal"""
+
+    def __init__(self, data_dir, profile, seed):
+        os.environ["IMAGE_METADATA_SAVER_DATA_DIR"] = data_dir
+        webui_stubs.install()
+        from scripts import image_metadata_saver as saver
+        from scripts.history_store import history_entry
+
+        self.saver = saver
+        self.history_entry = history_entry
+        self.rng = random.Random(seed)
+        self.counter = 0
+        saver.ENCODER_CONFIG["profile"] = profile
+        self.fill_blobs = self._make_fill_blobs()
+
+    def _make_fill_blobs(self):
+        """Guarda unas pocas imágenes reales a las que apuntan los registros de relleno"""
+        blobs = []
+        for _ in range(FILL_IMAGES):
+            image = webui_stubs.synthetic_image(self.rng)
+            image_hash, image_file, tmp_path = self.saver.encode_image_blob(image, self.saver.ENCODER_CONFIG["profile"])
+            self.saver.commit_image_blob(image, image_file, tmp_path, self.saver.ENCODER_CONFIG["profile"])
+            blobs.append((image_hash, image_file))
+        return blobs
+
+    def next_processing(self):
+        self.counter += 1
+        return webui_stubs.synthetic_processing(self.rng, self.counter)
+
+    def fill(self, total):
+        """Añade registros directamente al índice hasta llegar a `total`"""
+        store = self.saver.HISTORY_STORE
+        image = webui_stubs.synthetic_image(self.rng, 8)
+        start_date = datetime.datetime(2024, 1, 1)
+        while store.count() < total:
+            batch = []
+            for _ in range(min(FILL_BATCH_SIZE, total - store.count())):
+                metadata = self.saver.extract_metadata(image, self.next_processing())
+                metadata["timestamp"] = (start_date + datetime.timedelta(seconds=self.counter * 37)).isoformat()
+                metadata["filename"] = f"fill_{self.counter:07d}.png"
+                metadata["image_hash"], metadata["image_file"] = self.rng.choice(self.fill_blobs)
+                batch.append(self.history_entry(metadata))
+            store.append_many(batch)
+
+    def bench_saves(self, count, batch_size):
+        saver = self.saver
+        single = []
+        start = time.perf_counter()
+        for _ in range(count):
+            image = webui_stubs.synthetic_image(self.rng)
+            duration, _ = timed(saver.save_image_with_metadata, image, p=self.next_processing())
+            single.append(duration)
+        single_elapsed = time.perf_counter() - start
+
+        batches = []
+        saved = 0
+        start = time.perf_counter()
+        while saved < count:
+            items = [(webui_stubs.synthetic_image(self.rng), self.next_processing()) for _ in range(batch_size)]
+            duration, _ = timed(saver.save_images_with_metadata, items)
+            batches.append(duration)
+            saved += batch_size
+        batch_elapsed = time.perf_counter() - start
+
+        return {
+            "single": {**summarize(single), "images_per_s": round(count / single_elapsed, 1)},
+            "batch": {**summarize(batches), "batch_size": batch_size, "images_per_s": round(saved / batch_elapsed, 1)}
+        }
+
+    def bench_history(self, pages):
+        saver = self.saver
+        load_time, entries = timed(saver.load_history)
+
+        # Primera página con la caché de tarjetas vacía y después en caliente
+        with saver._card_cache_lock:
+            saver._card_cache.clear()
+        cold_time, _ = timed(saver.create_history_html)
+        warm = [timed(saver.create_history_html)[0] for _ in range(5)]
+
+        scroll = []
+        cursor = None
+        for _ in range(pages):
+            duration, (_, cursor) = timed(saver.render_history_page, cursor=cursor)
+            scroll.append(duration)
+            if cursor is None:
+                break
+
+        return {
+            "load_history_ms": round(load_time * 1000, 3),
+            "entries": len(entries),
+            "refresh_cold_ms": round(cold_time * 1000, 3),
+            "refresh_warm": summarize(warm),
+            "next_pages": summarize(scroll)
+        }
+
+    def bench_search(self, count):
+        store = self.saver.HISTORY_STORE
+        text = []
+        for _ in range(count):
+            words = self.rng.sample(webui_stubs.WORDS, self.rng.choice((1, 2)))
+            # La última palabra se busca como prefijo, como al escribir en la caja de búsqueda
+            words[-1] = words[-1][:self.rng.randint(3, len(words[-1]))]
+            text.append(timed(store.search, " ".join(words))[0])
+
+        rendered = [timed(self.saver.render_history_page, search_text=self.rng.choice(webui_stubs.WORDS))[0] for _ in range(count // 5 or 1)]
+
+        filters = []
+        for _ in range(count):
+            sampler = self.rng.choice(("Euler a", "DPM++ 2M", "DDIM"))
+            filters.append(timed(store.query, filters={"sampler": sampler})[0])
+
+        return {"text": summarize(text), "text_rendered": summarize(rendered), "filter": summarize(filters)}
+
+    def bench_deletes(self, count):
+        store = self.saver.HISTORY_STORE
+        page, _ = store.query(limit=count, order="asc")
+        durations = [timed(self.saver.delete_saved_image, entry["filename"])[0] for entry in page]
+        return summarize(durations)
+
+
+def compare(previous, current):
+    """Muestra la relación entre dos informes (>1 significa que el actual es más lento)"""
+    print(f"\nComparación con {previous['meta'].get('commit')} (actual / anterior):")
+
+    def walk(old, new, path):
+        for key, value in new.items():
+            if key not in old:
+                continue
+            if isinstance(value, dict):
+                walk(old[key], value, f"{path}{key}.")
+            elif key.endswith("_ms") and isinstance(value, (int, float)) and old[key]:
+                print(f"  {path}{key:<40} {old[key]:>10.3f} -> {value:>10.3f}  x{value / old[key]:.2f}")
+            elif key == "images_per_s" and old[key]:
+                print(f"  {path}{key:<40} {old[key]:>10.1f} -> {value:>10.1f}  x{old[key] / value:.2f}")
+
+    for scale, results in current["results"].items():
+        if scale in previous["results"]:
+            walk(previous["results"][scale], results, f"{scale}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del guardado y del historial")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--saves", type=int, default=100, help="Guardados medidos en cada escala")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--searches", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=5, help="Páginas de la galería que se recorren")
+    parser.add_argument("--deletes", type=int, default=50)
+    parser.add_argument("--profile", default="png_fast", help="Perfil de codificación de los guardados")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", default=None, help="Directorio de datos (por defecto, uno temporal)")
+    parser.add_argument("--json", dest="json_path", default=None, help="Guardar el informe en JSON")
+    parser.add_argument("--compare", default=None, help="Informe JSON anterior con el que comparar")
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="image_metadata_saver_bench_")
+    pipeline = Pipeline(data_dir, args.profile, args.seed)
+    from scripts.metrics import METRICS
+    from PIL import __version__ as pillow_version
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pillow": pillow_version
+        },
+        "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "compare", "data_dir")},
+        "results": {}
+    }
+
+    try:
+        for scale in sorted(args.scales):
+            fill_time, _ = timed(pipeline.fill, scale)
+            print(f"[{scale}] historial lleno en {fill_time:.1f}s")
+            results = {"fill_s": round(fill_time, 2)}
+            results["history"] = pipeline.bench_history(args.pages)
+            results["search"] = pipeline.bench_search(args.searches)
+            results["save"] = pipeline.bench_saves(args.saves, args.batch_size)
+            results["delete"] = pipeline.bench_deletes(args.deletes)
+            report["results"][str(scale)] = results
+
+            print(
+                f"[{scale}] guardado {results['save']['single']['images_per_s']} img/s "
+                f"(lotes {results['save']['batch']['images_per_s']} img/s), "
+                f"load_history {results['history']['load_history_ms']} ms, "
+                f"refresco {results['history']['refresh_warm']['p50_ms']} ms, "
+                f"búsqueda p95 {results['search']['text']['p95_ms']} ms, "
+                f"borrado p50 {results['delete']['p50_ms']} ms"
+            )
+    finally:
+        pipeline.saver.HISTORY_STORE.close()
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    # Desglose por etapas de todos los guardados medidos
+    report["spans"] = METRICS.snapshot()
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+"""
+Prueba de estrés del almacén de Image Metadata Saver
+
+Lanza varios procesos con varios hilos cada uno que guardan y borran registros a la vez
+sobre un mismo directorio de datos. Cada proceso importa la extensión fuera de la WebUI
+(ver webui_stubs.py) con IMAGE_METADATA_SAVER_DATA_DIR apuntando a ese directorio y usa
+sus propias funciones: save_image_with_metadata y save_images_with_metadata (reserva de
+nombre, colocación de la imagen y registro en el historial) y delete_saved_images. Muchas
+imágenes se repiten a propósito, con perfiles de codificación distintos, para que los
+guardados y los borrados compitan por las mismas imágenes, y todos los procesos usan las
+mismas pocas seeds, así que guardan a la vez registros con el mismo nombre base
+(image_<fecha>_<hora>_<seed>). Opcionalmente mata uno de los procesos a mitad de la prueba.
+
+Al terminar comprueba que:
+- el índice contiene exactamente los registros guardados y no borrados (ninguno perdido),
+- todas las imágenes y los JSON de los registros existen y son legibles,
+- los contadores de referencias coinciden con los registros y no quedan imágenes huérfanas,
+- reconstruir el índice desde los JSON (scripts/recovery.py) produce el mismo historial.
+
+Uso:
+    python benchmarks/stress_history.py [--processes 4] [--threads 4] [--operations 200] [--kill]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from PIL import Image
+
+BENCHMARKS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import webui_stubs
+
+# Número de imágenes distintas: pocas, para que se repitan entre guardados
+DISTINCT_IMAGES = 16
+
+# Perfiles entre los que se alterna: los mismos píxeles acaban en archivos distintos
+PROFILES = ("png", "webp_lossless")
+
+# Imágenes como mucho por guardado en lote y registros por borrado
+MAX_BATCH = 3
+
+# Seeds compartidas por todos los procesos: los nombres base coinciden a menudo
+SHARED_SEEDS = 4
+
+# Prefijo del prompt con el que cada proceso marca sus registros (se ve en la vista previa)
+WORKER_TAG = "stress-worker-{}"
+
+
+def load_extension(data_dir):
+    """Importa la extensión sobre el directorio de datos de la prueba"""
+    os.environ["IMAGE_METADATA_SAVER_DATA_DIR"] = data_dir
+    webui_stubs.install()
+    from scripts import image_metadata_saver as saver
+    return saver
+
+
+def worker_of(entry):
+    """Proceso que guardó un registro, según la marca del principio de su prompt"""
+    return int(entry["preview"].split(" ", 1)[0].rsplit("-", 1)[1])
+
+
+def saved_filename(json_path):
+    """Nombre del registro guardado (las imágenes se guardan por contenido, no por nombre)"""
+    with open(json_path, "r", encoding="utf-8") as f:
+        return json.load(f)["filename"]
+
+
+def worker(data_dir, worker_id, threads, operations, seed, log_path):
+    """Proceso de prueba: cada hilo guarda y borra registros y anota los que quedan vivos"""
+    saver = load_extension(data_dir)
+    profiles = [profile for profile in PROFILES if profile in saver.available_profiles()]
+    log_lock = threading.Lock()
+    log = open(log_path, "a", encoding="utf-8")
+
+    def run(thread_id):
+        rng = random.Random(seed * 1000 + worker_id * 100 + thread_id)
+        alive = []
+
+        def next_item():
+            color = rng.randrange(DISTINCT_IMAGES)
+            image = Image.new("RGB", (32, 32), (color * 16, 255 - color * 16, color))
+            p = webui_stubs.synthetic_processing(rng, color)
+            p.prompt = f"{WORKER_TAG.format(worker_id)} {p.prompt}"
+            p.seed = rng.randrange(SHARED_SEEDS)
+            return image, p
+
+        for _ in range(operations):
+            saver.ENCODER_CONFIG["profile"] = rng.choice(profiles)
+            action = rng.random()
+            if alive and action < 0.35:
+                filenames = [alive.pop(rng.randrange(len(alive))) for _ in range(min(len(alive), rng.randint(1, MAX_BATCH)))]
+                saver.delete_saved_images(filenames)
+                event = {"deleted": filenames}
+            elif action < 0.8:
+                image, p = next_item()
+                _, json_path = saver.save_image_with_metadata(image, p=p)
+                filenames = [saved_filename(json_path)]
+                alive.extend(filenames)
+                event = {"saved": filenames}
+            else:
+                results = saver.save_images_with_metadata([next_item() for _ in range(rng.randint(2, MAX_BATCH))])
+                filenames = [saved_filename(result["metadata_path"]) for result in results if result["success"]]
+                alive.extend(filenames)
+                event = {"saved": filenames}
+            with log_lock:
+                log.write(json.dumps(event) + "\n")
+                log.flush()
+
+    pool = [threading.Thread(target=run, args=(thread_id,)) for thread_id in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    log.close()
+    saver.HISTORY_STORE.close()
+
+
+def expected_records(log_path):
+    """Registros que deberían existir según el registro de operaciones de un proceso (por nombre)"""
+    alive = set()
+    if not os.path.exists(log_path):
+        return alive
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # última línea a medias de un proceso matado
+            if "saved" in event:
+                alive.update(event["saved"])
+            else:
+                alive.difference_update(event["deleted"])
+    return alive
+
+
+def check(saver, expected, killed, tolerance):
+    """
+    Comprueba las invariantes del almacén; devuelve la lista de errores.
+    `expected` es la lista, por proceso, de los registros que deberían existir.
+    """
+    errors = []
+    store = saver.HISTORY_STORE
+    entries = store.all()
+    found = {entry["filename"] for entry in entries}
+
+    for worker_id, wanted in enumerate(expected):
+        stored = {entry["filename"] for entry in entries if worker_of(entry) == worker_id}
+        if worker_id in killed:
+            # Cada hilo de un proceso matado puede haber registrado una operación sin llegar a anotarla
+            if len(wanted ^ stored) > tolerance:
+                errors.append(f"proceso {worker_id}: {len(wanted ^ stored)} diferencias tras matarlo")
+        elif stored != wanted:
+            errors.append(
+                f"proceso {worker_id}: perdidos {sorted(wanted - stored)[:10]}, sobrantes {sorted(stored - wanted)[:10]}"
+            )
+
+    references = {}
+    for entry in entries:
+        references[entry["image_file"]] = references.get(entry["image_file"], 0) + 1
+        if not os.path.exists(os.path.join(saver.SAVED_IMAGES_DIR, entry["image_file"])):
+            errors.append(f"falta la imagen de {entry['filename']}")
+        try:
+            with open(os.path.join(saver.METADATA_DIR, entry["metadata_file"]), "r", encoding="utf-8") as f:
+                json.load(f)
+        except (OSError, ValueError) as e:
+            errors.append(f"JSON ilegible de {entry['filename']}: {e}")
+
+    blobs = {row["image_file"]: row["refcount"] for row in store._conn.execute("SELECT image_file, refcount FROM blobs")}
+    if {h: n for h, n in blobs.items() if n} != references:
+        errors.append("los contadores de referencias no coinciden con los registros")
+
+    on_disk = set()
+    for root, _, files in os.walk(saver.SAVED_IMAGES_DIR):
+        on_disk.update(os.path.relpath(os.path.join(root, name), saver.SAVED_IMAGES_DIR) for name in files if not name.endswith(".tmp"))
+    # Un proceso matado entre colocar una imagen y registrarla la deja huérfana
+    # (en la WebUI la recoge el barrido de retención)
+    orphans = on_disk - {entry["image_file"] for entry in entries}
+    if len(orphans) > (tolerance if killed else 0):
+        errors.append(f"{len(orphans)} imágenes huérfanas en disco")
+    return errors, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de estrés de guardados y borrados concurrentes")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--operations", type=int, default=200, help="Operaciones por hilo")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--kill", action="store_true", help="Matar un proceso a mitad de la prueba")
+    parser.add_argument("--keep", action="store_true", help="No borrar el directorio de datos")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="image_metadata_saver_stress_")
+    logs = [os.path.join(data_dir, f"worker_{worker_id}.log") for worker_id in range(args.processes)]
+
+    # Procesos nuevos (no fork): cada uno importa la extensión y abre su propia conexión
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    processes = [
+        context.Process(target=worker, args=(data_dir, worker_id, args.threads, args.operations, args.seed, logs[worker_id]))
+        for worker_id in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    killed = set()
+    if args.kill:
+        time.sleep(3.0)
+        victim = processes[0]
+        if victim.is_alive():
+            os.kill(victim.pid, signal.SIGKILL if hasattr(signal, "SIGKILL") else signal.SIGTERM)
+            killed.add(0)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    # Un proceso matado puede dejar el bloqueo de archivo; el sistema lo libera al morir
+    saver = load_extension(data_dir)
+    from scripts.recovery import rebuild_index
+
+    tolerance = args.threads * MAX_BATCH
+    expected = [expected_records(log_path) for log_path in logs]
+    errors, found = check(saver, expected, killed, tolerance)
+
+    # La reconstrucción desde los JSON debe producir el mismo historial
+    # (salvo, en el proceso matado, una operación por hilo interrumpida entre el JSON y el índice)
+    store = saver.HISTORY_STORE
+    before = {(entry["filename"], entry["image_hash"], worker_of(entry)) for entry in store.all()}
+    summary = rebuild_index(store, saver.METADATA_DIR, saver.SAVED_IMAGES_DIR, use_processes=False)
+    after = {(entry["filename"], entry["image_hash"], worker_of(entry)) for entry in store.all()}
+    differences = {item for item in before ^ after if item[2] not in killed}
+    if differences or len(before ^ after) > tolerance:
+        errors.append(f"la reconstrucción difiere: {len(before ^ after)} entradas")
+
+    operations = args.processes * args.threads * args.operations
+    print(json.dumps({
+        "operations": operations,
+        "seconds": round(elapsed, 2),
+        "operations_per_s": round(operations / elapsed, 1),
+        "records": len(found),
+        "killed": bool(killed),
+        "rebuild": summary,
+        "errors": errors
+    }, indent=2, ensure_ascii=False))
+
+    store.close()
+    if not args.keep:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Sustitutos mínimos de los módulos de la WebUI para ejecutar la extensión fuera de Automatic1111
+
+install() registra en sys.modules versiones locales de modules.script_callbacks, shared,
+processing, images, ui_components y api (y de gradio si no está instalado), de modo que
+scripts/image_metadata_saver.py se pueda importar en benchmarks. Los callbacks registrados
+se guardan en CALLBACKS en lugar de ejecutarse.
+"""
+
+import sys
+import types
+
+CALLBACKS = {}
+
+
+class StableDiffusionProcessing:
+    """Objeto de procesamiento con los atributos que lee extract_metadata"""
+
+    def __init__(self, prompt="", negative_prompt="", steps=20, sampler_name="Euler a", cfg_scale=7.0,
+                 seed=-1, width=512, height=512, batch_size=1):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.steps = steps
+        self.sampler_name = sampler_name
+        self.cfg_scale = cfg_scale
+        self.seed = seed
+        self.width = width
+        self.height = height
+        self.batch_size = batch_size
+
+
+class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
+    pass
+
+
+class StableDiffusionProcessingImg2Img(StableDiffusionProcessing):
+    pass
+
+
+class FakeModel:
+    model_name = "benchmark-model"
+    sd_model_hash = "0123456789"
+
+
+def _register(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def _callback_registrar(name):
+    def register(callback, *args, **kwargs):
+        CALLBACKS.setdefault(name, []).append(callback)
+    return register
+
+
+def install():
+    """Registra los módulos sustitutos (no hace nada si ya están importados)"""
+    if "modules.script_callbacks" in sys.modules:
+        return
+
+    callback_names = ("on_app_started", "on_ui_tabs", "on_ui_settings", "on_image_saved", "on_before_image_saved")
+    script_callbacks = _register("modules.script_callbacks", **{name: _callback_registrar(name) for name in callback_names})
+    shared = _register(
+        "modules.shared",
+        opts=types.SimpleNamespace(),
+        sd_model=FakeModel(),
+        txt2img_gallery=None,
+        img2img_gallery=None,
+        generation_info=None
+    )
+    processing = _register(
+        "modules.processing",
+        StableDiffusionProcessing=StableDiffusionProcessing,
+        StableDiffusionProcessingTxt2Img=StableDiffusionProcessingTxt2Img,
+        StableDiffusionProcessingImg2Img=StableDiffusionProcessingImg2Img
+    )
+    images = _register("modules.images", save_image=lambda *args, **kwargs: None)
+    ui_components = _register("modules.ui_components")
+    api = _register("modules.api", api=types.SimpleNamespace())
+    _register(
+        "modules",
+        script_callbacks=script_callbacks,
+        shared=shared,
+        processing=processing,
+        images=images,
+        ui_components=ui_components,
+        api=api
+    )
+
+    try:
+        import gradio  # noqa: F401
+    except ImportError:
+        # Solo se usa al construir la interfaz, que los benchmarks no crean
+        _register("gradio")
+
+
+WORDS = (
+    "castle", "forest", "portrait", "cyberpunk", "city", "sunset", "dragon", "ocean", "mountain", "robot",
+    "watercolor", "cinematic", "lighting", "detailed", "night", "neon", "ancient", "temple", "snow", "desert"
+)
+
+
+def synthetic_processing(rng, index):
+    """Objeto de procesamiento txt2img con un prompt y una seed aleatorios"""
+    prompt = ", ".join(rng.sample(WORDS, 6)) + f", masterpiece {index}"
+    return StableDiffusionProcessingTxt2Img(
+        prompt=prompt,
+        negative_prompt="blurry, lowres",
+        steps=rng.choice((20, 25, 30)),
+        sampler_name=rng.choice(("Euler a", "DPM++ 2M", "DDIM")),
+        cfg_scale=rng.choice((5.0, 7.0, 9.0)),
+        seed=rng.randrange(2 ** 32),
+        width=512,
+        height=512
+    )
+
+
+def synthetic_image(rng, size=64):
+    """Imagen pequeña con ruido aleatorio (cada una con un contenido distinto)"""
+    from PIL import Image
+    return Image.frombytes("RGB", (size, size), rng.randbytes(size * size * 3))
+
@@ -21,6 +21,23 @@ def main():
     required_files = [
         "scripts/image_metadata_saver.py",
         "scripts/api.py",
+        "scripts/history_store.py",
+        "scripts/save_queue.py",
+        "scripts/thumbnails.py",
+        "scripts/extension_config.py",
+        "scripts/auto_save.py",
+        "scripts/encoders.py",
+        "scripts/layout.py",
+        "scripts/infotext.py",
+        "scripts/importer.py",
+        "scripts/records.py",
+        "scripts/metadata_cache.py",
+        "scripts/fileio.py",
+        "scripts/recovery.py",
+        "scripts/metrics.py",
+        "scripts/archive.py",
+        "scripts/retention.py",
+        "scripts/similarity.py",
         "javascript/script.js",
         "style.css",
         "__init__.py"
@@ -16,12 +16,18 @@ function initializePlugin() {
     
     // Añadir observador para detectar nuevas imágenes generadas
     observeGalleries();
+    
+    // Cargar páginas del historial de guardados a medida que se hace scroll
+    observeHistoryPages();
 }
 
 function addSaveButtonsToGallery(galleryId) {
     const gallery = document.getElementById(galleryId);
     if (!gallery) return;
     
+    // Añadir el botón para guardar toda la galería de una vez
+    addSaveAllButtonToGallery(gallery, galleryId);
+    
     // Buscar el contenedor de imágenes dentro de la galería
     const imgContainers = gallery.querySelectorAll('.thumbnail-item');
     
@@ -60,9 +66,66 @@ function addSaveButtonsToGallery(galleryId) {
     });
 }
 
+function addSaveAllButtonToGallery(gallery, galleryId) {
+    // Verificar si ya tiene el botón de guardar todas
+    if (gallery.querySelector('.save-all-metadata-btn')) return;
+    
+    const saveAllBtn = document.createElement('button');
+    saveAllBtn.className = 'save-all-metadata-btn';
+    saveAllBtn.innerHTML = '💾 Guardar todas';
+    saveAllBtn.title = 'Guardar todas las imágenes de la galería con sus metadatos';
+    saveAllBtn.style.cssText = `
+        position: absolute;
+        top: 10px;
+        left: 10px;
+        background-color: rgba(0, 0, 0, 0.7);
+        color: white;
+        border: none;
+        border-radius: 4px;
+        padding: 5px 8px;
+        font-size: 12px;
+        cursor: pointer;
+        z-index: 10;
+    `;
+    
+    saveAllBtn.addEventListener('click', function(e) {
+        e.stopPropagation();
+        saveAllImagesWithMetadata(galleryId);
+    });
+    
+    gallery.style.position = 'relative';
+    gallery.appendChild(saveAllBtn);
+}
+
+function saveAllImagesWithMetadata(galleryId) {
+    // Un único request: el servidor codifica en paralelo y actualiza el historial una sola vez
+    fetch('/api/image_metadata_saver/save_batch', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+            gallery_id: galleryId,
+            indices: 'all'
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            waitForSaveJob(data.job_id);
+        } else {
+            showNotification('Error al guardar las imágenes: ' + (data.error || data.detail), 'error');
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showNotification('Error de conexión al guardar las imágenes', 'error');
+    });
+}
+
 function saveImageWithMetadata(galleryId, index) {
     // Aquí hacemos una llamada a la API de la extensión para guardar la imagen
-    // Esto requiere que establezcamos un endpoint en la extensión Python
+    // El servidor encola el guardado y devuelve un id de trabajo que consultamos después
     
     fetch('/api/image_metadata_saver/save', {
         method: 'POST',
@@ -77,9 +140,9 @@ function saveImageWithMetadata(galleryId, index) {
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            showNotification('Imagen guardada correctamente con sus metadatos');
+            waitForSaveJob(data.job_id);
         } else {
-            showNotification('Error al guardar la imagen: ' + data.error, 'error');
+            showNotification('Error al guardar la imagen: ' + (data.error || data.detail), 'error');
         }
     })
     .catch(error => {
@@ -88,6 +151,40 @@ function saveImageWithMetadata(galleryId, index) {
     });
 }
 
+function waitForSaveJob(jobId, attempt = 0) {
+    // Consultamos el estado del trabajo hasta que termine, con espera creciente
+    fetch(`/api/image_metadata_saver/jobs/${jobId}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                showNotification('Error al consultar el guardado: ' + (data.error || data.detail), 'error');
+                return;
+            }
+            
+            const job = data.data;
+            if (job.status === 'done' && Array.isArray(job.result)) {
+                // Guardado por lotes: un resultado por imagen
+                const saved = job.result.filter(result => result.success).length;
+                const total = job.result.length;
+                if (saved === total) {
+                    showNotification(`${saved} imágenes guardadas correctamente con sus metadatos`);
+                } else {
+                    showNotification(`Se guardaron ${saved} de ${total} imágenes`, 'error');
+                }
+            } else if (job.status === 'done') {
+                showNotification('Imagen guardada correctamente con sus metadatos');
+            } else if (job.status === 'error') {
+                showNotification('Error al guardar la imagen: ' + job.error, 'error');
+            } else {
+                setTimeout(() => waitForSaveJob(jobId, attempt + 1), Math.min(250 * (attempt + 1), 2000));
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showNotification('Error de conexión al consultar el guardado', 'error');
+        });
+}
+
 function observeGalleries() {
     // Observamos cambios en las galerías para añadir botones a nuevas imágenes
     const galleries = ['txt2img_gallery', 'img2img_gallery'];
@@ -114,6 +211,107 @@ function observeGalleries() {
     });
 }
 
+function observeHistoryPages() {
+    // Cuando el marcador del final de la galería entra en pantalla pedimos la siguiente página
+    const intersection = new IntersectionObserver(function(entries) {
+        entries.forEach(function(entry) {
+            if (entry.isIntersecting) {
+                intersection.unobserve(entry.target);
+                loadNextHistoryPage(entry.target);
+            }
+        });
+    }, { rootMargin: '600px' });
+    
+    const attachSentinels = function() {
+        document.querySelectorAll('.history-sentinel:not([data-observed])').forEach(sentinel => {
+            sentinel.dataset.observed = '1';
+            intersection.observe(sentinel);
+        });
+    };
+    
+    // La galería se vuelve a renderizar al refrescar o buscar, así que vigilamos nuevos marcadores
+    const observer = new MutationObserver(attachSentinels);
+    observer.observe(document.body, { 
+        childList: true, 
+        subtree: true 
+    });
+    attachSentinels();
+}
+
+function loadNextHistoryPage(sentinel) {
+    // La galería se crea vacía con un marcador sin cursor: el primer aviso de la
+    // intersección (al abrir la pestaña) carga la primera página
+    const params = new URLSearchParams({
+        cursor: sentinel.dataset.cursor,
+        q: sentinel.dataset.search || ''
+    });
+    
+    fetch(`/api/image_metadata_saver/history_html?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                showNotification('Error al cargar el historial: ' + (data.error || data.detail), 'error');
+                return;
+            }
+            // El fragmento incluye el marcador de la página siguiente, si la hay
+            sentinel.outerHTML = data.html;
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showNotification('Error de conexión al cargar el historial', 'error');
+        });
+}
+
+// Marcar o desmarcar una imagen guardada como favorita (los favoritos no se borran por retención)
+function toggleStar(button, filename) {
+    const starred = button.dataset.starred !== '1';
+    
+    fetch('/api/image_metadata_saver/star', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            filenames: [filename],
+            starred: starred
+        })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+            button.dataset.starred = starred ? '1' : '0';
+            button.textContent = starred ? '★ Favorito' : '☆ Favorito';
+        } else {
+            showNotification(`Error: ${data.error}`, 'error');
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        showNotification('Error de conexión al marcar el favorito', 'error');
+    });
+}
+
+// Sustituir la galería por las imágenes parecidas a una imagen guardada
+function findSimilar(button, filename) {
+    fetch(`/api/image_metadata_saver/similar/${encodeURIComponent(filename)}?html=1`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                showNotification('Error al buscar imágenes parecidas: ' + (data.error || data.detail), 'error');
+                return;
+            }
+            // Se sustituye la galería (o los resultados de una búsqueda de parecidas anterior)
+            const container = button.closest('.history-similar') || button.closest('.history-container');
+            if (container) {
+                container.outerHTML = `<div class='history-similar'>${data.html}</div>`;
+            }
+        })
+        .catch(error => {
+            console.error('Error:', error);
+            showNotification('Error de conexión al buscar imágenes parecidas', 'error');
+        });
+}
+
 function showNotification(message, type = 'success') {
     // Crear notificación
     const notification = document.createElement('div');
@@ -178,9 +376,10 @@ function viewImageDetails(metadataFile, imagePath) {
         gap: 20px;
     `;
     
-    // Cargar los metadatos
+    // Cargar los metadatos (el endpoint de la API devuelve {success, data})
     fetch(metadataFile)
         .then(response => response.json())
+        .then(response => response.data !== undefined ? response.data : response)
         .then(metadata => {
             // Crear contenido del modal con la imagen y metadatos
             modalContent.innerHTML = `
@@ -230,4 +429,6 @@ function viewImageDetails(metadataFile, imagePath) {
 }
 
 // Exponer la función al ámbito global para que pueda ser llamada desde HTML
-window.viewImageDetails = viewImageDetails;
\ No newline at end of file
+window.viewImageDetails = viewImageDetails;
+window.toggleStar = toggleStar;
+window.findSimilar = findSimilar;
\ No newline at end of file
@@ -3,24 +3,142 @@ API endpoints para la extensión Image Metadata Saver
 """
 
 import os
-import json
+import inspect
 import datetime
-from fastapi import FastAPI, HTTPException, Request
-from PIL import Image
+import functools
+from typing import Optional
+import gradio as gr
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from modules import script_callbacks, shared
-from modules.shared import opts
-from modules.api import api
 
 from scripts.image_metadata_saver import (
-    extract_metadata, 
-    save_image_with_metadata, 
-    SAVED_IMAGES_DIR, 
-    METADATA_DIR
+    queue_save,
+    queue_save_batch,
+    queue_import,
+    queue_archive_import,
+    delete_saved_image,
+    queue_bulk_delete,
+    set_starred,
+    find_similar,
+    queue_hash_backfill,
+    similar_history_html,
+    render_history_page,
+    history_sentinel_html,
+    history_empty_html,
+    resolve_image_path,
+    resolve_metadata_path,
+    METADATA_DIR,
+    HISTORY_STORE,
+    SAVE_QUEUE,
+    IMPORT_QUEUE,
+    MAINTENANCE_QUEUE,
+    THUMBNAIL_CACHE,
+    METADATA_CACHE,
+    AUTO_SAVER,
+    RETENTION
 )
+from scripts.history_store import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, FILTER_FIELDS
+from scripts.similarity import DEFAULT_MAX_DISTANCE
+from scripts.save_queue import QueueFullError
+from scripts.metrics import METRICS, collect_request_spans, server_timing
+
+# Cabecera con la que un cliente pide los tiempos de la petición (se devuelven en Server-Timing)
+DEBUG_HEADER = "X-Image-Metadata-Saver-Debug"
+
+def get_gallery(gallery_id):
+    """Devuelve la lista de imágenes de una galería o lanza HTTPException"""
+    if gallery_id == "txt2img_gallery":
+        if not shared.txt2img_gallery:
+            raise HTTPException(status_code=404, detail="No se encontró la galería txt2img")
+        return shared.txt2img_gallery
+    elif gallery_id == "img2img_gallery":
+        if not shared.img2img_gallery:
+            raise HTTPException(status_code=404, detail="No se encontró la galería img2img")
+        return shared.img2img_gallery
+    else:
+        raise HTTPException(status_code=400, detail=f"Galería desconocida: {gallery_id}")
+
+def get_gallery_image(gallery_id, image_index):
+    """Devuelve (imagen, información de generación) de una galería o lanza HTTPException"""
+    gallery = get_gallery(gallery_id)
+    image_data = gallery[image_index] if 0 <= image_index < len(gallery) else None
+    
+    if not image_data:
+        raise HTTPException(status_code=404, detail=f"No se encontró la imagen con índice {image_index}")
+    
+    # Extraer imagen y metadata
+    image = image_data.get("image")
+    if not image:
+        raise HTTPException(status_code=404, detail="No se encontró la imagen en los datos")
+    
+    # Obtener información de generación
+    generation_info = None
+    if hasattr(shared, 'generation_info') and shared.generation_info is not None:
+        generation_info = shared.generation_info[image_index] if image_index < len(shared.generation_info) else None
+    
+    return image, generation_info
+
+def find_entry(filename):
+    """Busca una entrada del historial por el nombre de su imagen o de su JSON de metadatos"""
+    entry = HISTORY_STORE.get(filename)
+    if entry is None and filename.endswith(".json"):
+        entry = HISTORY_STORE.get_by_stem(os.path.splitext(filename)[0])
+    return entry
+
+def instrumented(name):
+    """
+    Mide la duración de un endpoint como span "api.<name>". Si la petición lleva la cabecera
+    de depuración, añade a la respuesta una cabecera Server-Timing con los spans medidos.
+    """
+    def decorator(handler):
+        signature = inspect.signature(handler)
+        parameters = list(signature.parameters.values())
+        # FastAPI rellena Request y Response por su tipo (solo un parámetro de cada uno por endpoint)
+        request_name = next((param.name for param in parameters if param.annotation is Request), None)
+        own_request = request_name is None
+        if own_request:
+            request_name = "_metrics_request"
+            parameters.append(inspect.Parameter(request_name, inspect.Parameter.KEYWORD_ONLY, annotation=Request))
+        parameters.append(inspect.Parameter("_metrics_response", inspect.Parameter.KEYWORD_ONLY, annotation=Response))
+        
+        def prepare(kwargs):
+            request = kwargs.pop(request_name) if own_request else kwargs[request_name]
+            return request.headers.get(DEBUG_HEADER), kwargs.pop("_metrics_response")
+        
+        def finish(debug, spans, result, response):
+            if debug:
+                target = result if isinstance(result, Response) else response
+                target.headers["Server-Timing"] = server_timing(spans)
+        
+        if inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def wrapper(*args, **kwargs):
+                debug, response = prepare(kwargs)
+                with collect_request_spans() as spans:
+                    with METRICS.span(f"api.{name}"):
+                        result = await handler(*args, **kwargs)
+                finish(debug, spans, result, response)
+                return result
+        else:
+            @functools.wraps(handler)
+            def wrapper(*args, **kwargs):
+                debug, response = prepare(kwargs)
+                with collect_request_spans() as spans:
+                    with METRICS.span(f"api.{name}"):
+                        result = handler(*args, **kwargs)
+                finish(debug, spans, result, response)
+                return result
+        
+        wrapper.__signature__ = signature.replace(parameters=parameters)
+        return wrapper
+    return decorator
 
 # Crear endpoint API para guardar imágenes
 def image_metadata_saver_api(_: gr.Blocks, app: FastAPI):
     @app.post("/api/image_metadata_saver/save")
+    @instrumented("save")
     async def save_image(request: Request):
         try:
             data = await request.json()
@@ -31,39 +149,65 @@ def image_metadata_saver_api(_: gr.Blocks, app: FastAPI):
             if not gallery_id:
                 raise HTTPException(status_code=400, detail="Se requiere gallery_id")
             
-            # Obtener la imagen del gallery
-            if gallery_id == "txt2img_gallery":
-                if not shared.txt2img_gallery:
-                    raise HTTPException(status_code=404, detail="No se encontró la galería txt2img")
-                image_data = shared.txt2img_gallery[image_index] if image_index < len(shared.txt2img_gallery) else None
-            elif gallery_id == "img2img_gallery":
-                if not shared.img2img_gallery:
-                    raise HTTPException(status_code=404, detail="No se encontró la galería img2img")
-                image_data = shared.img2img_gallery[image_index] if image_index < len(shared.img2img_gallery) else None
-            else:
-                raise HTTPException(status_code=400, detail=f"Galería desconocida: {gallery_id}")
+            image, generation_info = get_gallery_image(gallery_id, image_index)
+            
+            # Encolar el guardado: la codificación y las escrituras se hacen en segundo plano
+            try:
+                job_id = queue_save(image, p=generation_info)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            
+            return {
+                "success": True,
+                "job_id": job_id,
+                "status": SAVE_QUEUE.status(job_id)["status"]
+            }
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    @app.post("/api/image_metadata_saver/save_batch")
+    @instrumented("save_batch")
+    async def save_batch(request: Request):
+        try:
+            data = await request.json()
+            gallery_id = data.get("gallery_id")
+            indices = data.get("indices", "all")
             
-            if not image_data:
-                raise HTTPException(status_code=404, detail=f"No se encontró la imagen con índice {image_index}")
+            # Validar datos
+            if not gallery_id:
+                raise HTTPException(status_code=400, detail="Se requiere gallery_id")
+            
+            if indices == "all":
+                indices = list(range(len(get_gallery(gallery_id))))
+            elif not isinstance(indices, list) or not all(isinstance(i, int) for i in indices):
+                raise HTTPException(status_code=400, detail="indices debe ser una lista de enteros o \"all\"")
             
-            # Extraer imagen y metadata
-            image = image_data.get("image")
-            if not image:
-                raise HTTPException(status_code=404, detail="No se encontró la imagen en los datos")
+            if not indices:
+                raise HTTPException(status_code=400, detail="No hay imágenes que guardar")
             
-            # Obtener información de generación
-            generation_info = None
-            if hasattr(shared, 'generation_info') and shared.generation_info is not None:
-                generation_info = shared.generation_info[image_index] if image_index < len(shared.generation_info) else None
+            items = [get_gallery_image(gallery_id, image_index) for image_index in indices]
             
-            # Guardar imagen y metadatos
-            image_path, json_path = save_image_with_metadata(image, p=generation_info)
+            # Un único trabajo: codificación en paralelo y una sola transacción de historial
+            try:
+                job_id = queue_save_batch(items)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
             
             return {
                 "success": True,
-                "image_path": image_path,
-                "metadata_path": json_path
+                "job_id": job_id,
+                "indices": indices,
+                "status": SAVE_QUEUE.status(job_id)["status"]
             }
+        except HTTPException as e:
+            raise e
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -72,34 +216,288 @@ def image_metadata_saver_api(_: gr.Blocks, app: FastAPI):
                 "error": str(e)
             }
     
+    @app.post("/api/image_metadata_saver/import")
+    @instrumented("import")
+    async def import_folders(request: Request):
+        try:
+            data = await request.json()
+            paths = data.get("paths") or ([data["path"]] if data.get("path") else [])
+            # Como --no-hashes: sin hash perceptual no se decodifican los píxeles
+            hashes = bool(data.get("hashes", True))
+            
+            # Validar datos
+            if not paths or not all(isinstance(path, str) for path in paths):
+                raise HTTPException(status_code=400, detail="Se requiere path o una lista paths")
+            
+            roots = [os.path.abspath(path) for path in paths]
+            missing = [root for root in roots if not os.path.isdir(root)]
+            if missing:
+                raise HTTPException(status_code=404, detail=f"No se encontró el directorio: {missing[0]}")
+            
+            try:
+                job_id = queue_import(roots, hashes=hashes)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            
+            return {
+                "success": True,
+                "job_id": job_id,
+                "status": IMPORT_QUEUE.status(job_id)["status"]
+            }
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    @app.post("/api/image_metadata_saver/import_archive")
+    @instrumented("import_archive")
+    async def import_archive_file(request: Request):
+        try:
+            data = await request.json()
+            path = data.get("path")
+            
+            # Validar datos
+            if not path or not isinstance(path, str):
+                raise HTTPException(status_code=400, detail="Se requiere path")
+            
+            path = os.path.abspath(path)
+            if not os.path.isfile(path):
+                raise HTTPException(status_code=404, detail=f"No se encontró el archivo: {path}")
+            
+            try:
+                job_id = queue_archive_import(path)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            
+            return {
+                "success": True,
+                "job_id": job_id,
+                "status": IMPORT_QUEUE.status(job_id)["status"]
+            }
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    @app.get("/api/image_metadata_saver/export")
+    @instrumented("export")
+    def export_history(
+        format: str = "tar",
+        seed: Optional[str] = None,
+        model: Optional[str] = None,
+        model_hash: Optional[str] = None,
+        sampler: Optional[str] = None,
+        type: Optional[str] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None
+    ):
+        filters = {
+            "seed": seed,
+            "model": model,
+            "model_hash": model_hash,
+            "sampler": sampler,
+            "type": type,
+            "date_from": date_from,
+            "date_to": date_to
+        }
+        # tarfile y zipfile solo se cargan cuando alguien exporta
+        from scripts.archive import ARCHIVE_FORMATS, export_archive
+        try:
+            chunks = export_archive(HISTORY_STORE, filters, format)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # El archivo se genera por trozos mientras se envía (FastAPI recorre el generador en su pool de hilos)
+        filename = f"image_metadata_saver_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+        return StreamingResponse(
+            chunks,
+            media_type=ARCHIVE_FORMATS[format],
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    
+    @app.get("/api/image_metadata_saver/jobs/{job_id}")
+    @instrumented("jobs")
+    async def get_job_status(job_id: str):
+        for queue in (SAVE_QUEUE, IMPORT_QUEUE, MAINTENANCE_QUEUE):
+            job = queue.status(job_id)
+            if job is not None:
+                return {"success": True, "data": job, "pending": queue.pending()}
+        
+        raise HTTPException(status_code=404, detail=f"No se encontró el trabajo: {job_id}")
+    
+    @app.get("/api/image_metadata_saver/auto_save")
+    @instrumented("auto_save")
+    async def get_auto_save():
+        return {"success": True, "data": AUTO_SAVER.stats(), "pending": SAVE_QUEUE.pending()}
+    
+    @app.get("/api/image_metadata_saver/retention")
+    @instrumented("retention")
+    def get_retention():
+        return {"success": True, "data": RETENTION.stats()}
+    
+    @app.post("/api/image_metadata_saver/retention")
+    @instrumented("retention_config")
+    async def update_retention(request: Request):
+        try:
+            data = await request.json()
+            if not isinstance(data, dict):
+                raise HTTPException(status_code=400, detail="Se esperaba un objeto con la configuración")
+            
+            try:
+                config = RETENTION.update_config(**data)
+            except (TypeError, ValueError) as e:
+                raise HTTPException(status_code=400, detail=f"Configuración inválida: {e}")
+            
+            return {"success": True, "data": config}
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.post("/api/image_metadata_saver/retention/sweep")
+    @instrumented("retention_sweep")
+    async def sweep_retention():
+        # Barrido inmediato con la configuración actual (aunque los barridos periódicos estén desactivados)
+        try:
+            job_id = MAINTENANCE_QUEUE.submit(RETENTION.sweep)
+        except QueueFullError as e:
+            raise HTTPException(status_code=429, detail=str(e))
+        
+        return {"success": True, "job_id": job_id, "status": MAINTENANCE_QUEUE.status(job_id)["status"]}
+    
+    @app.get("/api/image_metadata_saver/cache_stats")
+    @instrumented("cache_stats")
+    async def get_cache_stats():
+        return {"success": True, "data": {"metadata": METADATA_CACHE.stats()}}
+    
+    @app.get("/api/image_metadata_saver/metrics")
+    def get_metrics():
+        # Formato de texto de Prometheus
+        return PlainTextResponse(METRICS.render_prometheus(), media_type="text/plain; version=0.0.4")
+    
     @app.get("/api/image_metadata_saver/history")
-    async def get_history():
+    @instrumented("history")
+    def get_history(
+        limit: int = DEFAULT_PAGE_SIZE,
+        cursor: Optional[str] = None,
+        order: str = "desc",
+        seed: Optional[str] = None,
+        model: Optional[str] = None,
+        model_hash: Optional[str] = None,
+        sampler: Optional[str] = None,
+        type: Optional[str] = None,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None
+    ):
+        try:
+            filters = {
+                "seed": seed,
+                "model": model,
+                "model_hash": model_hash,
+                "sampler": sampler,
+                "type": type,
+                "date_from": date_from,
+                "date_to": date_to
+            }
+            try:
+                items, next_cursor = HISTORY_STORE.query(limit=limit, cursor=cursor, order=order, filters=filters)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            return {"success": True, "data": items, "next_cursor": next_cursor}
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.get("/api/image_metadata_saver/search")
+    @instrumented("search")
+    def search_history(
+        q: str = "",
+        field: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+        offset: int = 0
+    ):
+        try:
+            try:
+                items, next_offset = HISTORY_STORE.search(q, limit=limit, offset=offset, field=field)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+            return {"success": True, "data": items, "next_offset": next_offset}
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.get("/api/image_metadata_saver/history_html")
+    @instrumented("history_html")
+    def get_history_html(cursor: Optional[str] = None, q: str = ""):
         try:
-            history_file = os.path.join(METADATA_DIR, "history.json")
-            if not os.path.exists(history_file):
-                return {"success": True, "data": []}
+            try:
+                cards, next_cursor = render_history_page(cursor=cursor, search_text=q)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             
-            with open(history_file, "r", encoding="utf-8") as f:
-                history = json.load(f)
+            # Primera página pedida por la galería vacía que se crea con la interfaz
+            if not cursor and not cards:
+                return {"success": True, "html": history_empty_html(q), "next_cursor": None}
             
-            return {"success": True, "data": history}
+            return {
+                "success": True,
+                "html": cards + history_sentinel_html(next_cursor, q),
+                "next_cursor": next_cursor
+            }
+        except HTTPException as e:
+            raise e
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    @app.get("/api/image_metadata_saver/thumbnail/{filename}")
+    @instrumented("thumbnail")
+    def get_thumbnail(filename: str):
+        # Validar nombre de archivo para evitar path traversal
+        if ".." in filename or "/" in filename or "\\" in filename:
+            raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
+        
+        entry = HISTORY_STORE.get(filename)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"No se encontró la imagen: {filename}")
+        
+        # Endpoint síncrono: FastAPI lo ejecuta en su pool de hilos si hay que generar la miniatura
+        thumb_path = THUMBNAIL_CACHE.get(resolve_image_path(entry), filename)
+        if thumb_path is None:
+            raise HTTPException(status_code=404, detail=f"No se encontró la imagen: {filename}")
+        
+        return FileResponse(thumb_path, headers={"Cache-Control": "max-age=86400"})
+    
     @app.get("/api/image_metadata_saver/metadata/{filename}")
-    async def get_metadata(filename: str):
+    @instrumented("metadata")
+    def get_metadata(filename: str):
         try:
             # Validar nombre de archivo para evitar path traversal
             if ".." in filename or "/" in filename or "\\" in filename:
                 raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
             
-            # Obtener ruta completa
-            json_path = os.path.join(METADATA_DIR, filename)
-            if not os.path.exists(json_path):
-                raise HTTPException(status_code=404, detail=f"No se encontró el archivo de metadatos: {filename}")
+            # Resolver la ruta a través del índice (acepta el nombre de la imagen o el del JSON)
+            entry = find_entry(filename)
+            json_path = resolve_metadata_path(entry) if entry else os.path.join(METADATA_DIR, filename)
             
-            with open(json_path, "r", encoding="utf-8") as f:
-                metadata = json.load(f)
+            # Caché en memoria invalidada por mtime; en un fallo los registros recientes
+            # se leen del índice y los anteriores, de su JSON
+            try:
+                metadata = METADATA_CACHE.get(
+                    json_path,
+                    load=(lambda: HISTORY_STORE.get_record(entry["filename"])) if entry else None
+                )
+            except FileNotFoundError:
+                raise HTTPException(status_code=404, detail=f"No se encontró el archivo de metadatos: {filename}")
             
             return {"success": True, "data": metadata}
         except HTTPException as e:
@@ -107,37 +505,118 @@ def image_metadata_saver_api(_: gr.Blocks, app: FastAPI):
         except Exception as e:
             return {"success": False, "error": str(e)}
     
+    @app.post("/api/image_metadata_saver/delete_batch")
+    @instrumented("delete_batch")
+    async def delete_batch(request: Request):
+        try:
+            data = await request.json()
+            filenames = data.get("filenames")
+            filters = data.get("filters")
+            keep_starred = bool(data.get("keep_starred", True))
+            
+            # Validar datos: una lista de nombres o al menos un filtro (nunca "borrar todo" por omisión)
+            if filenames is not None:
+                if not isinstance(filenames, list) or not all(isinstance(name, str) for name in filenames):
+                    raise HTTPException(status_code=400, detail="filenames debe ser una lista de nombres")
+                filters = None
+            elif isinstance(filters, dict):
+                filters = {key: value for key, value in filters.items() if key in FILTER_FIELDS + ("date_from", "date_to")}
+                if not any(value not in (None, "") for value in filters.values()):
+                    raise HTTPException(status_code=400, detail="Se requiere al menos un filtro")
+                try:
+                    # Consulta al índice fuera del bucle de eventos (puede ser la que lo abre)
+                    await run_in_threadpool(HISTORY_STORE.retention_candidates, limit=1, filters=filters)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+            else:
+                raise HTTPException(status_code=400, detail="Se requiere filenames o filters")
+            
+            # Se borra por bloques en segundo plano; el resumen se consulta en /jobs/{job_id}
+            try:
+                job_id = queue_bulk_delete(filenames=filenames, filters=filters, keep_starred=keep_starred)
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            
+            return {
+                "success": True,
+                "job_id": job_id,
+                "status": MAINTENANCE_QUEUE.status(job_id)["status"]
+            }
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.get("/api/image_metadata_saver/similar/{filename}")
+    @instrumented("similar")
+    def get_similar(filename: str, max_distance: int = DEFAULT_MAX_DISTANCE, limit: int = DEFAULT_PAGE_SIZE, html: bool = False):
+        try:
+            try:
+                results = find_similar(filename, max_distance=max_distance, limit=max(1, min(limit, MAX_PAGE_SIZE)))
+            except KeyError:
+                raise HTTPException(status_code=404, detail=f"No se encontró la imagen: {filename}")
+            except ValueError as e:
+                raise HTTPException(status_code=409, detail=f"{e}; calcula los hashes pendientes con POST /similar/backfill")
+            
+            response = {"success": True, "data": [dict(entry, distance=distance) for entry, distance in results]}
+            # La galería sustituye sus tarjetas por las de los resultados
+            if html:
+                response["html"] = similar_history_html(filename, results)
+            return response
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.post("/api/image_metadata_saver/similar/backfill")
+    @instrumented("similar_backfill")
+    def start_hash_backfill():
+        try:
+            # Se calcula en segundo plano; el resumen se consulta en /jobs/{job_id}
+            try:
+                job_id = queue_hash_backfill()
+            except QueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            
+            return {"success": True, "job_id": job_id, "status": MAINTENANCE_QUEUE.status(job_id)["status"]}
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    @app.post("/api/image_metadata_saver/star")
+    @instrumented("star")
+    async def star_images(request: Request):
+        try:
+            data = await request.json()
+            filenames = data.get("filenames") or ([data["filename"]] if data.get("filename") else [])
+            
+            # Validar datos
+            if not filenames or not all(isinstance(name, str) for name in filenames):
+                raise HTTPException(status_code=400, detail="Se requiere filename o una lista filenames")
+            
+            # Espera al bloqueo de escritura fuera del bucle de eventos
+            changed = await run_in_threadpool(set_starred, filenames, bool(data.get("starred", True)))
+            return {"success": True, "updated": changed}
+        except HTTPException as e:
+            raise e
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
     @app.delete("/api/image_metadata_saver/delete/{filename}")
-    async def delete_image(filename: str):
+    @instrumented("delete")
+    def delete_image(filename: str):
         try:
             # Validar nombre de archivo para evitar path traversal
             if ".." in filename or "/" in filename or "\\" in filename:
                 raise HTTPException(status_code=400, detail="Nombre de archivo inválido")
             
-            # Obtener rutas completas
-            image_path = os.path.join(SAVED_IMAGES_DIR, filename)
-            json_path = os.path.join(METADATA_DIR, f"{os.path.splitext(filename)[0]}.json")
-            
-            # Eliminar archivos si existen
-            if os.path.exists(image_path):
-                os.remove(image_path)
-            
-            if os.path.exists(json_path):
-                os.remove(json_path)
-            
-            # Actualizar historial
-            history_file = os.path.join(METADATA_DIR, "history.json")
-            if os.path.exists(history_file):
-                with open(history_file, "r", encoding="utf-8") as f:
-                    history = json.load(f)
-                
-                # Filtrar el elemento eliminado
-                history = [item for item in history if item["filename"] != filename]
-                
-                with open(history_file, "w", encoding="utf-8") as f:
-                    json.dump(history, f, indent=2, ensure_ascii=False)
+            # Endpoint síncrono: espera al bloqueo de escritura en el pool de hilos de FastAPI
+            delete_saved_image(filename)
             
             return {"success": True}
+        except HTTPException as e:
+            raise e
         except Exception as e:
             return {"success": False, "error": str(e)}
 
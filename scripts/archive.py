@@ -0,0 +1,444 @@
+"""
+Exportación e importación de archivos tar/zip para la extensión Image Metadata Saver
+
+La exportación recoge los registros que cumplen los mismos filtros que el historial y
+genera el archivo por trozos mientras se envía, sin construirlo antes en memoria ni en
+disco: primero las imágenes (cada una una sola vez) en images/ y al final un único
+manifest.jsonl con un registro de metadatos por línea. Todo se lee de una instantánea del
+índice, así que los guardados y borrados simultáneos no alteran el archivo a medias.
+El tar usa memoria constante; el zip guarda además una entrada del directorio central
+(unos cien bytes) por archivo, como exige el formato.
+
+La importación lee el archivo en orden (un tar se puede leer desde una tubería), deja las
+imágenes en un directorio temporal dentro de saved_images/ y, al leer el manifiesto, las
+coloca en el almacén por contenido y registra las entradas por bloques. Los registros que
+ya existen se omiten, así que importar dos veces el mismo archivo no duplica nada.
+
+Uso:
+    python scripts/archive.py export SALIDA.tar [--format tar|zip] [--model M] [--date-from AAAA-MM-DD] ...
+    python scripts/archive.py import ARCHIVO.tar
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import datetime
+import posixpath
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/archive.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.fileio import atomic_write_json, discard, replace_file, temp_path_for
+from scripts.history_store import HistoryStore, history_entry
+from scripts.layout import (
+    SAVED_IMAGES_DIR,
+    METADATA_DIR,
+    blob_file_for,
+    date_dir,
+    metadata_file_for,
+    resolve_image_path,
+    resolve_metadata_path
+)
+from scripts.metadata_cache import read_json
+from scripts.records import unpack_record
+
+# Formatos de archivo admitidos y su tipo MIME
+ARCHIVE_FORMATS = {"tar": "application/x-tar", "zip": "application/zip"}
+
+# Nombre del manifiesto y directorio de las imágenes dentro del archivo
+MANIFEST_NAME = "manifest.jsonl"
+IMAGES_PREFIX = "images/"
+
+# Tamaño de los trozos que se leen y se envían
+CHUNK_SIZE = 1024 * 1024
+
+# Registros que se confirman por transacción al importar
+ARCHIVE_BATCH_SIZE = 500
+
+# Prefijo de los directorios temporales de las importaciones dentro de saved_images/
+STAGING_PREFIX = ".archive-import-"
+
+
+def archive_image_name(image_file):
+    """Nombre dentro del archivo de la imagen de un registro"""
+    if os.path.isabs(image_file):
+        # Imágenes importadas de carpetas externas: nombre estable a partir de su ruta
+        digest = hashlib.sha1(image_file.encode("utf-8")).hexdigest()
+        return f"{IMAGES_PREFIX}external/{digest[:2]}/{digest}{os.path.splitext(image_file)[1].lower()}"
+    return IMAGES_PREFIX + image_file.replace(os.sep, "/")
+
+
+def manifest_record(entry, metadata_dir=METADATA_DIR):
+    """Registro de metadatos de una entrada tal como se escribe en el manifiesto"""
+    record = unpack_record(entry["record"]) if entry.get("record") else None
+    if record is None:
+        # Registros anteriores al registro empaquetado en el índice: se leen de su JSON
+        try:
+            record = read_json(resolve_metadata_path(entry, metadata_dir))
+        except (OSError, ValueError):
+            record = {"timestamp": entry["timestamp"], "filename": entry["filename"], "parameters": {}}
+    # La ruta absoluta local no sirve en otra instalación
+    record.pop("image_path", None)
+    record["archive_image"] = archive_image_name(entry.get("image_file") or entry["filename"])
+    return record
+
+
+def iter_manifest(snapshot, filters, metadata_dir=METADATA_DIR):
+    """Líneas (bytes) del manifiesto de las entradas que cumplen los filtros"""
+    for entry in snapshot.iter_entries(filters):
+        record = manifest_record(entry, metadata_dir)
+        yield (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def iter_file_chunks(path, size):
+    """Lee exactamente `size` bytes de un archivo por trozos"""
+    with open(path, "rb") as f:
+        remaining = size
+        while remaining:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise OSError(f"{path} ha cambiado de tamaño durante la exportación")
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_export_images(snapshot, filters, saved_images_dir=SAVED_IMAGES_DIR):
+    """(nombre en el archivo, ruta, stat) de cada imagen de las entradas que cumplen los filtros"""
+    for image_file in snapshot.iter_image_files(filters):
+        path = resolve_image_path({"image_file": image_file}, saved_images_dir)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Borrada desde que se tomó la instantánea; el importador la cuenta como ausente
+            continue
+        yield archive_image_name(image_file), path, stat
+
+
+class _ChunkBuffer:
+    """Destino de escritura de zipfile que acumula lo escrito hasta que se envía"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _tar_member(name, size, mtime, chunks):
+    """Cabecera, contenido y relleno de un miembro de un tar"""
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    yield info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        yield chunk
+    if written != size:
+        raise RuntimeError(f"{name}: se esperaban {size} bytes y se generaron {written}")
+    yield b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+def _stream_tar(snapshot, filters, saved_images_dir, metadata_dir):
+    total = 0
+    for name, path, stat in iter_export_images(snapshot, filters, saved_images_dir):
+        for chunk in _tar_member(name, stat.st_size, stat.st_mtime, iter_file_chunks(path, stat.st_size)):
+            total += len(chunk)
+            yield chunk
+
+    # La cabecera del tar necesita el tamaño del manifiesto: se genera dos veces sobre la
+    # misma instantánea en lugar de guardarlo
+    size = sum(len(line) for line in iter_manifest(snapshot, filters, metadata_dir))
+    for chunk in _tar_member(MANIFEST_NAME, size, time.time(), iter_manifest(snapshot, filters, metadata_dir)):
+        total += len(chunk)
+        yield chunk
+
+    # Fin del archivo: dos bloques vacíos y relleno hasta un registro completo
+    end = 2 * tarfile.BLOCKSIZE
+    yield b"\0" * (end + (-(total + end) % tarfile.RECORDSIZE))
+
+
+def _zip_date(mtime):
+    return max(datetime.datetime.fromtimestamp(mtime), datetime.datetime(1980, 1, 1)).timetuple()[:6]
+
+
+def _stream_zip(snapshot, filters, saved_images_dir, metadata_dir):
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, path, stat in iter_export_images(snapshot, filters, saved_images_dir):
+            # Las imágenes ya están comprimidas: se guardan sin volver a comprimir
+            info = zipfile.ZipInfo(name, date_time=_zip_date(stat.st_mtime))
+            info.file_size = stat.st_size
+            with archive.open(info, "w") as member:
+                for chunk in iter_file_chunks(path, stat.st_size):
+                    member.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+
+        info = zipfile.ZipInfo(MANIFEST_NAME, date_time=_zip_date(time.time()))
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with archive.open(info, "w", force_zip64=True) as member:
+            for line in iter_manifest(snapshot, filters, metadata_dir):
+                member.write(line)
+                yield from buffer.drain()
+    yield from buffer.drain()
+
+
+def export_archive(store, filters=None, archive_format="tar", saved_images_dir=SAVED_IMAGES_DIR, metadata_dir=METADATA_DIR):
+    """
+    Devuelve un generador con el contenido del archivo por trozos (bytes).
+    Los filtros son los del historial (seed, model, model_hash, sampler, type, date_from, date_to).
+    Lanza ValueError si el formato o los filtros no son válidos, antes de empezar a generar.
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Formato de archivo inválido: {archive_format}")
+    filters = filters or {}
+    HistoryStore._filter_clauses(filters)
+    stream = _stream_tar if archive_format == "tar" else _stream_zip
+
+    def generate():
+        # La instantánea se abre al empezar a enviar y se cierra aunque el cliente se desconecte
+        with store.snapshot() as snapshot:
+            yield from stream(snapshot, filters, saved_images_dir, metadata_dir)
+
+    return generate()
+
+
+def _member_path(name):
+    """Ruta relativa segura de un miembro del archivo o None si sale del directorio"""
+    name = posixpath.normpath(name)
+    if name.startswith("/") or name == ".." or name.startswith("../"):
+        return None
+    return name
+
+
+class _ArchiveImporter:
+    """Coloca las imágenes y registra las entradas de un manifiesto por bloques"""
+
+    def __init__(self, store, lock, saved_images_dir, metadata_dir):
+        self.store = store
+        self.lock = lock
+        # fetch(nombre, destino) -> ruta de un archivo con la imagen o None si no está en el archivo;
+        # la asigna el lector de cada formato
+        self.fetch = None
+        self.saved_images_dir = saved_images_dir
+        self.metadata_dir = metadata_dir
+        self.summary = {"records": 0, "imported": 0, "existing": 0, "missing": 0, "errors": 0}
+        self.batch = []
+
+    def add(self, line):
+        """Procesa una línea (bytes) del manifiesto"""
+        line = line.strip()
+        if not line:
+            return
+        self.summary["records"] += 1
+        try:
+            record = json.loads(line)
+            filename, timestamp = record["filename"], record["timestamp"]
+            name = record.pop("archive_image")
+        except (ValueError, KeyError, TypeError):
+            self.summary["errors"] += 1
+            return
+        if self.store.get(filename) is not None:
+            self.summary["existing"] += 1
+            return
+
+        extension = os.path.splitext(name)[1]
+        if record.get("image_hash"):
+            image_file = blob_file_for(record["image_hash"], extension)
+        else:
+            # Imágenes sin hash (anteriores o importadas de carpetas): una por registro
+            image_file = os.path.join(date_dir(timestamp), f"{os.path.splitext(filename)[0]}{extension}")
+        image_path = os.path.join(self.saved_images_dir, image_file)
+
+        source = None if os.path.exists(image_path) else self.fetch(name, image_path)
+        if source is None and not os.path.exists(image_path):
+            self.summary["missing"] += 1
+            return
+
+        record["image_file"] = image_file
+        record["image_path"] = image_path
+        record["metadata_file"] = metadata_file_for(filename, timestamp)
+        # Como en los guardados, el JSON se escribe antes de registrar la imagen
+        atomic_write_json(os.path.join(self.metadata_dir, record["metadata_file"]), record)
+        self.batch.append((record, name, image_path, source))
+        if len(self.batch) >= ARCHIVE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Coloca las imágenes del bloque y lo registra en una transacción"""
+        if not self.batch:
+            return
+        entries = []
+        with self.lock:
+            for record, name, image_path, source in self.batch:
+                if os.path.exists(image_path):
+                    if source:
+                        discard(source)
+                else:
+                    if source is None or not os.path.exists(source):
+                        # Borrada desde que se leyó el registro (o compartida con uno ya colocado)
+                        source = self.fetch(name, image_path)
+                    if source is None:
+                        self.summary["missing"] += 1
+                        discard(os.path.join(self.metadata_dir, record["metadata_file"]))
+                        continue
+                    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                    replace_file(source, image_path)
+                entries.append(history_entry(record))
+            # Los registros que ya existían se omitieron al leerlos; un guardado que haya tomado
+            # el mismo nombre desde entonces se sustituye, como al importar carpetas
+            self.store.append_many(entries, replace=True)
+        self.summary["imported"] += len(entries)
+        self.batch.clear()
+
+
+def _copy_to_temp(source, image_path):
+    """Copia un archivo abierto a un temporal junto a su destino y devuelve su ruta"""
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    tmp_path = temp_path_for(image_path)
+    try:
+        with open(tmp_path, "wb") as f:
+            shutil.copyfileobj(source, f, CHUNK_SIZE)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    return tmp_path
+
+
+def _import_tar(path, importer, staging_dir):
+    def fetch(name, image_path):
+        staged = os.path.join(staging_dir, name)
+        return staged if os.path.exists(staged) else None
+
+    importer.fetch = fetch
+    # Acepta una ruta o un flujo ya abierto (por ejemplo, la entrada estándar)
+    options = {"name": path} if isinstance(path, str) else {"fileobj": path}
+    with tarfile.open(mode="r|*", **options) as archive:
+        for member in archive:
+            # En modo flujo tarfile acumula los miembros leídos; se vacía para usar memoria constante
+            archive.members = []
+            if not member.isfile():
+                continue
+            name = _member_path(member.name)
+            if name is None:
+                continue
+            if name.startswith(IMAGES_PREFIX):
+                staged = os.path.join(staging_dir, name)
+                os.makedirs(os.path.dirname(staged), exist_ok=True)
+                with archive.extractfile(member) as source, open(staged, "wb") as f:
+                    shutil.copyfileobj(source, f, CHUNK_SIZE)
+            elif name == MANIFEST_NAME:
+                with archive.extractfile(member) as manifest:
+                    for line in manifest:
+                        importer.add(line)
+                importer.flush()
+
+
+def _import_zip(path, importer):
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+
+        def fetch(name, image_path):
+            if name not in names:
+                return None
+            with archive.open(name) as source:
+                return _copy_to_temp(source, image_path)
+
+        importer.fetch = fetch
+        with archive.open(MANIFEST_NAME) as manifest:
+            for line in manifest:
+                importer.add(line)
+        importer.flush()
+
+
+def import_archive(store, path, lock, saved_images_dir=SAVED_IMAGES_DIR, metadata_dir=METADATA_DIR):
+    """
+    Importa un archivo tar o zip generado por export_archive en el historial. `path` es la
+    ruta del archivo o, para un tar, un flujo abierto en modo binario.
+    `lock` es el bloqueo de escritura del almacén; se adquiere por cada bloque de registros.
+    Devuelve un resumen con contadores y el rendimiento en registros por segundo.
+    """
+    start = time.perf_counter()
+    importer = _ArchiveImporter(store, lock, saved_images_dir, metadata_dir)
+    if isinstance(path, str) and zipfile.is_zipfile(path):
+        _import_zip(path, importer)
+    else:
+        # Directorio temporal en el mismo sistema de archivos: las imágenes se colocan renombrándolas
+        staging_dir = os.path.join(saved_images_dir, f"{STAGING_PREFIX}{os.getpid()}-{int(time.time())}.tmp")
+        try:
+            _import_tar(path, importer, staging_dir)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    summary = importer.summary
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["records_per_s"] = round(summary["records"] / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+def main(argv=None):
+    import argparse
+    from scripts.fileio import WriterLock
+    from scripts.history_store import FILTER_FIELDS
+
+    parser = argparse.ArgumentParser(description="Exporta o importa registros del historial como archivo tar/zip")
+    parser.add_argument("--saved-images-dir", default=SAVED_IMAGES_DIR)
+    parser.add_argument("--metadata-dir", default=METADATA_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Exporta los registros que cumplen los filtros")
+    export_parser.add_argument("output", help="Archivo de salida ('-' para la salida estándar)")
+    export_parser.add_argument("--format", choices=sorted(ARCHIVE_FORMATS), default=None,
+                               help="Formato (por defecto, según la extensión de la salida)")
+    for field in FILTER_FIELDS:
+        export_parser.add_argument(f"--{field.replace('_', '-')}", dest=field, default=None)
+    export_parser.add_argument("--date-from", default=None)
+    export_parser.add_argument("--date-to", default=None)
+
+    import_parser = commands.add_parser("import", help="Importa un archivo generado con export")
+    import_parser.add_argument("archive", help="Archivo tar o zip ('-' para leer un tar de la entrada estándar)")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(os.path.join(args.metadata_dir, "history.sqlite3"), metadata_dir=args.metadata_dir)
+
+    if args.command == "export":
+        archive_format = args.format or ("zip" if args.output.lower().endswith(".zip") else "tar")
+        filters = {field: getattr(args, field) for field in FILTER_FIELDS + ("date_from", "date_to")}
+        output = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        written = 0
+        try:
+            for chunk in export_archive(store, filters, archive_format, args.saved_images_dir, args.metadata_dir):
+                output.write(chunk)
+                written += len(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
+        print(f"[Image Metadata Saver] Exportados {written} bytes", file=sys.stderr)
+    else:
+        # Mismo bloqueo que los guardados de la WebUI, adquirido por bloques de registros
+        lock = WriterLock(os.path.join(args.metadata_dir, ".write.lock"))
+        source = sys.stdin.buffer if args.archive == "-" else args.archive
+        summary = import_archive(store, source, lock, args.saved_images_dir, args.metadata_dir)
+        print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Guardado automático de la extensión Image Metadata Saver
+Se engancha al callback de imagen guardada de Automatic1111 y envía las imágenes
+generadas a la cola de guardado aplicando muestreo, filtros y un límite de ritmo.
+"""
+
+import threading
+import time
+from collections import deque
+
+from scripts.extension_config import load_section, save_section
+from scripts.save_queue import QueueFullError
+
+CONFIG_SECTION = "auto_save"
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    # Guardar solo una de cada N imágenes que pasen los filtros
+    "every_nth": 1,
+    # Máximo de imágenes encoladas por minuto (0 = sin límite)
+    "max_per_minute": 0,
+    # Tipos de generación aceptados (vacío = todos)
+    "types": [],
+    # Nombres de modelo aceptados (vacío = todos)
+    "models": [],
+    # Lado mínimo de la imagen en píxeles (0 = sin límite)
+    "min_size": 0,
+    # Ignorar las cuadrículas que genera la WebUI
+    "skip_grids": True
+}
+
+
+class AutoSaver:
+    """Estado y contadores del guardado automático"""
+
+    def __init__(self, extract, save, submit):
+        self._extract = extract
+        self._save = save
+        self._submit = submit
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self._sampled = 0
+        self.config = load_section(CONFIG_SECTION, DEFAULT_CONFIG)
+        self.counters = {"seen": 0, "filtered": 0, "queued": 0, "written": 0, "failed": 0, "dropped": 0}
+
+    def update_config(self, **values):
+        """Actualiza y persiste la configuración"""
+        with self._lock:
+            self.config.update({key: value for key, value in values.items() if key in DEFAULT_CONFIG})
+            self.config["every_nth"] = max(1, int(self.config["every_nth"] or 1))
+            self.config["max_per_minute"] = max(0, int(self.config["max_per_minute"] or 0))
+            self.config["min_size"] = max(0, int(self.config["min_size"] or 0))
+            config = dict(self.config)
+        save_section(CONFIG_SECTION, config)
+        return config
+
+    def stats(self):
+        """Configuración y contadores actuales"""
+        with self._lock:
+            return {"config": dict(self.config), "counters": dict(self.counters)}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _accepts(self, image, parameters, filename):
+        """Aplica los filtros de tipo, modelo, tamaño y cuadrícula"""
+        config = self.config
+        if config["skip_grids"] and filename and "grid" in filename.replace("\\", "/").rsplit("/", 1)[-1]:
+            return False
+        if config["types"] and parameters.get("type", "other") not in config["types"]:
+            return False
+        if config["models"] and parameters.get("model") not in config["models"]:
+            return False
+        if config["min_size"] and min(image.width, image.height) < config["min_size"]:
+            return False
+        return True
+
+    def _take_slot(self):
+        """Aplica el muestreo y el límite de ritmo; devuelve (aceptada, motivo)"""
+        with self._lock:
+            self._sampled += 1
+            if (self._sampled - 1) % self.config["every_nth"] != 0:
+                return False, "filtered"
+
+            max_per_minute = self.config["max_per_minute"]
+            if max_per_minute:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] > 60:
+                    self._recent.popleft()
+                if len(self._recent) >= max_per_minute:
+                    return False, "dropped"
+                self._recent.append(now)
+            return True, None
+
+    def on_image_saved(self, params):
+        """Callback de script_callbacks.on_image_saved"""
+        if not self.config["enabled"]:
+            return
+
+        self._count("seen")
+        try:
+            image = params.image
+            # Los metadatos se extraen ya: el objeto de procesamiento cambia en la siguiente imagen
+            metadata = self._extract(image, getattr(params, "p", None))
+            parameters = metadata.get("parameters", {})
+            if not isinstance(parameters, dict):
+                parameters = {}
+
+            if not self._accepts(image, parameters, getattr(params, "filename", "")):
+                self._count("filtered")
+                return
+
+            accepted, reason = self._take_slot()
+            if not accepted:
+                self._count(reason)
+                return
+
+            self._submit(self._job, image, metadata)
+            self._count("queued")
+        except QueueFullError:
+            # No bloquear la generación si la cola está llena
+            self._count("dropped")
+        except Exception as e:
+            self._count("failed")
+            print(f"[Image Metadata Saver] Error en el guardado automático: {e}")
+
+    def _job(self, image, metadata):
+        try:
+            result = self._save(image, metadata=metadata)
+        except Exception:
+            self._count("failed")
+            raise
+        self._count("written")
+        return result
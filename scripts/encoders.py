@@ -0,0 +1,112 @@
+"""
+Perfiles de codificación de imágenes para la extensión Image Metadata Saver
+Permite elegir entre PNG con distintos niveles de compresión, WebP (con o sin pérdida),
+JPEG y JPEG XL (si hay un plugin de Pillow instalado), incrustando los parámetros de
+generación como texto PNG o como EXIF UserComment.
+"""
+
+from io import BytesIO
+
+from PIL import Image, PngImagePlugin
+
+# Etiquetas EXIF usadas para incrustar los parámetros de generación
+EXIF_IFD_POINTER = 0x8769
+EXIF_USER_COMMENT = 0x9286
+
+# Perfil por defecto (mismo resultado que image.save() en versiones anteriores)
+DEFAULT_PROFILE = "png"
+
+# Perfiles disponibles: formato de Pillow, extensión y argumentos de save()
+ENCODER_PROFILES = {
+    "png": {
+        "label": "PNG (compresión por defecto)",
+        "format": "PNG",
+        "extension": ".png",
+        "options": {"compress_level": 6, "optimize": False}
+    },
+    "png_fast": {
+        "label": "PNG rápido (compresión mínima)",
+        "format": "PNG",
+        "extension": ".png",
+        "options": {"compress_level": 1, "optimize": False}
+    },
+    "webp_lossless": {
+        "label": "WebP sin pérdida",
+        "format": "WEBP",
+        "extension": ".webp",
+        "options": {"lossless": True, "quality": 0, "method": 0}
+    },
+    "webp": {
+        "label": "WebP calidad 90",
+        "format": "WEBP",
+        "extension": ".webp",
+        "options": {"quality": 90, "method": 4}
+    },
+    "jpeg": {
+        "label": "JPEG calidad 92",
+        "format": "JPEG",
+        "extension": ".jpg",
+        "options": {"quality": 92}
+    },
+    "jxl_lossless": {
+        "label": "JPEG XL sin pérdida (requiere plugin)",
+        "format": "JXL",
+        "extension": ".jxl",
+        "options": {"lossless": True, "effort": 1}
+    }
+}
+
+
+def available_profiles():
+    """Nombres de los perfiles que el Pillow instalado puede escribir"""
+    Image.init()
+    return [name for name, profile in ENCODER_PROFILES.items() if profile["format"] in Image.SAVE]
+
+
+def get_profile(name):
+    """Devuelve un perfil por nombre (o el perfil por defecto si no existe o no está disponible)"""
+    if name not in available_profiles():
+        name = DEFAULT_PROFILE
+    return name, ENCODER_PROFILES[name]
+
+
+def _user_comment(text):
+    """Codifica un texto como EXIF UserComment (prefijo UNICODE, UTF-16 big endian)"""
+    return b"UNICODE\0" + text.encode("utf-16-be")
+
+
+def _prepare(image, profile):
+    """Convierte el modo de la imagen si el formato no lo admite"""
+    if profile["format"] == "JPEG" and image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    if profile["format"] in ("WEBP", "JXL") and image.mode not in ("RGB", "RGBA"):
+        return image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    return image
+
+
+def encode_image(image, fp, profile_name=DEFAULT_PROFILE, parameters=None):
+    """
+    Codifica la imagen en `fp` (ruta o archivo) con el perfil indicado.
+    Los parámetros de generación se incrustan como texto PNG o EXIF UserComment.
+    """
+    _, profile = get_profile(profile_name)
+    options = dict(profile["options"])
+
+    if parameters:
+        if profile["format"] == "PNG":
+            pnginfo = PngImagePlugin.PngInfo()
+            pnginfo.add_text("parameters", parameters)
+            options["pnginfo"] = pnginfo
+        else:
+            exif = Image.Exif()
+            exif.get_ifd(EXIF_IFD_POINTER)[EXIF_USER_COMMENT] = _user_comment(parameters)
+            options["exif"] = exif.tobytes()
+
+    _prepare(image, profile).save(fp, format=profile["format"], **options)
+
+
+def encode_to_bytes(image, profile_name=DEFAULT_PROFILE, parameters=None):
+    """Codifica la imagen en memoria y devuelve los bytes resultantes"""
+    buffered = BytesIO()
+    encode_image(image, buffered, profile_name, parameters)
+    return buffered.getvalue()
@@ -0,0 +1,42 @@
+"""
+Configuración persistente de la extensión Image Metadata Saver
+Guarda las opciones de cada módulo como secciones de un único archivo JSON.
+"""
+
+import os
+import json
+import threading
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.json")
+
+_lock = threading.Lock()
+
+
+def load_section(section, defaults):
+    """Devuelve la sección de configuración combinada con sus valores por defecto"""
+    config = dict(defaults)
+    with _lock:
+        try:
+            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+                stored = json.load(f).get(section, {})
+        except (OSError, ValueError):
+            stored = {}
+    if isinstance(stored, dict):
+        config.update({key: value for key, value in stored.items() if key in defaults})
+    return config
+
+
+def save_section(section, values):
+    """Guarda una sección de configuración conservando el resto del archivo"""
+    with _lock:
+        try:
+            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
+                config = json.load(f)
+        except (OSError, ValueError):
+            config = {}
+        config[section] = values
+
+        tmp_path = f"{CONFIG_FILE}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(config, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, CONFIG_FILE)
@@ -0,0 +1,127 @@
+"""
+Escrituras seguras para la extensión Image Metadata Saver
+- Escrituras atómicas: se escribe en un archivo temporal del mismo directorio, se
+  sincroniza con el disco y se renombra, así que un corte nunca deja un archivo a medias.
+- Bloqueo de escritura único para todo el almacén, válido entre hilos y entre procesos
+  (la WebUI y los scripts de mantenimiento), basado en un archivo de bloqueo.
+"""
+
+import os
+import json
+import threading
+import itertools
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+# Contador de temporales del proceso: un mismo hilo (por ejemplo, del grupo de codificación)
+# puede preparar otro temporal del mismo destino antes de que se coloque el anterior
+_temp_counter = itertools.count()
+
+
+def temp_path_for(path):
+    """Ruta temporal única (por proceso, hilo y llamada) junto al archivo final"""
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.{next(_temp_counter)}.tmp"
+
+
+def replace_file(tmp_path, path):
+    """Sincroniza el temporal con el disco y lo renombra al destino"""
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(path, data):
+    """Escribe un JSON de forma atómica (crea el directorio si no existe); devuelve los bytes escritos"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = temp_path_for(path)
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(tmp_path, path)
+    except BaseException:
+        discard(tmp_path)
+        raise
+    return size
+
+
+def discard(path):
+    """Elimina un archivo temporal si existe"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class WriterLock:
+    """
+    Bloqueo exclusivo reentrante entre hilos (RLock) y entre procesos (archivo de bloqueo).
+    Protege las operaciones que combinan archivos e índice, como colocar una imagen
+    y registrarla o borrar un registro y su imagen huérfana.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    self._lock_file(fd)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            try:
+                self._unlock_file(fd)
+            finally:
+                os.close(fd)
+        self._lock.release()
+
+    @staticmethod
+    def _lock_file(fd):
+        if os.name == "nt":
+            # LK_LOCK reintenta durante unos segundos; se repite hasta obtenerlo
+            while True:
+                try:
+                    msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                    return
+                except OSError:
+                    continue
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+    @staticmethod
+    def _unlock_file(fd):
+        if os.name == "nt":
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
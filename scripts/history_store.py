@@ -0,0 +1,856 @@
+"""
+Almacén de historial para la extensión Image Metadata Saver
+Guarda el historial en una tabla SQLite para que cada guardado sea una inserción O(1)
+en lugar de reescribir history.json completo.
+"""
+
+import os
+import json
+import base64
+import sqlite3
+import threading
+
+from scripts.layout import metadata_file_for
+from scripts.records import compact_record, pack_record, unpack_record
+
+# Versión del esquema de la base de datos (PRAGMA user_version)
+SCHEMA_VERSION = 10
+
+# Columnas que forman una entrada del historial, en el mismo formato que history.json
+HISTORY_FIELDS = ("timestamp", "filename", "preview", "metadata_file")
+
+# Columnas indexadas por las que se puede filtrar el historial
+FILTER_FIELDS = ("seed", "model", "model_hash", "sampler", "type")
+
+# Ubicación del archivo de imagen (relativa al directorio de imágenes) y hash de su contenido
+STORAGE_FIELDS = ("image_file", "image_hash")
+
+# Tamaño en bytes del archivo de imagen y marca de favorito (excluido de la retención)
+RETENTION_FIELDS = ("image_size", "starred")
+
+# Hash perceptual de la imagen (ver scripts/similarity.py); NULL pendiente, vacío si no se pudo calcular
+SIMILARITY_FIELDS = ("phash",)
+
+# Condición de las entradas cuya imagen está en el almacén (no importadas de carpetas externas)
+STORED_IMAGE_CLAUSE = "filename NOT IN (SELECT filename FROM imported_files WHERE filename IS NOT NULL)"
+
+# Todas las columnas que se devuelven en cada entrada
+ENTRY_FIELDS = HISTORY_FIELDS + FILTER_FIELDS + STORAGE_FIELDS + RETENTION_FIELDS + SIMILARITY_FIELDS
+
+# Columnas de texto indexadas para la búsqueda por prompt
+SEARCH_FIELDS = ("prompt", "negative_prompt")
+
+# Límites de paginación
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(timestamp, row_id):
+    """Codifica la posición de la última entrada de una página como cursor opaco"""
+    raw = json.dumps([timestamp, row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decodifica un cursor; lanza ValueError si no es válido"""
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(timestamp), int(row_id)
+    except Exception as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+
+
+def build_match_query(text, field=None):
+    """
+    Convierte el texto introducido por el usuario en una consulta FTS5 segura:
+    cada palabra se cita (sin operadores) y la última admite prefijo.
+    """
+    tokens = [token.replace('"', '""') for token in text.split()]
+    if not tokens:
+        return None
+    terms = [f'"{token}"' for token in tokens]
+    terms[-1] += "*"
+    query = " ".join(terms)
+    if field:
+        if field not in SEARCH_FIELDS:
+            raise ValueError(f"Campo de búsqueda inválido: {field}")
+        query = f"{field} : ({query})"
+    return query
+
+
+def history_entry(metadata):
+    """Construye la entrada de historial (con los campos filtrables) a partir de los metadatos"""
+    parameters = metadata.get("parameters", {})
+    if not isinstance(parameters, dict):
+        parameters = {}
+    prompt = parameters.get("prompt", "") or ""
+    entry = {
+        "timestamp": metadata["timestamp"],
+        "filename": metadata["filename"],
+        "preview": prompt[:100] + "..." if len(prompt) > 100 else prompt,
+        "metadata_file": metadata.get("metadata_file") or metadata_file_for(metadata["filename"], metadata["timestamp"])
+    }
+    for field in FILTER_FIELDS + SEARCH_FIELDS:
+        entry[field] = parameters.get(field)
+    entry["image_file"] = metadata.get("image_file")
+    entry["image_hash"] = metadata.get("image_hash")
+    entry["image_size"] = metadata.get("image_size")
+    entry["starred"] = 1 if metadata.get("starred") else 0
+    entry["phash"] = metadata.get("phash")
+    # Copia empaquetada del registro completo: la API lo lee del índice sin abrir el JSON
+    entry["record"] = pack_record(compact_record(metadata))
+    return entry
+
+
+class HistoryStore:
+    """Historial de imágenes guardadas respaldado por SQLite"""
+
+    def __init__(self, db_path, legacy_file=None, metadata_dir=None):
+        self.db_path = db_path
+        self.legacy_file = legacy_file
+        # Directorio base de las rutas relativas de metadata_file
+        self.metadata_dir = metadata_dir or os.path.dirname(db_path)
+        self._lock = threading.RLock()
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        try:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            # Necesario para que INSERT OR REPLACE dispare el trigger de borrado del índice de búsqueda
+            self._conn.execute("PRAGMA recursive_triggers=ON")
+
+            self._migrate_schema()
+        except sqlite3.DatabaseError:
+            # Base de datos ilegible: se cierra para que se pueda apartar (ver scripts/recovery.py)
+            self._conn.close()
+            raise
+        if legacy_file:
+            self._import_legacy_history(legacy_file)
+
+    def _migrate_schema(self):
+        """Crea o actualiza las tablas según la versión del esquema"""
+        with self._lock:
+            version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
+
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Otro proceso puede haber migrado el esquema mientras se esperaba el bloqueo
+                version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    self._conn.execute("COMMIT")
+                    return
+
+                if version < 1:
+                    self._conn.execute("""
+                        CREATE TABLE IF NOT EXISTS history (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            timestamp TEXT NOT NULL,
+                            filename TEXT NOT NULL UNIQUE,
+                            preview TEXT NOT NULL DEFAULT '',
+                            metadata_file TEXT NOT NULL DEFAULT ''
+                        )
+                    """)
+                    self._conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)")
+
+                if version < 2:
+                    for field in FILTER_FIELDS:
+                        affinity = "INTEGER" if field == "seed" else "TEXT"
+                        self._conn.execute(f"ALTER TABLE history ADD COLUMN {field} {affinity}")
+                    # Índices compuestos para paginar por (timestamp, id) con o sin filtro
+                    self._conn.execute("DROP INDEX IF EXISTS idx_history_timestamp")
+                    self._conn.execute("CREATE INDEX idx_history_timestamp ON history(timestamp, id)")
+                    for field in FILTER_FIELDS:
+                        self._conn.execute(f"CREATE INDEX idx_history_{field} ON history({field}, timestamp, id)")
+                    self._backfill_from_metadata()
+
+                if version < 3:
+                    self._conn.execute(f"""
+                        CREATE VIRTUAL TABLE history_fts USING fts5(
+                            {', '.join(SEARCH_FIELDS)},
+                            tokenize='unicode61 remove_diacritics 2'
+                        )
+                    """)
+                    self._conn.execute("""
+                        CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+                            DELETE FROM history_fts WHERE rowid = old.id;
+                        END
+                    """)
+                    self._backfill_from_metadata(index_text=True)
+
+                if version < 4:
+                    for field in STORAGE_FIELDS:
+                        self._conn.execute(f"ALTER TABLE history ADD COLUMN {field} TEXT")
+                    # Las entradas anteriores guardaban la imagen con el mismo nombre que el registro
+                    self._conn.execute("UPDATE history SET image_file = filename")
+                    self._conn.execute("CREATE INDEX idx_history_image_hash ON history(image_hash)")
+                    # Imágenes almacenadas por contenido y número de registros que las usan
+                    self._conn.execute("""
+                        CREATE TABLE blobs (
+                            hash TEXT PRIMARY KEY,
+                            image_file TEXT NOT NULL,
+                            refcount INTEGER NOT NULL DEFAULT 0
+                        )
+                    """)
+                    self._conn.execute("""
+                        CREATE TRIGGER history_blob_ref AFTER INSERT ON history
+                        WHEN new.image_hash IS NOT NULL BEGIN
+                            INSERT INTO blobs (hash, image_file, refcount) VALUES (new.image_hash, new.image_file, 1)
+                            ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1;
+                        END
+                    """)
+                    self._conn.execute("""
+                        CREATE TRIGGER history_blob_unref AFTER DELETE ON history
+                        WHEN old.image_hash IS NOT NULL BEGIN
+                            UPDATE blobs SET refcount = refcount - 1 WHERE hash = old.image_hash;
+                        END
+                    """)
+
+                if version < 5:
+                    # Valores clave/valor del propio índice (por ejemplo, el formato de directorios)
+                    self._conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+                if version < 6:
+                    # Archivos ya importados desde carpetas externas (para importaciones incrementales)
+                    self._conn.execute("""
+                        CREATE TABLE imported_files (
+                            path TEXT PRIMARY KEY,
+                            mtime REAL NOT NULL,
+                            size INTEGER NOT NULL,
+                            filename TEXT
+                        )
+                    """)
+
+                if version < 7:
+                    # Registro compacto empaquetado (no se incluye en las entradas del historial)
+                    self._conn.execute("ALTER TABLE history ADD COLUMN record BLOB")
+
+                if version < 8:
+                    # Tamaño de la imagen (NULL si se desconoce; lo completa el barrido de retención)
+                    self._conn.execute("ALTER TABLE history ADD COLUMN image_size INTEGER")
+                    self._conn.execute("ALTER TABLE history ADD COLUMN starred INTEGER NOT NULL DEFAULT 0")
+
+                if version < 9:
+                    # Hash perceptual (lo calculan los guardados nuevos y scripts/similarity.py)
+                    self._conn.execute("ALTER TABLE history ADD COLUMN phash TEXT")
+
+                if version < 10:
+                    # Las referencias se cuentan por archivo y no por hash: los mismos píxeles
+                    # guardados con otro perfil de codificación son otro archivo (.png, .webp...)
+                    self._conn.execute("DROP TRIGGER IF EXISTS history_blob_ref")
+                    self._conn.execute("DROP TRIGGER IF EXISTS history_blob_unref")
+                    self._conn.execute("DROP TABLE blobs")
+                    self._conn.execute("""
+                        CREATE TABLE blobs (
+                            image_file TEXT PRIMARY KEY,
+                            hash TEXT NOT NULL,
+                            refcount INTEGER NOT NULL DEFAULT 0
+                        )
+                    """)
+                    self._conn.execute("CREATE INDEX idx_blobs_hash ON blobs(hash)")
+                    self._conn.execute("""
+                        INSERT INTO blobs (image_file, hash, refcount)
+                        SELECT image_file, MIN(image_hash), COUNT(*) FROM history
+                        WHERE image_hash IS NOT NULL GROUP BY image_file
+                    """)
+                    self._conn.execute("""
+                        CREATE TRIGGER history_blob_ref AFTER INSERT ON history
+                        WHEN new.image_hash IS NOT NULL BEGIN
+                            INSERT INTO blobs (image_file, hash, refcount) VALUES (new.image_file, new.image_hash, 1)
+                            ON CONFLICT(image_file) DO UPDATE SET refcount = refcount + 1;
+                        END
+                    """)
+                    self._conn.execute("""
+                        CREATE TRIGGER history_blob_unref AFTER DELETE ON history
+                        WHEN old.image_hash IS NOT NULL BEGIN
+                            UPDATE blobs SET refcount = refcount - 1 WHERE image_file = old.image_file;
+                        END
+                    """)
+
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _backfill_from_metadata(self, index_text=False):
+        """
+        Rellena las columnas de filtro de las entradas existentes desde sus JSON
+        y, opcionalmente, indexa sus prompts para la búsqueda.
+        """
+        if index_text:
+            rows = self._conn.execute(
+                "SELECT id, metadata_file FROM history WHERE id NOT IN (SELECT rowid FROM history_fts)"
+            ).fetchall()
+        else:
+            rows = self._conn.execute(
+                f"SELECT id, metadata_file FROM history WHERE {' AND '.join(f'{field} IS NULL' for field in FILTER_FIELDS)}"
+            ).fetchall()
+
+        for row in rows:
+            try:
+                with open(os.path.join(self.metadata_dir, row["metadata_file"]), "r", encoding="utf-8") as f:
+                    parameters = json.load(f).get("parameters", {})
+            except (OSError, ValueError):
+                continue
+            if not isinstance(parameters, dict):
+                continue
+            self._conn.execute(
+                f"UPDATE history SET {', '.join(f'{field} = COALESCE({field}, ?)' for field in FILTER_FIELDS)} WHERE id = ?",
+                tuple(parameters.get(field) for field in FILTER_FIELDS) + (row["id"],)
+            )
+            if index_text:
+                self._index_text(row["id"], parameters)
+
+    def _index_text(self, row_id, entry):
+        """Añade los prompts de una entrada al índice de búsqueda"""
+        values = tuple(str(entry.get(field) or "") for field in SEARCH_FIELDS)
+        if not any(values):
+            return
+        self._conn.execute(
+            f"INSERT INTO history_fts (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (?, {', '.join('?' for _ in SEARCH_FIELDS)})",
+            (row_id,) + values
+        )
+
+    def _import_legacy_history(self, legacy_file):
+        """Migra el antiguo history.json a la base de datos (solo una vez)"""
+        if not os.path.exists(legacy_file):
+            return
+
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[Image Metadata Saver] No se pudo leer {legacy_file} para migrarlo: {e}")
+            return
+
+        if isinstance(entries, list):
+            self.append_many(entries, replace=True)
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._backfill_from_metadata()
+                    self._backfill_from_metadata(index_text=True)
+                    self._conn.execute("COMMIT")
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+
+        # Renombrar el archivo antiguo para no volver a migrarlo
+        os.replace(legacy_file, f"{legacy_file}.migrated")
+        print(f"[Image Metadata Saver] Migradas {len(entries) if isinstance(entries, list) else 0} entradas desde {legacy_file}")
+
+    @staticmethod
+    def _entry_values(entry):
+        return (
+            tuple(entry.get(field) or "" for field in HISTORY_FIELDS)
+            + tuple(entry.get(field) for field in FILTER_FIELDS)
+            # Sin ubicación explícita la imagen se llama igual que el registro
+            + (entry.get("image_file") or entry.get("filename"), entry.get("image_hash"))
+            + (entry.get("image_size"), 1 if entry.get("starred") else 0)
+            + (entry.get("phash"),)
+            + (entry.get("record"),)
+        )
+
+    def append(self, entry):
+        """Añade una entrada al historial"""
+        self.append_many([entry])
+
+    def append_many(self, entries, replace=False):
+        """
+        Añade varias entradas al historial en una única transacción. Sin `replace`, un nombre
+        que ya existe lanza sqlite3.IntegrityError y no se registra ninguna entrada.
+        """
+        entries = [entry for entry in entries if entry.get("filename")]
+        if not entries:
+            return
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._insert_entries(entries, replace=replace)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _insert_entries(self, entries, replace=False):
+        """Inserta entradas dentro de la transacción en curso (con `replace`, sustituye las que ya existen)"""
+        sql = (
+            f"INSERT {'OR REPLACE ' if replace else ''}INTO history ({', '.join(ENTRY_FIELDS)}, record) "
+            f"VALUES ({', '.join('?' for _ in ENTRY_FIELDS)}, ?)"
+        )
+        for entry in entries:
+            row_id = self._conn.execute(sql, self._entry_values(entry)).lastrowid
+            self._index_text(row_id, entry)
+
+    def imported_files(self):
+        """Devuelve {ruta: (mtime, tamaño)} de los archivos externos ya importados"""
+        with self._lock:
+            rows = self._conn.execute("SELECT path, mtime, size FROM imported_files").fetchall()
+        return {row["path"]: (row["mtime"], row["size"]) for row in rows}
+
+    def record_imported(self, entries, files):
+        """
+        Registra entradas importadas y marca sus archivos como vistos en la misma transacción,
+        de modo que una importación interrumpida se pueda reanudar sin duplicados.
+        `files` es una lista de (ruta, mtime, tamaño, filename o None).
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Los nombres de las importaciones son estables: volver a importar un archivo lo sustituye
+                self._insert_entries([entry for entry in entries if entry.get("filename")], replace=True)
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO imported_files (path, mtime, size, filename) VALUES (?, ?, ?, ?)",
+                    files
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, filename):
+        """
+        Elimina una entrada del historial.
+        Devuelve (existía, archivos de imagen que ya no usa ningún registro).
+        """
+        entries, orphaned = self.delete_many([filename])
+        return bool(entries), orphaned
+
+    def delete_many(self, filenames):
+        """
+        Elimina varias entradas en una única transacción.
+        Devuelve (entradas eliminadas, archivos de imagen que ya no usa ningún registro).
+        """
+        deleted, orphaned = [], []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for filename in filenames:
+                    row = self._conn.execute(
+                        f"SELECT {', '.join(ENTRY_FIELDS)} FROM history WHERE filename = ?", (filename,)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    self._conn.execute("DELETE FROM history WHERE filename = ?", (filename,))
+                    deleted.append(dict(row))
+                    orphaned.extend(self._collect_orphans(row))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return deleted, orphaned
+
+    def _collect_orphans(self, row):
+        """Devuelve el archivo de imagen de un registro borrado si ya no tiene referencias"""
+        if row["image_hash"] is None:
+            # Imágenes anteriores al almacenamiento por contenido: una por registro.
+            # Las importadas (ruta absoluta fuera del almacén) nunca se borran del disco.
+            if not row["image_file"] or os.path.isabs(row["image_file"]):
+                return []
+            return [row["image_file"]]
+
+        blob = self._conn.execute(
+            "SELECT image_file, refcount FROM blobs WHERE image_file = ?", (row["image_file"],)
+        ).fetchone()
+        if blob is None or blob["refcount"] > 0:
+            return []
+        self._conn.execute("DELETE FROM blobs WHERE image_file = ?", (row["image_file"],))
+        return [blob["image_file"]]
+
+    def rebuild(self, entries):
+        """
+        Sustituye todas las entradas del historial (y las referencias de las imágenes)
+        en una única transacción. Devuelve el número de entradas registradas.
+        """
+        entries = [entry for entry in entries if entry.get("filename")]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM history")
+                self._conn.execute("DELETE FROM blobs")
+                self._insert_entries(entries, replace=True)
+                count = self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return count
+
+    def update_locations(self, locations):
+        """Actualiza en una transacción las rutas de varios registros: [(filename, metadata_file, image_file)]"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE history SET metadata_file = ?, image_file = ? WHERE filename = ?",
+                    [(metadata_file, image_file, filename) for filename, metadata_file, image_file in locations]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def fill_missing_fields(self, rows):
+        """
+        Completa en una transacción los campos de filtro vacíos y la búsqueda de texto
+        de varios registros. Cada fila es un diccionario con "filename" y los parámetros y,
+        opcionalmente, "record" con el registro reescrito, que sustituye a la copia empaquetada.
+        """
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for row in rows:
+                    found = self._conn.execute(
+                        "SELECT id, id IN (SELECT rowid FROM history_fts) AS indexed FROM history WHERE filename = ?",
+                        (row["filename"],)
+                    ).fetchone()
+                    if found is None:
+                        continue
+                    self._conn.execute(
+                        f"UPDATE history SET {', '.join(f'{field} = COALESCE({field}, ?)' for field in FILTER_FIELDS)} WHERE id = ?",
+                        tuple(row.get(field) for field in FILTER_FIELDS) + (found["id"],)
+                    )
+                    if not found["indexed"]:
+                        self._index_text(found["id"], row)
+                    if row.get("record") is not None:
+                        self._conn.execute(
+                            "UPDATE history SET record = ? WHERE id = ?",
+                            (pack_record(compact_record(row["record"])), found["id"])
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_starred(self, filenames, starred=True):
+        """Marca o desmarca varias entradas como favoritas; devuelve las que existían"""
+        changed = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for filename in filenames:
+                    row = self._conn.execute("SELECT record FROM history WHERE filename = ?", (filename,)).fetchone()
+                    if row is None:
+                        continue
+                    # La copia empaquetada del registro también lleva la marca
+                    record = unpack_record(row["record"])
+                    if record is not None:
+                        record["starred"] = bool(starred)
+                    self._conn.execute(
+                        "UPDATE history SET starred = ?, record = ? WHERE filename = ?",
+                        (1 if starred else 0, pack_record(record) if record is not None else row["record"], filename)
+                    )
+                    changed.append(filename)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return changed
+
+    def retention_candidates(self, before=None, limit=DEFAULT_PAGE_SIZE, keep_starred=True, stored_only=False, filters=None):
+        """
+        Entradas más antiguas primero que se pueden borrar: anteriores a `before` (timestamp ISO)
+        si se indica, que cumplen los filtros y, con keep_starred, que no son favoritas.
+        stored_only descarta las importadas de carpetas externas (borrarlas no libera espacio).
+        """
+        clauses, params = self._filter_clauses(filters or {})
+        if before:
+            clauses.append("timestamp < ?")
+            params.append(before)
+        if keep_starred:
+            clauses.append("starred = 0")
+        if stored_only:
+            clauses.append(STORED_IMAGE_CLAUSE)
+        sql = f"SELECT {', '.join(ENTRY_FIELDS)} FROM history"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY timestamp, id LIMIT ?"
+        with self._lock:
+            rows = self._conn.execute(sql, params + [max(1, int(limit))]).fetchall()
+        return [dict(row) for row in rows]
+
+    def image_bytes(self):
+        """
+        Bytes ocupados por las imágenes del almacén (cada archivo una vez; las importadas de
+        carpetas externas no cuentan) y número de entradas con tamaño desconocido.
+        """
+        with self._lock:
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM "
+                f"(SELECT MAX(image_size) AS size FROM history WHERE {STORED_IMAGE_CLAUSE} GROUP BY image_file)"
+            ).fetchone()[0]
+            unknown = self._conn.execute("SELECT COUNT(*) FROM history WHERE image_size IS NULL").fetchone()[0]
+        return total, unknown
+
+    def missing_sizes(self, limit=MAX_PAGE_SIZE):
+        """Entradas sin tamaño de imagen registrado (filename, image_file)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, image_file FROM history WHERE image_size IS NULL LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row["filename"], row["image_file"] or row["filename"]) for row in rows]
+
+    def set_image_sizes(self, sizes):
+        """Registra en una transacción el tamaño de la imagen de varias entradas: [(filename, bytes)]"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE history SET image_size = ? WHERE filename = ?",
+                    [(size, filename) for filename, size in sizes]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def missing_phashes(self, limit=MAX_PAGE_SIZE):
+        """Entradas sin hash perceptual calculado (filename, image_file)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT filename, image_file FROM history WHERE phash IS NULL LIMIT ?", (limit,)
+            ).fetchall()
+        return [(row["filename"], row["image_file"] or row["filename"]) for row in rows]
+
+    def set_phashes(self, hashes):
+        """Registra en una transacción el hash perceptual de varias entradas: [(filename, hash)]"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "UPDATE history SET phash = ? WHERE filename = ?",
+                    [(phash, filename) for filename, phash in hashes]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def phashes_since(self, row_id):
+        """Entradas con hash perceptual añadidas después de `row_id`: [(id, filename, hash)] por id"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, filename, phash FROM history WHERE id > ? AND phash IS NOT NULL AND phash != '' ORDER BY id",
+                (row_id,)
+            ).fetchall()
+        return [(row["id"], row["filename"], row["phash"]) for row in rows]
+
+    def blob_referenced(self, image_file):
+        """Indica si alguna entrada usa la imagen almacenada en `image_file` (ruta relativa)"""
+        with self._lock:
+            row = self._conn.execute("SELECT refcount FROM blobs WHERE image_file = ?", (image_file,)).fetchone()
+        return row is not None and row["refcount"] > 0
+
+    def get_meta(self, key, default=None):
+        """Lee un valor de la tabla meta"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def set_meta(self, key, value):
+        """Guarda un valor en la tabla meta"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get(self, filename):
+        """Devuelve la entrada de un archivo o None si no existe"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(ENTRY_FIELDS)} FROM history WHERE filename = ?",
+                (filename,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def get_record(self, filename):
+        """Devuelve el registro de metadatos guardado en el índice o None (registros anteriores)"""
+        with self._lock:
+            row = self._conn.execute("SELECT record FROM history WHERE filename = ?", (filename,)).fetchone()
+        return unpack_record(row["record"]) if row else None
+
+    def get_by_stem(self, stem):
+        """Devuelve la entrada cuyo nombre sin extensión es `stem` (por ejemplo, a partir del nombre del JSON)"""
+        with self._lock:
+            # Rango [stem + ".", stem + "/"): todas las extensiones de ese nombre, usando el índice único
+            row = self._conn.execute(
+                f"SELECT {', '.join(ENTRY_FIELDS)} FROM history WHERE filename > ? AND filename < ? LIMIT 1",
+                (f"{stem}.", f"{stem}/")
+            ).fetchone()
+        return dict(row) if row else None
+
+    def all(self):
+        """Devuelve todas las entradas en orden de inserción"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(ENTRY_FIELDS)} FROM history ORDER BY id"
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _filter_clauses(filters):
+        """Convierte los filtros recibidos en cláusulas WHERE y sus parámetros"""
+        clauses, params = [], []
+        for field in FILTER_FIELDS:
+            value = filters.get(field)
+            if value in (None, ""):
+                continue
+            if field == "seed":
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Seed inválida: {value}")
+            clauses.append(f"{field} = ?")
+            params.append(value)
+
+        date_from = filters.get("date_from")
+        if date_from:
+            clauses.append("timestamp >= ?")
+            params.append(date_from)
+
+        date_to = filters.get("date_to")
+        if date_to:
+            # Una fecha sin hora incluye el día completo
+            if len(date_to) == 10:
+                date_to = f"{date_to}T23:59:59.999999"
+            clauses.append("timestamp <= ?")
+            params.append(date_to)
+
+        return clauses, params
+
+    def query(self, limit=DEFAULT_PAGE_SIZE, cursor=None, order="desc", filters=None):
+        """
+        Devuelve una página del historial ordenada por timestamp.
+        Retorna (entradas, siguiente_cursor); el cursor es None en la última página.
+        limit=None devuelve todas las entradas que cumplan los filtros.
+        """
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Orden inválido: {order}")
+
+        clauses, params = self._filter_clauses(filters or {})
+
+        if cursor:
+            cursor_timestamp, cursor_id = decode_cursor(cursor)
+            comparison = "<" if order == "desc" else ">"
+            clauses.append(f"(timestamp, id) {comparison} (?, ?)")
+            params.extend([cursor_timestamp, cursor_id])
+
+        sql = f"SELECT id, {', '.join(ENTRY_FIELDS)} FROM history"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        direction = order.upper()
+        sql += f" ORDER BY timestamp {direction}, id {direction}"
+
+        if limit is not None:
+            limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+            # Se pide una fila extra para saber si hay más páginas
+            sql += " LIMIT ?"
+            params.append(limit + 1)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["timestamp"], rows[-1]["id"])
+
+        entries = []
+        for row in rows:
+            entry = dict(row)
+            entry.pop("id")
+            entries.append(entry)
+        return entries, next_cursor
+
+    def count(self):
+        """Número de entradas del historial"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def search(self, text, limit=DEFAULT_PAGE_SIZE, offset=0, field=None):
+        """
+        Busca en los prompts guardados ordenando por relevancia (BM25).
+        Retorna (entradas, siguiente_offset); el offset es None en la última página.
+        """
+        match = build_match_query(text, field)
+        if not match:
+            return [], None
+
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        offset = max(0, int(offset))
+        columns = ", ".join(f"h.{field_name}" for field_name in ENTRY_FIELDS)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM history_fts "
+                f"JOIN history h ON h.id = history_fts.rowid "
+                f"WHERE history_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?",
+                (match, limit + 1, offset)
+            ).fetchall()
+
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_offset = offset + limit
+        return [dict(row) for row in rows], next_offset
+
+    def snapshot(self):
+        """Vista de solo lectura del historial fijada en este momento (ver HistorySnapshot)"""
+        return HistorySnapshot(self.db_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class HistorySnapshot:
+    """
+    Lectura del historial sobre una conexión propia dentro de una transacción de lectura:
+    en modo WAL todas las consultas ven el índice tal como estaba al abrirla, aunque se
+    guarden o borren registros mientras tanto. Pensada para recorridos largos, como una
+    exportación, que leen las filas de una en una sin cargar el historial en memoria.
+    """
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        try:
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self._conn.execute("BEGIN")
+            # La instantánea se fija con la primera lectura de la transacción
+            self._conn.execute("SELECT COUNT(*) FROM history").fetchone()
+        except Exception:
+            self._conn.close()
+            raise
+
+    def _where(self, filters):
+        clauses, params = HistoryStore._filter_clauses(filters or {})
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def iter_entries(self, filters=None):
+        """Recorre las entradas que cumplen los filtros (con su registro empaquetado) por timestamp"""
+        where, params = self._where(filters)
+        yield from (dict(row) for row in self._conn.execute(
+            f"SELECT {', '.join(ENTRY_FIELDS)}, record FROM history{where} ORDER BY timestamp, id", params
+        ))
+
+    def iter_image_files(self, filters=None):
+        """Recorre, sin repetir, los archivos de imagen de las entradas que cumplen los filtros"""
+        where, params = self._where(filters)
+        yield from (row[0] for row in self._conn.execute(
+            f"SELECT DISTINCT COALESCE(image_file, filename) FROM history{where} ORDER BY 1", params
+        ))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -3,31 +3,129 @@ Image Metadata Saver - Extension for Automatic1111 WebUI
 Permite guardar imágenes junto con sus metadatos en formato JSON y visualizar un historial de imágenes guardadas.
 """
 
+import time
+
+# Inicio de la importación de la extensión (se mide para el registro de arranque)
+_IMPORT_START = time.perf_counter()
+
 import os
 import json
+import html
+import sqlite3
+import hashlib
 import datetime
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import gradio as gr
 from modules import script_callbacks, shared, ui_components
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img
 from modules.images import save_image
 from PIL import Image
 import base64
-from io import BytesIO
+
+from scripts.history_store import history_entry
+from scripts.recovery import LazyHistoryStore
+from scripts.save_queue import SaveQueue
+from scripts.thumbnails import ThumbnailCache
+from scripts.metadata_cache import MetadataCache
+from scripts.metrics import METRICS
+from scripts.fileio import WriterLock, atomic_write_json, discard, replace_file, temp_path_for
+from scripts.auto_save import AutoSaver
+from scripts.retention import RetentionSweeper
+from scripts.similarity import DEFAULT_MAX_DISTANCE, SimilarityIndex, backfill_hashes, image_phash
+from scripts.encoders import DEFAULT_PROFILE, ENCODER_PROFILES, available_profiles, get_profile, encode_image, encode_to_bytes
+from scripts.extension_config import load_section, save_section
+from scripts.infotext import parse_infotext, infotext_parameters
+from scripts.records import compact_parameters, compact_image_info, compact_record
+from scripts.layout import (
+    SAVED_IMAGES_DIR,
+    METADATA_DIR,
+    THUMBNAILS_DIR,
+    HISTORY_FILE,
+    HISTORY_DB_FILE,
+    WRITE_LOCK_FILE,
+    LAYOUT_KEY,
+    LAYOUT_VERSION,
+    blob_file_for,
+    metadata_file_for,
+    resolve_image_path,
+    resolve_metadata_path
+)
 
 # Configuración de la extensión
 EXTENSION_NAME = "Image Metadata Saver"
-SAVED_IMAGES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "saved_images")
-METADATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "metadata")
-HISTORY_FILE = os.path.join(METADATA_DIR, "history.json")
 
-# Asegurarse de que los directorios existan
-os.makedirs(SAVED_IMAGES_DIR, exist_ok=True)
-os.makedirs(METADATA_DIR, exist_ok=True)
+# Ver scripts/layout.py para la organización de los directorios
+
+# Número de tarjetas que se renderizan por página en la galería de guardados
+HISTORY_PAGE_SIZE = 48
+
+# Número máximo de tarjetas HTML que se mantienen en caché
+CARD_CACHE_SIZE = 5000
+
+# Hilos para codificar imágenes en paralelo en los guardados por lotes
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)
+
+# Sección de config.json con el perfil de codificación elegido
+ENCODER_CONFIG_SECTION = "encoder"
+
+def prepare_storage(store):
+    """Crea los directorios y comprueba el formato de los archivos al abrir el índice"""
+    os.makedirs(SAVED_IMAGES_DIR, exist_ok=True)
+    os.makedirs(METADATA_DIR, exist_ok=True)
+    
+    # Las instalaciones con directorios planos siguen funcionando, pero conviene migrarlas
+    if store.get_meta(LAYOUT_KEY) != LAYOUT_VERSION and store.count():
+        print("[Image Metadata Saver] Los archivos guardados usan el formato de directorios antiguo; "
+              "ejecuta 'python scripts/layout.py' para repartirlos en subdirectorios")
+    elif not store.count():
+        store.set_meta(LAYOUT_KEY, LAYOUT_VERSION)
+
+# Historial respaldado por SQLite (migra history.json la primera vez y se reconstruye si está corrupto).
+# Se abre la primera vez que se usa, no al importar la extensión
+HISTORY_STORE = LazyHistoryStore(HISTORY_DB_FILE, legacy_file=HISTORY_FILE, metadata_dir=METADATA_DIR, on_open=prepare_storage)
+
+# Bloqueo de escritura compartido con los scripts de mantenimiento (layout.py, recovery.py)
+WRITE_LOCK = WriterLock(WRITE_LOCK_FILE)
+
+# Cola de guardado en segundo plano (un único hilo escritor)
+SAVE_QUEUE = SaveQueue()
+
+# Cola aparte para las importaciones de carpetas, que pueden tardar minutos
+IMPORT_QUEUE = SaveQueue(max_pending=4)
+
+# Cola para los borrados masivos y los barridos de retención lanzados a mano
+MAINTENANCE_QUEUE = SaveQueue(max_pending=4)
+
+# Medidores que se leen al exportar las métricas
+METRICS.register_gauge("save_queue_depth", SAVE_QUEUE.pending, "Guardados pendientes en la cola")
+METRICS.register_gauge("import_queue_depth", IMPORT_QUEUE.pending, "Importaciones pendientes en la cola")
+METRICS.register_gauge("maintenance_queue_depth", MAINTENANCE_QUEUE.pending, "Borrados masivos pendientes en la cola")
+METRICS.register_gauge("history_records", lambda: HISTORY_STORE.count(), "Registros en el historial")
+
+# Miniaturas para la galería de guardados
+THUMBNAIL_CACHE = ThumbnailCache(THUMBNAILS_DIR)
+
+# Registros de metadatos ya leídos (el endpoint de metadatos no reabre los JSON)
+METADATA_CACHE = MetadataCache()
+
+# Hashes perceptuales para buscar imágenes parecidas (se cargan en la primera búsqueda)
+SIMILARITY_INDEX = SimilarityIndex(HISTORY_STORE)
 
-# Inicializar el historial si no existe
-if not os.path.exists(HISTORY_FILE):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump([], f)
+# Caché de fragmentos HTML por tarjeta (las entradas del historial no cambian tras guardarse)
+_card_cache = OrderedDict()
+_card_cache_lock = threading.Lock()
+
+# Pool compartido para codificar imágenes en paralelo (Pillow libera el GIL al comprimir)
+ENCODE_POOL = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="image-metadata-saver-encode")
+
+# Perfil de codificación de las imágenes guardadas
+ENCODER_CONFIG = load_section(ENCODER_CONFIG_SECTION, {"profile": DEFAULT_PROFILE})
+
+# Intentos de registrar un guardado si otro escritor se adelanta con el mismo nombre
+RECORD_ATTEMPTS = 3
 
 def extract_metadata(image, p=None):
     """Extrae los metadatos de la imagen generada y el procesamiento"""
@@ -36,11 +134,12 @@ def extract_metadata(image, p=None):
         "filename": "",  # Se establecerá después de guardar
         "parameters": {}
     }
+    infotext = None
     
     # Extraer parámetros de generación si están disponibles
     if p:
         if isinstance(p, (StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img)):
-            metadata["parameters"] = {
+            metadata["parameters"] = compact_parameters({
                 "prompt": p.prompt,
                 "negative_prompt": p.negative_prompt,
                 "steps": p.steps,
@@ -52,137 +151,596 @@ def extract_metadata(image, p=None):
                 "model_hash": shared.sd_model.sd_model_hash if hasattr(shared, "sd_model") and shared.sd_model else "unknown",
                 "batch_size": p.batch_size if hasattr(p, "batch_size") else 1,
                 "type": "txt2img" if isinstance(p, StableDiffusionProcessingTxt2Img) else "img2img"
-            }
+            })
+        elif isinstance(p, str):
+            # La WebUI guarda la información de generación como infotext
+            infotext = p
         else:
-            # Intenta extraer información desde otros tipos de procesamiento o imágenes
+            # Otros tipos de procesamiento: solo los atributos del esquema, nunca p.__dict__ entero
             try:
-                metadata["parameters"] = p.__dict__
-            except:
+                metadata["parameters"] = compact_parameters(vars(p))
+            except TypeError:
                 pass
     
-    # Intenta extraer metadatos de la imagen
+    # Intenta extraer metadatos de la imagen (solo textos cortos, sin bloques binarios)
     if hasattr(image, "info") and image.info:
-        metadata["image_info"] = image.info
+        omitted = []
+        image_info = compact_image_info(image.info, omitted)
+        if image_info:
+            metadata["image_info"] = image_info
+        if omitted:
+            metadata["omitted"] = omitted
     
     # Intenta extraer metadatos desde los parámetros de generación en la imagen
+    if not infotext:
+        try:
+            infotext = image.info.get("parameters", "")
+        except AttributeError:
+            infotext = None
+    
+    if infotext:
+        parsed = parse_infotext(infotext)
+        metadata["infotext"] = infotext
+        metadata["parsed_parameters"] = parsed
+        # Completar los campos estructurados que no aporta el objeto de procesamiento
+        for field, value in infotext_parameters(parsed).items():
+            metadata["parameters"].setdefault(field, value)
+    
+    return compact_record(metadata)
+
+def set_encoder_profile(profile_name):
+    """Cambia y persiste el perfil de codificación de las imágenes guardadas"""
+    profile_name, _ = get_profile(profile_name)
+    ENCODER_CONFIG["profile"] = profile_name
+    save_section(ENCODER_CONFIG_SECTION, dict(ENCODER_CONFIG))
+    return profile_name
+
+def reserve_filename(base, extension=".png", taken=()):
+    """
+    Devuelve un nombre de registro libre: añade un sufijo si otro registro usa ya ese nombre
+    sin extensión (el JSON y la miniatura solo dependen de él) o si está en `taken`.
+    Debe llamarse con WRITE_LOCK adquirido, en la misma sección que registra el guardado.
+    """
+    stem = base
+    counter = 1
+    while stem in taken or HISTORY_STORE.get_by_stem(stem) is not None:
+        stem = f"{base}_{counter}"
+        counter += 1
+    return f"{stem}{extension}"
+
+def image_digest(image):
+    """Hash del contenido en píxeles de la imagen (independiente de la codificación)"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode("ascii"))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def encode_image_blob(image, profile_name=DEFAULT_PROFILE, parameters=None):
+    """
+    Codifica la imagen en un archivo temporal junto a su ruta por contenido.
+    Devuelve (hash, ruta relativa, temporal); el temporal es None si la imagen ya existía.
+    Se ejecuta sin bloqueo: la imagen se coloca después con commit_image_blob.
+    """
+    _, profile = get_profile(profile_name)
+    image_hash = image_digest(image)
+    image_file = blob_file_for(image_hash, profile["extension"])
+    image_path = os.path.join(SAVED_IMAGES_DIR, image_file)
+    
+    tmp_path = None
+    if not os.path.exists(image_path):
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        tmp_path = temp_path_for(image_path)
+        try:
+            with METRICS.span("save.encode"):
+                encode_image(image, tmp_path, profile_name, parameters)
+        except BaseException:
+            discard(tmp_path)
+            raise
+        METRICS.increment("bytes_written", os.path.getsize(tmp_path), kind="image")
+    
+    return image_hash, image_file, tmp_path
+
+def commit_image_blob(image, image_file, tmp_path, profile_name=DEFAULT_PROFILE, parameters=None):
+    """
+    Coloca la imagen codificada en su ruta definitiva. Debe llamarse con WRITE_LOCK
+    adquirido, justo antes de registrarla, para que un borrado concurrente no elimine
+    una imagen que se está volviendo a guardar.
+    Devuelve True si ha colocado la imagen y False si ya existía.
+    """
+    image_path = os.path.join(SAVED_IMAGES_DIR, image_file)
+    if os.path.exists(image_path):
+        if tmp_path:
+            discard(tmp_path)
+        return False
+    
+    if tmp_path is None:
+        # La imagen existía al codificar, pero se ha borrado desde entonces
+        os.makedirs(os.path.dirname(image_path), exist_ok=True)
+        tmp_path = temp_path_for(image_path)
+        try:
+            encode_image(image, tmp_path, profile_name, parameters)
+        except BaseException:
+            discard(tmp_path)
+            raise
+    replace_file(tmp_path, image_path)
+    return True
+
+def write_image_files(image, metadata=None, p=None):
+    """
+    Codifica la imagen y prepara sus metadatos sin tocar el historial. El nombre del registro
+    se elige después, con WRITE_LOCK adquirido (ver record_saves).
+    Devuelve (ruta de imagen, metadatos, nombre base, extensión, función que coloca la imagen
+    y devuelve True si no existía).
+    """
+    if metadata is None:
+        with METRICS.span("save.extract_metadata"):
+            metadata = extract_metadata(image, p)
+    
+    profile_name, profile = get_profile(ENCODER_CONFIG["profile"])
+    extension = profile["extension"]
+    
+    # Nombre base del registro (record_saves le añade un sufijo si ya está en uso)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    base = f"image_{timestamp}_{metadata['parameters'].get('seed', 'unknown')}"
+    
+    tmp_path = None
     try:
-        parameters = image.info.get("parameters", "")
-        if parameters:
-            # Aquí podrías parsear los parámetros de texto a un diccionario estructurado
-            metadata["parsed_parameters"] = parameters
-    except:
-        pass
+        # Codificar la imagen (almacenamiento por contenido: las repetidas no se recodifican)
+        parameters = image.info.get("parameters") if hasattr(image, "info") else None
+        image_hash, image_file, tmp_path = encode_image_blob(image, profile_name, parameters)
+        image_path = os.path.join(SAVED_IMAGES_DIR, image_file)
+        
+        # Hash perceptual para la búsqueda de imágenes parecidas
+        with METRICS.span("save.phash"):
+            metadata["phash"] = image_phash(image)
         
-    return metadata
+        metadata["image_path"] = image_path
+        metadata["image_file"] = image_file
+        metadata["image_hash"] = image_hash
+        try:
+            metadata["image_size"] = os.path.getsize(tmp_path or image_path)
+        except OSError:
+            # La imagen que ya existía se ha borrado desde entonces (commit la vuelve a codificar);
+            # el barrido de retención completa los tamaños desconocidos
+            metadata["image_size"] = None
+    except Exception:
+        if tmp_path:
+            discard(tmp_path)
+        raise
+    
+    def commit():
+        return commit_image_blob(image, image_file, tmp_path, profile_name, parameters)
+    
+    return image_path, metadata, base, extension, commit
+
+def record_saves(saves):
+    """
+    Elige el nombre definitivo de varios guardados, escribe sus JSON y los registra en el
+    historial en una única transacción. `saves` es una lista de (metadatos, nombre base,
+    extensión). Debe llamarse con WRITE_LOCK adquirido: el bloqueo vale también entre
+    procesos, así que nadie registra el mismo nombre entre la comprobación y la inserción.
+    Devuelve los registros guardados, en el mismo orden.
+    """
+    for attempt in range(RECORD_ATTEMPTS):
+        records, taken = [], set()
+        for metadata, base, extension in saves:
+            filename = reserve_filename(base, extension, taken)
+            taken.add(os.path.splitext(filename)[0])
+            record = dict(metadata, filename=filename, metadata_file=metadata_file_for(filename, metadata["timestamp"]))
+            records.append(compact_record(record))
+        
+        # Guardar metadatos como JSON (repartidos en subdirectorios por fecha) antes de registrarlos
+        json_paths = []
+        try:
+            for record in records:
+                json_path = os.path.join(METADATA_DIR, record["metadata_file"])
+                with METRICS.span("save.json_write"):
+                    METRICS.increment("bytes_written", atomic_write_json(json_path, record), kind="metadata")
+                json_paths.append(json_path)
+            HISTORY_STORE.append_many([history_entry(record) for record in records])
+            return records
+        except sqlite3.IntegrityError:
+            # Otro escritor registró el mismo nombre sin el bloqueo: se elige otro sufijo
+            for json_path in json_paths:
+                discard(json_path)
+            if attempt == RECORD_ATTEMPTS - 1:
+                raise
+        except Exception:
+            for json_path in json_paths:
+                discard(json_path)
+            raise
+
+def write_thumbnail(image, record):
+    """Genera la miniatura de un registro mientras la imagen está en memoria"""
+    try:
+        with METRICS.span("save.thumbnail"):
+            THUMBNAIL_CACHE.get(record["image_path"], record["filename"], image=image)
+    except Exception as e:
+        print(f"[Image Metadata Saver] No se pudo generar la miniatura de {record['filename']}: {e}")
+
+def discard_unsaved(saves):
+    """
+    Deshace guardados que no han llegado al historial: borra las imágenes colocadas para
+    ellos que no usa ningún registro. `saves` es una lista de (metadatos, imagen colocada).
+    Debe llamarse con WRITE_LOCK adquirido.
+    """
+    for metadata, placed in saves:
+        if not placed:
+            continue
+        try:
+            referenced = HISTORY_STORE.blob_referenced(metadata["image_file"])
+        except Exception:
+            # Índice inaccesible: la imagen se queda y la recoge el barrido de retención
+            continue
+        if not referenced:
+            discard(os.path.join(SAVED_IMAGES_DIR, metadata["image_file"]))
 
 def save_image_with_metadata(image, metadata=None, p=None):
     """Guarda la imagen y sus metadatos"""
-    if metadata is None:
-        metadata = extract_metadata(image, p)
+    with METRICS.span("save.total"):
+        try:
+            image_path, metadata, base, extension, commit = write_image_files(image, metadata=metadata, p=p)
+        except Exception:
+            METRICS.increment("saves", status="error")
+            raise
+        
+        # Colocar la imagen, elegir el nombre y actualizar el historial como una única operación
+        try:
+            wait_start = time.perf_counter()
+            with WRITE_LOCK:
+                METRICS.observe("save.lock_wait", time.perf_counter() - wait_start)
+                with METRICS.span("save.history_update"):
+                    placed = False
+                    try:
+                        placed = commit()
+                        record = record_saves([(metadata, base, extension)])[0]
+                    except Exception:
+                        discard_unsaved([(metadata, placed)])
+                        raise
+        except Exception:
+            METRICS.increment("saves", status="error")
+            raise
+        
+        write_thumbnail(image, record)
     
-    # Generar nombre de archivo único
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"image_{timestamp}_{metadata['parameters'].get('seed', 'unknown')}"
+    METRICS.increment("saves", status="ok")
+    return image_path, os.path.join(METADATA_DIR, record["metadata_file"])
+
+def save_images_with_metadata(items):
+    """
+    Guarda varias imágenes a la vez: codifica en paralelo y registra todas en el historial
+    en una única transacción. `items` es una lista de tuplas (imagen, p).
+    Devuelve un resultado por imagen, en el mismo orden.
+    """
+    batch_start = time.perf_counter()
+    results = [None] * len(items)
+    written = []
     
-    # Guardar la imagen
-    image_path = os.path.join(SAVED_IMAGES_DIR, f"{filename}.png")
-    image.save(image_path)
+    futures = [ENCODE_POOL.submit(write_image_files, image, p=p) for image, p in items]
+    for i, future in enumerate(futures):
+        try:
+            image_path, metadata, base, extension, commit = future.result()
+            written.append((i, metadata, base, extension, commit))
+        except Exception as e:
+            results[i] = {"success": False, "error": str(e)}
     
-    # Actualizar metadatos con el nombre de archivo
-    metadata["filename"] = f"{filename}.png"
-    metadata["image_path"] = image_path
+    # Colocar las imágenes y registrarlas en el historial de una vez
+    committed, records = [], []
+    wait_start = time.perf_counter()
+    with WRITE_LOCK:
+        METRICS.observe("save.lock_wait", time.perf_counter() - wait_start)
+        with METRICS.span("save.history_update"):
+            for i, metadata, base, extension, commit in written:
+                try:
+                    committed.append((i, metadata, base, extension, commit()))
+                except Exception as e:
+                    results[i] = {"success": False, "error": str(e)}
+            try:
+                records = record_saves([(metadata, base, extension) for _, metadata, base, extension, _ in committed])
+            except Exception as e:
+                # Ningún registro del lote ha llegado al historial
+                discard_unsaved([(metadata, placed) for _, metadata, _, _, placed in committed])
+                for i, *_ in committed:
+                    results[i] = {"success": False, "error": str(e)}
+                committed = []
     
-    # Guardar metadatos como JSON
-    json_path = os.path.join(METADATA_DIR, f"{filename}.json")
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=2, ensure_ascii=False)
+    # Miniaturas en paralelo, ya con el nombre definitivo de cada registro
+    thumbnails = []
+    for (i, *_), record in zip(committed, records):
+        results[i] = {
+            "success": True,
+            "image_path": record["image_path"],
+            "metadata_path": os.path.join(METADATA_DIR, record["metadata_file"])
+        }
+        thumbnails.append(ENCODE_POOL.submit(write_thumbnail, items[i][0], record))
+    for future in thumbnails:
+        future.result()
     
-    # Actualizar el historial
-    update_history(metadata)
+    METRICS.increment("saves", len(records), status="ok")
+    METRICS.increment("saves", len(items) - len(records), status="error")
+    METRICS.observe("save.batch_total", time.perf_counter() - batch_start)
+    return results
+
+def delete_saved_images(filenames):
+    """
+    Elimina varios registros en una única transacción del índice, junto con sus JSON y las
+    imágenes que ya no usa ningún otro registro. Devuelve el número de registros eliminados.
+    """
+    with WRITE_LOCK:
+        entries, orphaned_files = HISTORY_STORE.delete_many(filenames)
+        
+        # Eliminar archivos si existen (la imagen solo si ningún otro registro la usa)
+        for image_file in orphaned_files:
+            image_path = os.path.join(SAVED_IMAGES_DIR, image_file)
+            if os.path.exists(image_path):
+                os.remove(image_path)
+        
+        json_paths = [resolve_metadata_path(entry) for entry in entries]
+        for json_path in json_paths:
+            if os.path.exists(json_path):
+                os.remove(json_path)
     
-    return image_path, json_path
+    # Actualizar cachés de la galería y de metadatos
+    for entry, json_path in zip(entries, json_paths):
+        THUMBNAIL_CACHE.invalidate(entry["filename"])
+        METADATA_CACHE.invalidate(json_path)
+    forget_history_cards({entry["filename"] for entry in entries})
+    SIMILARITY_INDEX.discard([entry["filename"] for entry in entries])
+    METRICS.increment("deletes", len(entries))
+    return len(entries)
 
-def update_history(metadata):
-    """Actualiza el archivo de historial con los nuevos metadatos"""
-    history = []
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            history = json.load(f)
-    except:
-        history = []
-    
-    # Añadir nuevos metadatos al historial
-    history.append({
-        "timestamp": metadata["timestamp"],
-        "filename": metadata["filename"],
-        "preview": metadata.get("parameters", {}).get("prompt", "")[:100] + "..." if len(metadata.get("parameters", {}).get("prompt", "")) > 100 else metadata.get("parameters", {}).get("prompt", ""),
-        "metadata_file": os.path.join(METADATA_DIR, f"{metadata['filename'].split('.')[0]}.json")
-    })
-    
-    # Guardar historial actualizado
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, indent=2, ensure_ascii=False)
+def delete_saved_image(filename):
+    """
+    Elimina un registro, su JSON y su imagen si ya no la usa ningún otro registro.
+    Devuelve True si el registro existía.
+    """
+    if delete_saved_images([filename]):
+        return True
+    
+    # Sin registro: archivos sueltos de versiones anteriores con ese nombre
+    json_path = resolve_metadata_path({"filename": filename})
+    with WRITE_LOCK:
+        for path in (os.path.join(SAVED_IMAGES_DIR, filename), json_path):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    THUMBNAIL_CACHE.invalidate(filename)
+    METADATA_CACHE.invalidate(json_path)
+    forget_history_cards({filename})
+    return False
+
+def bulk_delete(filenames=None, filters=None, keep_starred=True, batch_size=500):
+    """
+    Borra por bloques los registros de una lista de nombres o los que cumplen los filtros del
+    historial (con keep_starred se conservan los favoritos). Devuelve un resumen.
+    """
+    start = time.perf_counter()
+    deleted = 0
+    if filenames is not None:
+        for i in range(0, len(filenames), batch_size):
+            deleted += delete_saved_images(filenames[i:i + batch_size])
+    else:
+        while True:
+            batch = HISTORY_STORE.retention_candidates(limit=batch_size, keep_starred=keep_starred, filters=filters)
+            if not batch:
+                break
+            deleted += delete_saved_images([entry["filename"] for entry in batch])
+    
+    elapsed = time.perf_counter() - start
+    return {"deleted": deleted, "seconds": round(elapsed, 3), "deleted_per_s": round(deleted / elapsed, 1) if elapsed > 0 else None}
+
+def set_starred(filenames, starred=True):
+    """Marca o desmarca registros como favoritos (en el índice y en su JSON); devuelve los que existían"""
+    with WRITE_LOCK:
+        changed = HISTORY_STORE.set_starred(filenames, starred)
+        json_paths = []
+        for filename in changed:
+            json_path = resolve_metadata_path(HISTORY_STORE.get(filename))
+            json_paths.append(json_path)
+            # El JSON es la fuente de verdad: la marca se conserva si se reconstruye el índice
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    metadata = json.load(f)
+            except (OSError, ValueError):
+                continue
+            metadata["starred"] = bool(starred)
+            atomic_write_json(json_path, metadata)
+    
+    for json_path in json_paths:
+        METADATA_CACHE.invalidate(json_path)
+    forget_history_cards(set(changed))
+    return changed
+
+def find_similar(filename, max_distance=DEFAULT_MAX_DISTANCE, limit=HISTORY_PAGE_SIZE):
+    """Entradas con una imagen parecida a la de `filename`: [(entrada, distancia)]"""
+    with METRICS.span("similar.query"):
+        return SIMILARITY_INDEX.similar(filename, max_distance=max_distance, limit=limit)
+
+def queue_hash_backfill():
+    """Encola el cálculo de los hashes perceptuales que faltan y devuelve el id del trabajo"""
+    # Hilos en lugar de procesos: no se hace fork del proceso de la WebUI
+    return MAINTENANCE_QUEUE.submit(backfill_hashes, HISTORY_STORE, workers=ENCODE_WORKERS, use_processes=False)
+
+def queue_save(image, metadata=None, p=None):
+    """Encola el guardado de la imagen y devuelve el id del trabajo (lanza QueueFullError si la cola está llena)"""
+    def job():
+        image_path, json_path = save_image_with_metadata(image, metadata=metadata, p=p)
+        return {"image_path": image_path, "metadata_path": json_path}
+    
+    return SAVE_QUEUE.submit(job)
+
+def queue_save_batch(items):
+    """Encola el guardado de varias imágenes como un único trabajo y devuelve su id"""
+    return SAVE_QUEUE.submit(save_images_with_metadata, items)
+
+def queue_bulk_delete(filenames=None, filters=None, keep_starred=True):
+    """Encola un borrado masivo y devuelve el id del trabajo"""
+    return MAINTENANCE_QUEUE.submit(bulk_delete, filenames=filenames, filters=filters, keep_starred=keep_starred)
+
+def queue_import(roots, hashes=True):
+    """
+    Encola la importación de carpetas de imágenes existentes y devuelve el id del trabajo.
+    Sin `hashes` solo se leen las cabeceras (el hash perceptual se calcula después).
+    """
+    from scripts.importer import import_directories
+    # Hilos en lugar de procesos: no se hace fork del proceso de la WebUI
+    return IMPORT_QUEUE.submit(import_directories, HISTORY_STORE, roots, use_processes=False, hashes=hashes)
+
+def queue_archive_import(path):
+    """Encola la importación de un archivo tar/zip exportado y devuelve el id del trabajo"""
+    from scripts.archive import import_archive
+    return IMPORT_QUEUE.submit(import_archive, HISTORY_STORE, path, WRITE_LOCK)
+
+# Guardado automático: usa la misma cola que los botones de guardado
+AUTO_SAVER = AutoSaver(extract_metadata, save_image_with_metadata, SAVE_QUEUE.submit)
+
+# Reglas de retención aplicadas por un hilo en segundo plano (arranca con la aplicación)
+RETENTION = RetentionSweeper(HISTORY_STORE, delete_saved_images, WRITE_LOCK, SAVED_IMAGES_DIR, METADATA_DIR, THUMBNAIL_CACHE)
 
 def image_to_base64(image):
     """Convierte una imagen PIL a base64 para mostrar en la interfaz"""
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    # Compresión mínima: solo se usa para mostrarla, no para guardarla
+    img_str = base64.b64encode(encode_to_bytes(image, "png_fast")).decode('utf-8')
     return f"data:image/png;base64,{img_str}"
 
 def load_history():
     """Carga el historial de imágenes guardadas"""
-    try:
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except:
-        return []
+    return HISTORY_STORE.all()
 
-def create_history_html():
-    """Crea el HTML para mostrar el historial de imágenes guardadas"""
-    history = load_history()
-    
-    if not history:
-        return "<div class='history-empty'>No hay imágenes guardadas en el historial.</div>"
-    
-    html = "<div class='history-container'>"
+def thumbnail_url(filename):
+    """URL del endpoint que sirve (y genera bajo demanda) la miniatura de una imagen"""
+    return f"/api/image_metadata_saver/thumbnail/{urllib.parse.quote(filename, safe='')}"
+
+def render_history_card(item):
+    """Renderiza la tarjeta de una entrada del historial usando la caché de fragmentos"""
+    key = (item["filename"], item["timestamp"])
+    with _card_cache_lock:
+        card = _card_cache.get(key)
+        if card is not None:
+            _card_cache.move_to_end(key)
+            return card
     
-    # Ordenar por timestamp (más reciente primero)
-    history.sort(key=lambda x: x["timestamp"], reverse=True)
+    image_path = resolve_image_path(item)
+    filename = html.escape(item["filename"], quote=True)
+    thumbnail = html.escape(thumbnail_url(item["filename"]), quote=True)
+    prompt = html.escape(item.get("preview") or "No disponible")
+    seed = html.escape(str(item["seed"]) if item.get("seed") is not None else "No disponible")
+    # Argumentos de viewImageDetails serializados como JSON y escapados para el atributo
+    # (los nombres importados pueden tener espacios, '#' o '%': se codifican como en findSimilar)
+    metadata_url = f"/api/image_metadata_saver/metadata/{urllib.parse.quote(item['filename'], safe='')}"
+    details_args = html.escape(f"{json.dumps(metadata_url)},{json.dumps('file=' + image_path)}", quote=True)
+    starred = bool(item.get("starred"))
+    star_args = html.escape(f"this,{json.dumps(item['filename'])}", quote=True)
+    similar_args = html.escape(json.dumps(item["filename"]), quote=True)
     
-    for item in history:
-        image_path = os.path.join(SAVED_IMAGES_DIR, item["filename"])
-        
-        if os.path.exists(image_path):
-            # Cargar metadatos para mostrar información detallada
-            metadata = {}
-            try:
-                with open(item["metadata_file"], "r", encoding="utf-8") as f:
-                    metadata = json.load(f)
-            except:
-                metadata = {"parameters": {"prompt": "Metadatos no disponibles"}}
-            
-            # Crear tarjeta para la imagen en el historial
-            html += f"""
+    card = f"""
             <div class='history-item'>
                 <div class='history-image'>
-                    <img src='file={image_path}' alt='{item["filename"]}'>
+                    <img src='{thumbnail}' alt='{filename}' loading='lazy'>
                 </div>
                 <div class='history-details'>
-                    <h4>{item["filename"]}</h4>
+                    <h4>{filename}</h4>
                     <p><strong>Fecha:</strong> {datetime.datetime.fromisoformat(item["timestamp"]).strftime("%d/%m/%Y %H:%M:%S")}</p>
-                    <p><strong>Prompt:</strong> {metadata.get("parameters", {}).get("prompt", "No disponible")[:100]}...</p>
-                    <p><strong>Seed:</strong> {metadata.get("parameters", {}).get("seed", "No disponible")}</p>
-                    <button class='view-details' onclick='viewImageDetails("{item["metadata_file"]}","{image_path}")'>Ver detalles</button>
+                    <p><strong>Prompt:</strong> {prompt}</p>
+                    <p><strong>Seed:</strong> {seed}</p>
+                    <button class='view-details' onclick='viewImageDetails({details_args})'>Ver detalles</button>
+                    <button class='star-toggle' data-starred='{int(starred)}' title='Los favoritos no se borran por retención' onclick='toggleStar({star_args})'>{"★ Favorito" if starred else "☆ Favorito"}</button>
+                    <button class='find-similar' title='Buscar imágenes parecidas a esta' onclick='findSimilar(this,{similar_args})'>Parecidas</button>
                 </div>
             </div>
             """
     
-    html += "</div>"
-    return html
+    with _card_cache_lock:
+        _card_cache[key] = card
+        while len(_card_cache) > CARD_CACHE_SIZE:
+            _card_cache.popitem(last=False)
+    return card
+
+def forget_history_card(filename):
+    """Elimina de la caché las tarjetas de una imagen (por ejemplo al borrarla)"""
+    forget_history_cards({filename})
+
+def forget_history_cards(filenames):
+    """Elimina de la caché las tarjetas de varias imágenes en una sola pasada"""
+    if not filenames:
+        return
+    with _card_cache_lock:
+        for key in [key for key in _card_cache if key[0] in filenames]:
+            del _card_cache[key]
+
+def render_history_page(cursor=None, search_text=""):
+    """
+    Renderiza una página de tarjetas del historial.
+    Retorna (html, siguiente_cursor); el cursor es None en la última página.
+    En las búsquedas el cursor es el offset del siguiente resultado.
+    """
+    with METRICS.span("gallery.query"):
+        if search_text and search_text.strip():
+            # Resultados ordenados por relevancia desde el índice de texto completo
+            items, next_offset = HISTORY_STORE.search(search_text, limit=HISTORY_PAGE_SIZE, offset=int(cursor or 0))
+            next_cursor = str(next_offset) if next_offset is not None else None
+        else:
+            # El índice por timestamp devuelve las entradas ya ordenadas (más reciente primero)
+            items, next_cursor = HISTORY_STORE.query(limit=HISTORY_PAGE_SIZE, cursor=cursor, order="desc")
+    
+    with METRICS.span("gallery.render_cards"):
+        return "".join(render_history_card(item) for item in items), next_cursor
+
+def history_sentinel_html(next_cursor, search_text=""):
+    """Marcador al final de la galería que el JavaScript usa para cargar la siguiente página"""
+    if next_cursor is None:
+        return ""
+    return (
+        f"<div class='history-sentinel' data-cursor='{html.escape(next_cursor, quote=True)}' "
+        f"data-search='{html.escape(search_text or '', quote=True)}'></div>"
+    )
+
+def history_empty_html(search_text=""):
+    """Mensaje de la galería cuando no hay entradas (o la búsqueda no encuentra nada)"""
+    if search_text and search_text.strip():
+        return "<div class='history-empty'>No se encontraron imágenes para esa búsqueda.</div>"
+    return "<div class='history-empty'>No hay imágenes guardadas en el historial.</div>"
+
+def similar_history_html(filename, results):
+    """Galería con las imágenes parecidas a `filename`, de la más a la menos parecida"""
+    header = (
+        f"<div class='history-similar-header'>{len(results)} imágenes parecidas a "
+        f"<strong>{html.escape(filename)}</strong>. Pulsa \"Refrescar historial\" para volver.</div>"
+    )
+    if not results:
+        return header
+    cards = "".join(render_history_card(entry) for entry, _ in results)
+    return f"{header}<div class='history-container'>{cards}</div>"
+
+def history_shell_html():
+    """
+    Galería vacía con un marcador sin cursor: el JavaScript pide la primera página cuando
+    se abre la pestaña, de modo que crear la interfaz no consulta el historial
+    """
+    return "<div class='history-container'><div class='history-sentinel' data-cursor='' data-search=''></div></div>"
+
+def create_history_html(search_text=""):
+    """Crea el HTML de la primera página del historial (o de los resultados de una búsqueda)"""
+    with METRICS.span("gallery.create_history_html"):
+        cards, next_cursor = render_history_page(search_text=search_text)
+    
+    if not cards:
+        return history_empty_html(search_text)
+    
+    # El resto de páginas se cargan al hacer scroll (ver javascript/script.js)
+    return f"<div class='history-container'>{cards}{history_sentinel_html(next_cursor, search_text)}</div>"
 
 def on_ui():
     """Función principal para crear la interfaz de usuario de la extensión"""
+    start = time.perf_counter()
+    tabs = build_ui()
+    elapsed = time.perf_counter() - start
+    METRICS.observe("startup.on_ui", elapsed)
+    print(f"[Image Metadata Saver] Interfaz creada en {elapsed * 1000:.0f} ms")
+    return tabs
+
+def build_ui():
+    """Crea las pestañas de la extensión sin leer el historial (se carga desde el navegador)"""
     with gr.Blocks(analytics_enabled=False) as ui:
         with gr.Tab("Guardados"):
             gr.HTML("""
@@ -219,6 +777,29 @@ def on_ui():
                 .view-details:hover {
                     background-color: #3a5ce5;
                 }
+                .star-toggle {
+                    background: none;
+                    border: 1px solid #f5b301;
+                    color: #f5b301;
+                    padding: 4px 8px;
+                    border-radius: 4px;
+                    cursor: pointer;
+                    margin-top: 10px;
+                    margin-left: 6px;
+                }
+                .find-similar {
+                    background: none;
+                    border: 1px solid #4a6cf7;
+                    color: #4a6cf7;
+                    padding: 4px 8px;
+                    border-radius: 4px;
+                    cursor: pointer;
+                    margin-top: 10px;
+                    margin-left: 6px;
+                }
+                .history-similar-header {
+                    padding: 10px 0;
+                }
                 .history-empty {
                     padding: 20px;
                     text-align: center;
@@ -238,15 +819,31 @@ def on_ui():
             </script>
             """)
             
-            # Botón para refrescar el historial
-            refresh_btn = gr.Button("Refrescar historial")
+            with gr.Row():
+                # Caja de búsqueda por prompt / negative prompt
+                search_box = gr.Textbox(
+                    label="Buscar por prompt",
+                    placeholder="Escribe palabras del prompt y pulsa Enter",
+                    lines=1
+                )
+                
+                # Botón para refrescar el historial
+                refresh_btn = gr.Button("Refrescar historial")
             
-            # Panel para mostrar el historial
-            history_panel = gr.HTML(create_history_html())
+            # Panel para mostrar el historial (la primera página se pide al abrir la pestaña)
+            history_panel = gr.HTML(history_shell_html())
             
-            # Refrescar el historial cuando se haga clic en el botón
+            # Buscar al pulsar Enter en la caja de búsqueda
+            search_box.submit(
+                fn=lambda text: gr.update(value=create_history_html(text)),
+                inputs=[search_box],
+                outputs=history_panel
+            )
+            
+            # Refrescar el historial cuando se haga clic en el botón (manteniendo la búsqueda)
             refresh_btn.click(
-                fn=lambda: gr.update(value=create_history_html()),
+                fn=lambda text: gr.update(value=create_history_html(text)),
+                inputs=[search_box],
                 outputs=history_panel
             )
         
@@ -270,19 +867,154 @@ def on_ui():
                 interactive=False
             )
             
-            # Opciones adicionales que podrías implementar
+            # Guardado automático de las imágenes generadas
+            auto_save_config = AUTO_SAVER.stats()["config"]
             auto_save = gr.Checkbox(
                 label="Guardar automáticamente todas las imágenes generadas",
-                value=False
+                value=auto_save_config["enabled"]
             )
             
-            # Esta función se implementaría para aplicar la configuración
+            with gr.Row():
+                auto_save_every_nth = gr.Number(
+                    label="Guardar una de cada N imágenes",
+                    value=auto_save_config["every_nth"],
+                    precision=0
+                )
+                auto_save_max_per_minute = gr.Number(
+                    label="Máximo de imágenes por minuto (0 = sin límite)",
+                    value=auto_save_config["max_per_minute"],
+                    precision=0
+                )
+                auto_save_min_size = gr.Number(
+                    label="Lado mínimo en píxeles (0 = sin límite)",
+                    value=auto_save_config["min_size"],
+                    precision=0
+                )
+            
+            with gr.Row():
+                auto_save_types = gr.CheckboxGroup(
+                    label="Tipos de generación (ninguno = todos)",
+                    choices=["txt2img", "img2img", "other"],
+                    value=auto_save_config["types"]
+                )
+                auto_save_models = gr.Textbox(
+                    label="Modelos (separados por comas, vacío = todos)",
+                    value=", ".join(auto_save_config["models"])
+                )
+                auto_save_skip_grids = gr.Checkbox(
+                    label="Ignorar cuadrículas",
+                    value=auto_save_config["skip_grids"]
+                )
+            
+            # Perfil de codificación de las imágenes guardadas
+            encoder_profile = gr.Dropdown(
+                label="Formato de las imágenes guardadas",
+                info=", ".join(f"{name}: {ENCODER_PROFILES[name]['label']}" for name in available_profiles()),
+                choices=available_profiles(),
+                value=get_profile(ENCODER_CONFIG["profile"])[0]
+            )
+            
+            # Retención: borrado periódico de los registros antiguos o cuando se supera un tamaño
+            retention_config = dict(RETENTION.config)
+            with gr.Row():
+                retention_enabled = gr.Checkbox(
+                    label="Aplicar reglas de retención",
+                    value=retention_config["enabled"]
+                )
+                retention_keep_starred = gr.Checkbox(
+                    label="Conservar siempre los favoritos",
+                    value=retention_config["keep_starred"]
+                )
+            
+            with gr.Row():
+                retention_max_age_days = gr.Number(
+                    label="Borrar registros con más de N días (0 = sin límite)",
+                    value=retention_config["max_age_days"]
+                )
+                retention_max_total_mb = gr.Number(
+                    label="Tamaño máximo de las imágenes en MB (0 = sin límite)",
+                    value=retention_config["max_total_mb"]
+                )
+                retention_interval_minutes = gr.Number(
+                    label="Minutos entre barridos",
+                    value=retention_config["interval_minutes"]
+                )
+            
             save_config_btn = gr.Button("Guardar configuración")
+            config_status = gr.Textbox(label="Estado", value="", interactive=False)
+            
+            def apply_config(enabled, every_nth, max_per_minute, min_size, types, models, skip_grids, profile,
+                             retention_on, keep_starred, max_age_days, max_total_mb, interval_minutes):
+                set_encoder_profile(profile)
+                RETENTION.update_config(
+                    enabled=retention_on,
+                    keep_starred=keep_starred,
+                    max_age_days=max_age_days,
+                    max_total_mb=max_total_mb,
+                    interval_minutes=interval_minutes
+                )
+                AUTO_SAVER.update_config(
+                    enabled=enabled,
+                    every_nth=every_nth,
+                    max_per_minute=max_per_minute,
+                    min_size=min_size,
+                    types=types,
+                    models=[model.strip() for model in models.split(",") if model.strip()],
+                    skip_grids=skip_grids
+                )
+                return gr.update(value="Configuración guardada!")
+            
             save_config_btn.click(
-                fn=lambda x: gr.update(value="Configuración guardada!"),
-                inputs=[auto_save],
-                outputs=[gr.Textbox(value="", visible=False)]
+                fn=apply_config,
+                inputs=[
+                    auto_save,
+                    auto_save_every_nth,
+                    auto_save_max_per_minute,
+                    auto_save_min_size,
+                    auto_save_types,
+                    auto_save_models,
+                    auto_save_skip_grids,
+                    encoder_profile,
+                    retention_enabled,
+                    retention_keep_starred,
+                    retention_max_age_days,
+                    retention_max_total_mb,
+                    retention_interval_minutes
+                ],
+                outputs=[config_status]
+            )
+            
+            # Contadores del guardado automático
+            auto_save_counters = gr.JSON(label="Contadores del guardado automático", value=AUTO_SAVER.stats()["counters"])
+            refresh_counters_btn = gr.Button("Actualizar contadores")
+            refresh_counters_btn.click(
+                fn=lambda: AUTO_SAVER.stats()["counters"],
+                outputs=[auto_save_counters]
             )
+            
+            # Estado de la retención y barrido manual
+            # Se calcula al cargar la página, no al crear la interfaz
+            retention_stats = gr.JSON(label="Retención (ocupación, contadores y último barrido)", value=RETENTION.stats)
+            with gr.Row():
+                refresh_retention_btn = gr.Button("Actualizar estado")
+                sweep_btn = gr.Button("Aplicar retención ahora")
+            refresh_retention_btn.click(fn=RETENTION.stats, outputs=[retention_stats])
+            
+            def sweep_now():
+                RETENTION.sweep()
+                return RETENTION.stats()
+            
+            sweep_btn.click(fn=sweep_now, outputs=[retention_stats])
+            
+            # Hashes perceptuales de las imágenes guardadas antes de la búsqueda de parecidas
+            with gr.Row():
+                backfill_btn = gr.Button("Calcular hashes de similitud pendientes")
+                backfill_status = gr.Textbox(label="Cálculo de hashes", value="", interactive=False)
+            
+            def start_backfill():
+                return gr.update(value=f"Cálculo encolado (trabajo {queue_hash_backfill()})")
+            
+            backfill_btn.click(fn=start_backfill, outputs=[backfill_status])
     
     return [(ui, EXTENSION_NAME, EXTENSION_NAME.lower().replace(" ", "_"))]
 
@@ -309,8 +1041,19 @@ def on_app_started(demo, app):
     """Se ejecuta cuando se inicia la aplicación"""
     script_callbacks.on_ui_tabs(on_ui)
     
+    # Barridos periódicos de retención (solo borran si están activados en la configuración)
+    RETENTION.start()
+    
     # Registrar callback para agregar botones a las imágenes generadas
     # Esto dependerá de la estructura exacta de la UI de Automatic1111
     # y podría requerir ajustes adicionales
 
-script_callbacks.on_app_started(on_app_started)
\ No newline at end of file
+script_callbacks.on_app_started(on_app_started)
+
+# Guardado automático de cada imagen que produce la WebUI
+script_callbacks.on_image_saved(AUTO_SAVER.on_image_saved)
+
+# Coste de importar la extensión (el índice todavía no se ha abierto)
+_import_seconds = time.perf_counter() - _IMPORT_START
+METRICS.observe("startup.import", _import_seconds)
+print(f"[Image Metadata Saver] Extensión cargada en {_import_seconds * 1000:.0f} ms")
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""
+Importación de carpetas de imágenes existentes para la extensión Image Metadata Saver
+
+Recorre un árbol de directorios (por ejemplo, outputs/ de la WebUI), lee el infotext de
+cada imagen y su hash perceptual (a partir de una versión reducida; con --no-hashes no se
+decodifican los píxeles) y registra las imágenes en el historial sin copiarlas: los
+registros apuntan al archivo original, que nunca se borra al eliminar el registro. La
+lectura se reparte entre varios procesos y el progreso se guarda en el índice (ruta,
+mtime y tamaño), así que volver a ejecutarla solo procesa archivos nuevos o modificados.
+
+Uso:
+    python scripts/importer.py CARPETA [CARPETA...] [--workers N] [--no-hashes]
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import datetime
+
+from PIL import Image
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/importer.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.fileio import atomic_write_json
+from scripts.history_store import history_entry
+from scripts.infotext import parse_infotext, infotext_parameters
+from scripts.layout import METADATA_DIR, metadata_file_for
+from scripts.records import compact_record
+from scripts.similarity import HASH_SIZE, image_phash
+
+# Extensiones que se importan
+IMAGE_EXTENSIONS = (".png", ".webp", ".jpg", ".jpeg")
+
+# Registros que se confirman por transacción
+IMPORT_BATCH_SIZE = 500
+
+
+def iter_image_files(root):
+    """Recorre recursivamente un directorio devolviendo (ruta, mtime, tamaño) de cada imagen"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        stat = entry.stat()
+                        yield os.path.abspath(entry.path), stat.st_mtime, stat.st_size
+        except OSError as e:
+            print(f"[Image Metadata Saver] No se pudo leer {directory}: {e}")
+
+
+def record_name(path):
+    """Nombre de registro estable para un archivo importado (mismo archivo, mismo registro)"""
+    stem, extension = os.path.splitext(os.path.basename(path))
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()[:10]
+    return f"import_{stem}_{digest}{extension.lower()}"
+
+
+def read_image_record(task, metadata_dir=METADATA_DIR, hashes=True):
+    """
+    Lee la cabecera y los textos de una imagen (y, con `hashes`, su hash perceptual), escribe
+    su JSON de metadatos y devuelve (ruta, mtime, tamaño, metadatos o None, error o None).
+    Se ejecuta en los procesos del pool.
+    """
+    path, mtime, size = task
+    phash = None
+    try:
+        with Image.open(path) as image:
+            # Image.open solo lee la cabecera y los bloques de texto anteriores a los píxeles;
+            # el hash perceptual sí decodifica la imagen (JPEG a escala reducida, PNG entera)
+            info = dict(image.info)
+            width, height = image.size
+            image_format = image.format
+            if hashes:
+                # JPEG decodifica directamente a escala reducida
+                image.draft("RGB", (HASH_SIZE * 8, HASH_SIZE * 8))
+                phash = image_phash(image)
+    except Exception as e:
+        return path, mtime, size, None, str(e)
+
+    infotext = info.get("parameters") if isinstance(info.get("parameters"), str) else None
+    parsed = parse_infotext(infotext) if infotext else {}
+    parameters = infotext_parameters(parsed)
+    parameters.setdefault("size", f"{width}x{height}")
+    parameters["type"] = "import"
+
+    metadata = {
+        "timestamp": datetime.datetime.fromtimestamp(mtime).isoformat(),
+        "filename": record_name(path),
+        "parameters": parameters,
+        "image_path": path,
+        # Ruta absoluta: la imagen se queda en su carpeta original
+        "image_file": path,
+        "image_size": size,
+        "phash": phash,
+        "source": {"path": path, "mtime": mtime, "size": size, "format": image_format}
+    }
+    if infotext:
+        metadata["infotext"] = infotext
+        metadata["parsed_parameters"] = parsed
+    metadata["metadata_file"] = metadata_file_for(metadata["filename"], metadata["timestamp"])
+    metadata = compact_record(metadata)
+
+    json_path = os.path.join(metadata_dir, metadata["metadata_file"])
+    try:
+        atomic_write_json(json_path, metadata)
+    except OSError as e:
+        return path, mtime, size, None, str(e)
+
+    return path, mtime, size, metadata, None
+
+
+def import_directories(store, roots, metadata_dir=METADATA_DIR, workers=None, use_processes=True, on_progress=None, hashes=True):
+    """
+    Importa las imágenes de uno o varios directorios en el historial. Sin `hashes` no se
+    calcula el hash perceptual (lo completa después scripts/similarity.py).
+    Devuelve un resumen con contadores y el rendimiento en archivos por segundo.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from functools import partial
+
+    seen = store.imported_files()
+    summary = {"files": 0, "imported": 0, "unchanged": 0, "errors": 0}
+    entries, files = [], []
+    start = time.perf_counter()
+
+    def flush():
+        store.record_imported(entries, files)
+        entries.clear()
+        files.clear()
+        if on_progress:
+            on_progress(dict(summary))
+
+    def pending_tasks():
+        for root in roots:
+            for path, mtime, size in iter_image_files(root):
+                summary["files"] += 1
+                if seen.get(path) == (mtime, size):
+                    summary["unchanged"] += 1
+                    continue
+                yield path, mtime, size
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        for path, mtime, size, metadata, error in executor.map(partial(read_image_record, metadata_dir=metadata_dir, hashes=hashes), pending_tasks(), chunksize=32):
+            if error:
+                summary["errors"] += 1
+                files.append((path, mtime, size, None))
+            else:
+                summary["imported"] += 1
+                entries.append(history_entry(metadata))
+                files.append((path, mtime, size, metadata["filename"]))
+            if len(files) >= IMPORT_BATCH_SIZE:
+                flush()
+    flush()
+
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["files_per_s"] = round(summary["files"] / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+def main(argv=None):
+    import argparse
+    from scripts.history_store import HistoryStore
+    from scripts.layout import HISTORY_DB_FILE, HISTORY_FILE
+
+    parser = argparse.ArgumentParser(description="Importa carpetas de imágenes existentes en el historial")
+    parser.add_argument("roots", nargs="+", help="Directorios a importar")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos (por defecto, uno por CPU)")
+    parser.add_argument("--no-hashes", action="store_true", help="No calcular el hash perceptual (solo lee las cabeceras)")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(HISTORY_DB_FILE, legacy_file=HISTORY_FILE, metadata_dir=METADATA_DIR)
+    summary = import_directories(
+        store,
+        [os.path.abspath(root) for root in args.roots],
+        workers=args.workers,
+        hashes=not args.no_hashes,
+        on_progress=lambda progress: print(f"\r{progress['files']} archivos, {progress['imported']} importados", end="", flush=True)
+    )
+    print()
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
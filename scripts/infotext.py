@@ -0,0 +1,257 @@
+"""
+Parser del texto "parameters" (infotext) que Automatic1111 incrusta en las imágenes
+Convierte el texto en campos tipados (steps, sampler, CFG, seed, tamaño, modelo, LoRAs,
+hires...). Los resultados se memorizan por texto, ya que las imágenes de un mismo lote
+suelen compartirlo casi entero.
+
+Ejecutado como script rellena los campos estructurados de un directorio de metadatos
+existente usando varios procesos:
+    python scripts/infotext.py [--metadata-dir DIR] [--workers N]
+"""
+
+import os
+import re
+import sys
+import copy
+import json
+import time
+from functools import lru_cache
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/infotext.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.fileio import atomic_write_json
+from scripts.records import compact_record
+
+# Mismo patrón que usa la WebUI para los pares "Clave: valor" de la última línea
+RE_PARAM = re.compile(r'\s*(\w[\w \-/]+):\s*("(?:\\.|[^\\"])+"|[^,]*)(?:,|$)')
+RE_SIZE = re.compile(r"^(\d+)x(\d+)$")
+RE_LORA = re.compile(r"<(lora|lyco):([^:>]+)(?::([^:>]+))?[^>]*>", re.IGNORECASE)
+
+NEGATIVE_PREFIX = "Negative prompt:"
+
+# Claves del infotext que se convierten en campos tipados
+INT_FIELDS = {"Steps": "steps", "Seed": "seed", "Clip skip": "clip_skip", "Hires steps": "hires_steps"}
+FLOAT_FIELDS = {"CFG scale": "cfg_scale", "Denoising strength": "denoising_strength", "Hires upscale": "hires_upscale"}
+TEXT_FIELDS = {"Sampler": "sampler", "Schedule type": "scheduler", "Model": "model", "Model hash": "model_hash",
+               "VAE": "vae", "Hires upscaler": "hires_upscaler", "Version": "version"}
+
+# Campos que pasan a metadata["parameters"] cuando no hay un objeto de procesamiento
+PARAMETER_FIELDS = ("prompt", "negative_prompt", "steps", "sampler", "cfg_scale", "seed", "size", "model", "model_hash")
+
+# Tamaño de la caché de resultados
+CACHE_SIZE = 4096
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value[1:-1]
+    return value
+
+
+def _to_number(value, cast):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_loras(prompt, hashes_text):
+    """LoRAs referenciadas en el prompt (<lora:nombre:peso>) con su hash si aparece en el infotext"""
+    hashes = {}
+    for item in (hashes_text or "").split(","):
+        name, sep, value = item.partition(":")
+        if sep:
+            hashes[name.strip()] = value.strip()
+
+    loras = []
+    for _, name, weight in RE_LORA.findall(prompt):
+        loras.append({
+            "name": name,
+            "weight": _to_number(weight, float) if weight else 1.0,
+            "hash": hashes.get(name)
+        })
+    return loras
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_cached(text):
+    lines = text.strip().split("\n")
+
+    # La última línea contiene los parámetros si tiene al menos tres pares "Clave: valor"
+    params_line = ""
+    if lines and len(RE_PARAM.findall(lines[-1])) >= 3:
+        params_line = lines.pop()
+
+    prompt_lines, negative_lines = [], []
+    target = prompt_lines
+    for line in lines:
+        if line.startswith(NEGATIVE_PREFIX):
+            target = negative_lines
+            line = line[len(NEGATIVE_PREFIX):].lstrip()
+        target.append(line)
+
+    result = {
+        "prompt": "\n".join(prompt_lines).strip(),
+        "negative_prompt": "\n".join(negative_lines).strip(),
+        "loras": [],
+        "hires": {},
+        "extra": {}
+    }
+
+    for key, value in RE_PARAM.findall(params_line):
+        key = key.strip()
+        value = _unquote(value.strip())
+        if key in INT_FIELDS:
+            result[INT_FIELDS[key]] = _to_number(value, int)
+        elif key in FLOAT_FIELDS:
+            result[FLOAT_FIELDS[key]] = _to_number(value, float)
+        elif key in TEXT_FIELDS:
+            result[TEXT_FIELDS[key]] = value
+        elif key == "Size":
+            match = RE_SIZE.match(value)
+            if match:
+                result["size"] = value
+                result["width"], result["height"] = int(match.group(1)), int(match.group(2))
+        elif key == "Hires resize":
+            result["hires"]["resize"] = value
+        elif key == "Lora hashes":
+            result["extra"]["lora_hashes"] = value
+        else:
+            result["extra"][key] = value
+
+    for field in ("hires_upscale", "hires_steps", "hires_upscaler"):
+        if field in result:
+            result["hires"][field[len("hires_"):]] = result.pop(field)
+    if result["hires"] and "denoising_strength" in result:
+        result["hires"]["denoising_strength"] = result["denoising_strength"]
+
+    result["loras"] = _parse_loras(result["prompt"], result["extra"].pop("lora_hashes", ""))
+    return result
+
+
+def parse_infotext(text):
+    """Convierte el infotext de la WebUI en un diccionario con campos tipados"""
+    if not text or not isinstance(text, str):
+        return {}
+    # Copia para que quien lo modifique no altere la caché
+    return copy.deepcopy(_parse_cached(text))
+
+
+def infotext_parameters(parsed):
+    """Campos de metadata["parameters"] que se pueden obtener del infotext"""
+    return {field: parsed[field] for field in PARAMETER_FIELDS if parsed.get(field) not in (None, "")}
+
+
+def _metadata_infotext(metadata):
+    """Devuelve el infotext guardado en un JSON de metadatos, si existe"""
+    if isinstance(metadata.get("infotext"), str):
+        return metadata["infotext"]
+    if isinstance(metadata.get("parsed_parameters"), str):
+        return metadata["parsed_parameters"]
+    image_info = metadata.get("image_info")
+    if isinstance(image_info, dict) and isinstance(image_info.get("parameters"), str):
+        return image_info["parameters"]
+    return None
+
+
+def backfill_file(path):
+    """
+    Analiza el infotext de un JSON de metadatos y guarda los campos estructurados.
+    Devuelve (ruta, estado, fila para el índice: campos de parameters y registro reescrito).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return path, "error", None
+
+    if not isinstance(metadata, dict) or isinstance(metadata.get("parsed_parameters"), dict):
+        return path, "skipped", None
+
+    text = _metadata_infotext(metadata)
+    if not text:
+        return path, "skipped", None
+
+    parsed = parse_infotext(text)
+    metadata["infotext"] = text
+    metadata["parsed_parameters"] = parsed
+
+    parameters = metadata.get("parameters")
+    if not isinstance(parameters, dict):
+        parameters = {}
+    for field, value in infotext_parameters(parsed).items():
+        parameters.setdefault(field, value)
+    metadata["parameters"] = parameters
+    # Los registros antiguos pueden incluir p.__dict__ o image.info completos
+    metadata = compact_record(metadata)
+
+    atomic_write_json(path, metadata)
+    return path, "parsed", {**metadata["parameters"], "filename": metadata.get("filename"), "record": metadata}
+
+
+def iter_metadata_files(metadata_dir):
+    """Recorre recursivamente los JSON de metadatos (sin el historial antiguo)"""
+    for root, _, files in os.walk(metadata_dir):
+        for name in files:
+            if name.endswith(".json") and name != "history.json":
+                yield os.path.join(root, name)
+
+
+def backfill_directory(metadata_dir, workers=None, on_parsed=None):
+    """
+    Rellena los campos estructurados de todos los JSON de un directorio con un pool de procesos.
+    `on_parsed` recibe la fila de cada registro analizado (por ejemplo, para el índice).
+    Devuelve un resumen con contadores y el rendimiento en archivos por segundo.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    summary = {"files": 0, "parsed": 0, "skipped": 0, "error": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _, status, parameters in executor.map(backfill_file, iter_metadata_files(metadata_dir), chunksize=64):
+            summary["files"] += 1
+            summary[status] += 1
+            if parameters and on_parsed:
+                on_parsed(parameters)
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["files_per_s"] = round(summary["files"] / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+def main(argv=None):
+    import argparse
+    from scripts.fileio import WriterLock
+    from scripts.history_store import HistoryStore
+    from scripts.layout import METADATA_DIR
+
+    parser = argparse.ArgumentParser(description="Analiza el infotext de los metadatos guardados y rellena el índice")
+    parser.add_argument("--metadata-dir", default=METADATA_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Procesos (por defecto, uno por CPU)")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(os.path.join(args.metadata_dir, "history.sqlite3"), metadata_dir=args.metadata_dir)
+    pending = []
+
+    def on_parsed(parameters):
+        if parameters.get("filename"):
+            pending.append(parameters)
+        if len(pending) >= 500:
+            store.fill_missing_fields(pending)
+            pending.clear()
+
+    # Mismo bloqueo que los guardados de la WebUI: set_starred también reescribe los JSON
+    with WriterLock(os.path.join(args.metadata_dir, ".write.lock")):
+        summary = backfill_directory(args.metadata_dir, workers=args.workers, on_parsed=on_parsed)
+        store.fill_missing_fields(pending)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
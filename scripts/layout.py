@@ -0,0 +1,181 @@
+"""
+Organización en disco de la extensión Image Metadata Saver
+
+- Imágenes: almacenadas por contenido en saved_images/<aa>/<bb>/<hash>.<ext>
+- Metadatos: un JSON por registro en metadata/<AAAA>/<MM>/<DD>/<nombre>.json
+- El índice (history.sqlite3) guarda las rutas relativas de cada registro, de modo que
+  nadie construye rutas uniendo el nombre de archivo a un directorio plano.
+
+Ejecutado como script migra las instalaciones con directorios planos al formato repartido:
+    python scripts/layout.py [--dry-run]
+"""
+
+import os
+import sys
+import json
+import datetime
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/layout.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.fileio import atomic_write_json
+
+# Directorio de datos (por defecto, el de la extensión); se puede cambiar con una variable de
+# entorno, por ejemplo para que los benchmarks trabajen en un directorio temporal
+EXTENSION_DATA_DIR = os.environ.get("IMAGE_METADATA_SAVER_DATA_DIR") or os.path.dirname(os.path.realpath(__file__))
+SAVED_IMAGES_DIR = os.path.join(EXTENSION_DATA_DIR, "saved_images")
+METADATA_DIR = os.path.join(EXTENSION_DATA_DIR, "metadata")
+THUMBNAILS_DIR = os.path.join(EXTENSION_DATA_DIR, "thumbnails")
+HISTORY_FILE = os.path.join(METADATA_DIR, "history.json")
+HISTORY_DB_FILE = os.path.join(METADATA_DIR, "history.sqlite3")
+WRITE_LOCK_FILE = os.path.join(METADATA_DIR, ".write.lock")
+
+# Identificador del formato de directorios actual (se guarda en el índice)
+LAYOUT_KEY = "layout"
+LAYOUT_VERSION = "sharded-v1"
+
+# Registros que se migran por transacción
+MIGRATION_BATCH_SIZE = 500
+
+
+def date_dir(timestamp):
+    """Subdirectorio AAAA/MM/DD correspondiente a un timestamp ISO"""
+    try:
+        date = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        date = datetime.datetime.now()
+    return os.path.join(f"{date.year:04d}", f"{date.month:02d}", f"{date.day:02d}")
+
+
+def metadata_file_for(filename, timestamp):
+    """Ruta relativa (a METADATA_DIR) del JSON de un registro"""
+    return os.path.join(date_dir(timestamp), f"{os.path.splitext(filename)[0]}.json")
+
+
+def blob_file_for(image_hash, extension=".png"):
+    """Ruta relativa, repartida en subdirectorios por prefijo, de una imagen almacenada por contenido"""
+    return os.path.join(image_hash[:2], image_hash[2:4], f"{image_hash}{extension}")
+
+
+def resolve_image_path(entry, saved_images_dir=SAVED_IMAGES_DIR):
+    """Ruta absoluta de la imagen de una entrada del historial"""
+    return os.path.join(saved_images_dir, entry.get("image_file") or entry["filename"])
+
+
+def resolve_metadata_path(entry, metadata_dir=METADATA_DIR):
+    """Ruta absoluta del JSON de una entrada (las entradas antiguas guardan rutas absolutas)"""
+    metadata_file = entry.get("metadata_file")
+    if not metadata_file:
+        return os.path.join(metadata_dir, f"{os.path.splitext(entry['filename'])[0]}.json")
+    return os.path.join(metadata_dir, metadata_file)
+
+
+def _move(source, destination):
+    """Mueve un archivo creando el directorio destino; tolera migraciones interrumpidas"""
+    if os.path.exists(destination):
+        return True
+    if not os.path.exists(source):
+        return False
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(source, destination)
+    return True
+
+
+def migrate_flat_layout(store, saved_images_dir=SAVED_IMAGES_DIR, metadata_dir=METADATA_DIR, dry_run=False):
+    """
+    Mueve los JSON y las imágenes de registros antiguos (directorios planos) al formato repartido
+    por fecha y actualiza el índice. Se puede interrumpir y volver a ejecutar.
+    Devuelve un resumen con el número de archivos movidos.
+    """
+    summary = {"entries": 0, "metadata_moved": 0, "images_moved": 0, "missing": 0}
+    updates = []
+
+    def flush():
+        if updates and not dry_run:
+            store.update_locations(updates)
+        updates.clear()
+
+    for entry in store.all():
+        summary["entries"] += 1
+        old_metadata_path = resolve_metadata_path(entry, metadata_dir)
+        new_metadata_file = metadata_file_for(entry["filename"], entry["timestamp"])
+        new_metadata_path = os.path.join(metadata_dir, new_metadata_file)
+
+        image_file = entry.get("image_file") or entry["filename"]
+        new_image_file = image_file
+        # Solo las imágenes antiguas (sin hash) están en la raíz del directorio de imágenes
+        if entry.get("image_hash") is None and os.path.dirname(image_file) == "":
+            new_image_file = os.path.join(date_dir(entry["timestamp"]), image_file)
+
+        if old_metadata_path == new_metadata_path and new_image_file == image_file:
+            continue
+
+        if dry_run:
+            summary["metadata_moved"] += old_metadata_path != new_metadata_path
+            summary["images_moved"] += new_image_file != image_file
+            continue
+
+        if new_image_file != image_file:
+            if _move(os.path.join(saved_images_dir, image_file), os.path.join(saved_images_dir, new_image_file)):
+                summary["images_moved"] += 1
+            else:
+                summary["missing"] += 1
+                new_image_file = image_file
+
+        if old_metadata_path != new_metadata_path:
+            if _move(old_metadata_path, new_metadata_path):
+                summary["metadata_moved"] += 1
+            else:
+                summary["missing"] += 1
+                new_metadata_file = entry.get("metadata_file") or new_metadata_file
+
+        # El JSON es la fuente de verdad: anota la nueva ubicación de la imagen para que una
+        # reconstrucción del índice (scripts/recovery.py) la encuentre
+        if new_image_file != image_file:
+            json_path = os.path.join(metadata_dir, new_metadata_file)
+            try:
+                with open(json_path, "r", encoding="utf-8") as f:
+                    metadata = json.load(f)
+                metadata["image_file"] = new_image_file
+                metadata["image_path"] = os.path.join(saved_images_dir, new_image_file)
+                atomic_write_json(json_path, metadata)
+            except (OSError, ValueError):
+                pass
+
+        updates.append((entry["filename"], new_metadata_file, new_image_file))
+        if len(updates) >= MIGRATION_BATCH_SIZE:
+            flush()
+
+    flush()
+    if not dry_run:
+        store.set_meta(LAYOUT_KEY, LAYOUT_VERSION)
+    return summary
+
+
+def main(argv=None):
+    import argparse
+
+    from scripts.fileio import WriterLock
+    from scripts.history_store import HistoryStore
+
+    parser = argparse.ArgumentParser(description="Migra saved_images/ y metadata/ al formato repartido por directorios")
+    parser.add_argument("--saved-images-dir", default=SAVED_IMAGES_DIR)
+    parser.add_argument("--metadata-dir", default=METADATA_DIR)
+    parser.add_argument("--dry-run", action="store_true", help="Solo contar los archivos que se moverían")
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(
+        os.path.join(args.metadata_dir, "history.sqlite3"),
+        legacy_file=os.path.join(args.metadata_dir, "history.json"),
+        metadata_dir=args.metadata_dir
+    )
+    # Mismo bloqueo que los guardados y borrados de la WebUI mientras se mueven archivos
+    with WriterLock(os.path.join(args.metadata_dir, ".write.lock")):
+        summary = migrate_flat_layout(store, args.saved_images_dir, args.metadata_dir, dry_run=args.dry_run)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
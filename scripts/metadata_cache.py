@@ -0,0 +1,88 @@
+"""
+Caché en memoria de metadatos para la extensión Image Metadata Saver
+Guarda los registros ya leídos por ruta de su JSON, con un límite LRU de entradas.
+Cada consulta hace un stat() del archivo en lugar de abrirlo y parsearlo: si el mtime
+o el tamaño han cambiado (por ejemplo, tras un backfill o una migración) se vuelve a leer.
+"""
+
+import os
+import json
+import threading
+from collections import OrderedDict
+
+# Número máximo de registros en memoria
+DEFAULT_MAX_ENTRIES = 4096
+
+
+def read_json(path):
+    """Lee un JSON de metadatos desde disco"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class MetadataCache:
+    """Registros de metadatos parseados con invalidación por mtime y límite LRU"""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ruta -> ((mtime_ns, tamaño), registro), del menos al más usado
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, path, load=None):
+        """
+        Devuelve el registro del JSON `path`. En un fallo se usa `load()` (por ejemplo,
+        la copia del índice) o se lee el archivo. Lanza FileNotFoundError si no existe.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.invalidate(path)
+            raise FileNotFoundError(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None:
+                if cached[0] == version:
+                    self._entries.move_to_end(path)
+                    self._counters["hits"] += 1
+                    return cached[1]
+                del self._entries[path]
+                self._counters["invalidations"] += 1
+                # El JSON ha cambiado después de leerlo: la copia de `load` puede estar desfasada
+                load = None
+            self._counters["misses"] += 1
+
+        record = load() if load else None
+        if record is None:
+            record = read_json(path)
+
+        with self._lock:
+            self._entries[path] = (version, record)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters["evictions"] += 1
+        return record
+
+    def invalidate(self, path):
+        """Elimina un registro de la caché (por ejemplo, al borrar su JSON)"""
+        with self._lock:
+            if self._entries.pop(path, None) is not None:
+                self._counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Contadores de aciertos, fallos, expulsiones e invalidaciones"""
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hit_rate": round(self._counters["hits"] / lookups, 4) if lookups else None
+            }
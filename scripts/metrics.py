@@ -0,0 +1,173 @@
+"""
+Métricas de rendimiento para la extensión Image Metadata Saver
+Mide la duración de las etapas del guardado, de la galería y de la API (spans), las
+agrega en histogramas con percentiles p50/p95/p99 y cuenta los bytes escritos. Todo se
+exporta en el formato de texto de Prometheus.
+"""
+
+import time
+import bisect
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# Prefijo de los nombres de las métricas
+METRIC_PREFIX = "image_metadata_saver"
+
+# Límites superiores (segundos) de los intervalos de los histogramas
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Percentiles que se calculan sobre las últimas muestras de cada span
+QUANTILES = (0.5, 0.95, 0.99)
+RESERVOIR_SIZE = 1024
+
+# Spans de la petición en curso (solo si se ha pedido la cabecera de depuración)
+_request_spans = contextvars.ContextVar("image_metadata_saver_request_spans", default=None)
+
+
+class Histogram:
+    """Histograma acumulado más una ventana de las últimas muestras para los percentiles"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class Metrics:
+    """Registro de histogramas de duración, contadores y medidores"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name, seconds):
+        """Añade una duración al histograma del span `name`"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((name, seconds))
+
+    @contextmanager
+    def span(self, name):
+        """Mide la duración del bloque y la registra como `name` (también si lanza una excepción)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def increment(self, name, value=1, **labels):
+        """Incrementa un contador con etiquetas opcionales"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_gauge(self, name, function, help_text=""):
+        """Registra un medidor cuyo valor se obtiene al exportar (por ejemplo, la profundidad de una cola)"""
+        self._gauges[name] = (function, help_text)
+
+    def snapshot(self):
+        """Resumen en diccionario de los spans (recuento, media y percentiles en ms)"""
+        with self._lock:
+            return {
+                name: {
+                    "count": histogram.count,
+                    "mean_ms": round(histogram.total / histogram.count * 1000, 3) if histogram.count else None,
+                    **{f"p{int(q * 100)}_ms": round(value * 1000, 3) for q, value in histogram.quantiles().items()}
+                }
+                for name, histogram in self._histograms.items()
+            }
+
+    def render_prometheus(self):
+        """Exporta todas las métricas en el formato de texto de Prometheus"""
+        lines = []
+        span_metric = f"{METRIC_PREFIX}_span_seconds"
+        quantile_metric = f"{METRIC_PREFIX}_span_quantile_seconds"
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            span_data = [
+                (name, list(histogram.counts), histogram.total, histogram.count, histogram.quantiles())
+                for name, histogram in histograms
+            ]
+
+        lines.append(f"# HELP {span_metric} Duración de las etapas del guardado, la galería y la API")
+        lines.append(f"# TYPE {span_metric} histogram")
+        for name, counts, total, count, _ in span_data:
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{span_metric}_bucket{{span="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{span_metric}_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'{span_metric}_count{{span="{name}"}} {count}')
+
+        lines.append(f"# HELP {quantile_metric} Percentiles de las últimas {RESERVOIR_SIZE} duraciones de cada etapa")
+        lines.append(f"# TYPE {quantile_metric} gauge")
+        for name, _, _, _, quantiles in span_data:
+            for q, value in quantiles.items():
+                lines.append(f'{quantile_metric}{{span="{name}",quantile="{q}"}} {value:.6f}')
+
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f"{METRIC_PREFIX}_{name}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+
+        for name, (function, help_text) in sorted(self._gauges.items()):
+            try:
+                value = function()
+            except Exception:
+                continue
+            metric = f"{METRIC_PREFIX}_{name}"
+            if help_text:
+                lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def collect_request_spans():
+    """Recoge los spans medidos en el contexto actual (para la cabecera de depuración)"""
+    spans = []
+    token = _request_spans.set(spans)
+    try:
+        yield spans
+    finally:
+        _request_spans.reset(token)
+
+
+def server_timing(spans):
+    """Formatea spans como cabecera Server-Timing (duraciones en ms)"""
+    return ", ".join(f"{name.replace(':', '_').replace('/', '_')};dur={seconds * 1000:.2f}" for name, seconds in spans)
+
+
+# Registro global de la extensión
+METRICS = Metrics()
@@ -0,0 +1,193 @@
+"""
+Registros de metadatos compactos para la extensión Image Metadata Saver
+Define qué campos se guardan de cada imagen, con tipos y límites de tamaño, para que
+ningún registro arrastre objetos enteros de la WebUI (p.__dict__) ni bloques binarios
+de image.info (perfiles ICC, EXIF...). El índice guarda además una copia empaquetada
+de cada registro (msgpack si está instalado, JSON comprimido si no).
+"""
+
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Campos de metadata["parameters"] y su tipo
+PARAMETER_SCHEMA = {
+    "prompt": str,
+    "negative_prompt": str,
+    "steps": int,
+    "sampler": str,
+    "scheduler": str,
+    "cfg_scale": float,
+    "seed": int,
+    "subseed": int,
+    "size": str,
+    "width": int,
+    "height": int,
+    "model": str,
+    "model_hash": str,
+    "batch_size": int,
+    "denoising_strength": float,
+    "clip_skip": int,
+    "type": str
+}
+
+# Nombres de atributos de los objetos de procesamiento que corresponden a otro campo
+PARAMETER_ALIASES = {"sampler_name": "sampler", "sd_model_name": "model", "sd_model_hash": "model_hash"}
+
+# Claves de primer nivel que se conservan en cada registro
+RECORD_FIELDS = (
+    "timestamp", "filename", "parameters", "infotext", "parsed_parameters", "image_info",
+    "image_path", "image_file", "image_hash", "image_size", "starred", "phash", "metadata_file", "source",
+    "truncated", "omitted"
+)
+
+# Límites de tamaño (caracteres)
+MAX_PROMPT_LENGTH = 8192
+MAX_INFOTEXT_LENGTH = 16384
+MAX_TEXT_LENGTH = 1024
+MAX_ITEMS = 64
+
+# Prefijos del formato empaquetado en el índice
+PACKED_MSGPACK = b"m"
+PACKED_ZLIB_JSON = b"z"
+
+
+def _truncate(text, limit, field, truncated):
+    if len(text) <= limit:
+        return text
+    truncated.append(field)
+    return text[:limit]
+
+
+def _coerce(value, kind):
+    """Convierte un valor al tipo del esquema; devuelve None si no es posible"""
+    if value is None or isinstance(value, bool):
+        return None
+    if kind is str:
+        return value if isinstance(value, str) else str(value) if isinstance(value, (int, float)) else None
+    try:
+        return kind(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def compact_parameters(values, truncated=None):
+    """
+    Filtra un diccionario de parámetros (o los atributos de un objeto de procesamiento)
+    dejando solo los campos del esquema, con su tipo y tamaño acotado.
+    """
+    truncated = truncated if truncated is not None else []
+    parameters = {}
+    for key, value in values.items():
+        field = PARAMETER_ALIASES.get(key, key)
+        if field not in PARAMETER_SCHEMA or field in parameters and key != field:
+            continue
+        value = _coerce(value, PARAMETER_SCHEMA[field])
+        if value is None:
+            continue
+        if isinstance(value, str):
+            limit = MAX_PROMPT_LENGTH if field in ("prompt", "negative_prompt") else MAX_TEXT_LENGTH
+            value = _truncate(value, limit, f"parameters.{field}", truncated)
+        parameters[field] = value
+
+    if "size" not in parameters and "width" in parameters and "height" in parameters:
+        parameters["size"] = f"{parameters['width']}x{parameters['height']}"
+    return parameters
+
+
+def compact_image_info(info, omitted=None):
+    """
+    Conserva de image.info solo los textos cortos. Los valores binarios o grandes se
+    omiten y su clave se anota en `omitted`; "parameters" ya se guarda como infotext.
+    """
+    omitted = omitted if omitted is not None else []
+    compact = {}
+    for key, value in info.items():
+        if not isinstance(key, str) or key == "parameters":
+            continue
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            compact[key] = value
+        elif isinstance(value, str) and len(value) <= MAX_TEXT_LENGTH:
+            compact[key] = value
+        elif isinstance(value, tuple) and len(value) <= 4 and all(isinstance(item, (int, float)) for item in value):
+            # Valores como dpi o gamma
+            compact[key] = list(value)
+        else:
+            omitted.append(f"image_info.{key}")
+        if len(compact) >= MAX_ITEMS:
+            break
+    return compact
+
+
+def _bound(value, truncated, path, depth=0):
+    """Acota recursivamente un valor JSON (textos, listas y anidamiento)"""
+    if isinstance(value, str):
+        limit = MAX_PROMPT_LENGTH if path.endswith("prompt") else MAX_TEXT_LENGTH
+        return _truncate(value, limit, path, truncated)
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if depth >= 4:
+        return None
+    if isinstance(value, dict):
+        return {
+            str(key): _bound(item, truncated, f"{path}.{key}", depth + 1)
+            for key, item in list(value.items())[:MAX_ITEMS]
+        }
+    if isinstance(value, (list, tuple)):
+        return [_bound(item, truncated, path, depth + 1) for item in value[:MAX_ITEMS]]
+    return None
+
+
+def compact_record(metadata):
+    """Devuelve una copia del registro con solo los campos permitidos y tamaños acotados"""
+    truncated = list(metadata.get("truncated") or [])
+    omitted = list(metadata.get("omitted") or [])
+    record = {}
+    for field in RECORD_FIELDS:
+        value = metadata.get(field)
+        if value is None or field in ("truncated", "omitted"):
+            continue
+        if field == "parameters":
+            value = compact_parameters(value, truncated) if isinstance(value, dict) else {}
+        elif field == "image_info":
+            value = (compact_image_info(value, omitted) if isinstance(value, dict) else None) or None
+        elif field == "infotext":
+            value = _truncate(value, MAX_INFOTEXT_LENGTH, field, truncated) if isinstance(value, str) else None
+        else:
+            value = _bound(value, truncated, field)
+        if value is not None:
+            record[field] = value
+
+    record.setdefault("parameters", {})
+    if truncated:
+        record["truncated"] = sorted(set(truncated))
+    if omitted:
+        record["omitted"] = sorted(set(omitted))
+    return record
+
+
+def pack_record(record):
+    """Empaqueta un registro para guardarlo en el índice"""
+    if msgpack is not None:
+        return PACKED_MSGPACK + msgpack.packb(record, use_bin_type=True)
+    raw = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return PACKED_ZLIB_JSON + zlib.compress(raw)
+
+
+def unpack_record(data):
+    """Desempaqueta un registro del índice; devuelve None si no se puede leer"""
+    if not data:
+        return None
+    data = bytes(data)
+    try:
+        if data[:1] == PACKED_ZLIB_JSON:
+            return json.loads(zlib.decompress(data[1:]))
+        if data[:1] == PACKED_MSGPACK and msgpack is not None:
+            return msgpack.unpackb(data[1:], raw=False)
+    except Exception:
+        return None
+    return None
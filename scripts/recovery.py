@@ -0,0 +1,200 @@
+"""
+Recuperación del índice de la extensión Image Metadata Saver
+
+Los JSON de metadatos de cada imagen son la fuente de verdad: si el índice
+(history.sqlite3) se pierde o se corrompe, se reconstruye a partir de ellos.
+Al arrancar, un índice que SQLite no puede abrir se aparta y se reconstruye solo.
+
+Uso:
+    python scripts/recovery.py [--metadata-dir DIR] [--workers N]
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import datetime
+import threading
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/recovery.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.history_store import HistoryStore, history_entry
+from scripts.infotext import iter_metadata_files
+from scripts.layout import METADATA_DIR, SAVED_IMAGES_DIR, date_dir, resolve_image_path
+
+
+def legacy_image_file(metadata, saved_images_dir=SAVED_IMAGES_DIR):
+    """
+    Ubicación de la imagen de un JSON anterior a image_file: la de image_path si está
+    dentro del directorio de imágenes, el directorio por fecha al que la mueve
+    scripts/layout.py o, si no existe ninguna, la raíz del directorio (None).
+    """
+    candidates = []
+    image_path = metadata.get("image_path")
+    if isinstance(image_path, str) and image_path:
+        relative = os.path.relpath(image_path, saved_images_dir) if os.path.isabs(image_path) else image_path
+        if not relative.startswith(os.pardir):
+            candidates.append(relative)
+    candidates.append(os.path.join(date_dir(metadata["timestamp"]), metadata["filename"]))
+    for candidate in candidates:
+        if os.path.exists(os.path.join(saved_images_dir, candidate)):
+            return candidate
+    return None
+
+
+def read_history_entry(path, metadata_dir=METADATA_DIR, saved_images_dir=SAVED_IMAGES_DIR):
+    """
+    Construye la entrada del índice de un JSON de metadatos.
+    Devuelve (entrada o None, estado): "ok", "error" (JSON ilegible) o "missing" (sin imagen).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None, "error"
+    if not isinstance(metadata, dict) or not metadata.get("filename") or not metadata.get("timestamp"):
+        return None, "error"
+    # La ubicación real del JSON prevalece sobre la anotada en él
+    metadata["metadata_file"] = os.path.relpath(path, metadata_dir)
+    if not metadata.get("image_file"):
+        metadata["image_file"] = legacy_image_file(metadata, saved_images_dir)
+    entry = history_entry(metadata)
+    # JSON escrito por un guardado que no llegó a colocar la imagen
+    if not os.path.exists(resolve_image_path(entry, saved_images_dir)):
+        return None, "missing"
+    return entry, "ok"
+
+
+def rebuild_index(store, metadata_dir=METADATA_DIR, saved_images_dir=SAVED_IMAGES_DIR, workers=None, use_processes=True):
+    """
+    Sustituye el contenido del índice por las entradas de todos los JSON de metadatos
+    cuya imagen existe. Devuelve un resumen con contadores y el rendimiento en archivos por segundo.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    from functools import partial
+
+    summary = {"files": 0, "entries": 0, "errors": 0, "missing": 0}
+    entries = []
+    start = time.perf_counter()
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        read = partial(read_history_entry, metadata_dir=metadata_dir, saved_images_dir=saved_images_dir)
+        for entry, status in executor.map(read, iter_metadata_files(metadata_dir), chunksize=64):
+            summary["files"] += 1
+            if entry is None:
+                summary[status] += 1
+            else:
+                entries.append(entry)
+
+    summary["entries"] = store.rebuild(entries)
+    elapsed = time.perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["files_per_s"] = round(summary["files"] / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+def open_history_store(db_path, legacy_file=None, metadata_dir=METADATA_DIR, saved_images_dir=SAVED_IMAGES_DIR):
+    """
+    Abre el índice; si está corrupto lo renombra (*.corrupt-FECHA) y lo reconstruye
+    desde los JSON de metadatos.
+    """
+    try:
+        store = HistoryStore(db_path, legacy_file=legacy_file, metadata_dir=metadata_dir)
+        store.count()
+        return store
+    except sqlite3.DatabaseError as e:
+        print(f"[Image Metadata Saver] El índice {db_path} no se puede leer ({e}); reconstruyéndolo")
+
+    suffix = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    for extension in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + extension):
+            os.replace(db_path + extension, f"{db_path}.corrupt-{suffix}{extension}")
+
+    store = HistoryStore(db_path, legacy_file=legacy_file, metadata_dir=metadata_dir)
+    # Hilos en lugar de procesos: puede ejecutarse dentro de la WebUI
+    summary = rebuild_index(store, metadata_dir, saved_images_dir, use_processes=False)
+    print(f"[Image Metadata Saver] Índice reconstruido con {summary['entries']} entradas "
+          f"({summary['errors']} JSON ilegibles, {summary['missing']} sin imagen)")
+    return store
+
+
+class LazyHistoryStore:
+    """
+    Índice que se abre la primera vez que se usa en lugar de al importar la extensión:
+    la migración de history.json o la reconstrucción de un índice corrupto no retrasan
+    el arranque de la WebUI. Delega el resto de atributos en el HistoryStore abierto.
+    """
+
+    def __init__(self, db_path, legacy_file=None, metadata_dir=METADATA_DIR, saved_images_dir=SAVED_IMAGES_DIR, on_open=None):
+        self.db_path = db_path
+        self._legacy_file = legacy_file
+        self._metadata_dir = metadata_dir
+        self._saved_images_dir = saved_images_dir
+        # on_open(store) se ejecuta una vez, antes de que nadie más use el índice
+        self._on_open = on_open
+        self._store = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._store is not None
+
+    def open(self):
+        """
+        Devuelve el HistoryStore, abriéndolo (y recuperándolo si hace falta) la primera vez.
+        La primera llamada puede tardar (migración o reconstrucción): los endpoints que usan
+        el índice son síncronos para que FastAPI la ejecute en su pool de hilos.
+        """
+        store = self._store
+        if store is not None:
+            return store
+        with self._lock:
+            if self._store is None:
+                start = time.perf_counter()
+                store = open_history_store(
+                    self.db_path, legacy_file=self._legacy_file,
+                    metadata_dir=self._metadata_dir, saved_images_dir=self._saved_images_dir
+                )
+                if self._on_open:
+                    self._on_open(store)
+                self._store = store
+                print(f"[Image Metadata Saver] Índice abierto en {(time.perf_counter() - start) * 1000:.0f} ms "
+                      f"({store.count()} registros)")
+            return self._store
+
+    def close(self):
+        """Cierra el índice si llegó a abrirse"""
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def __getattr__(self, name):
+        return getattr(self.open(), name)
+
+
+def main(argv=None):
+    import argparse
+    from scripts.fileio import WriterLock
+
+    parser = argparse.ArgumentParser(description="Reconstruye el índice del historial desde los JSON de metadatos")
+    parser.add_argument("--saved-images-dir", default=SAVED_IMAGES_DIR)
+    parser.add_argument("--metadata-dir", default=METADATA_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="Procesos (por defecto, uno por CPU)")
+    args = parser.parse_args(argv)
+
+    db_path = os.path.join(args.metadata_dir, "history.sqlite3")
+    # Mismo bloqueo que los guardados de la WebUI: nadie escribe mientras se reconstruye
+    with WriterLock(os.path.join(args.metadata_dir, ".write.lock")):
+        store = open_history_store(db_path, metadata_dir=args.metadata_dir, saved_images_dir=args.saved_images_dir)
+        summary = rebuild_index(store, args.metadata_dir, args.saved_images_dir, workers=args.workers)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,269 @@
+"""
+Retención y limpieza del almacén de la extensión Image Metadata Saver
+Aplica reglas de retención configurables (antigüedad máxima y tamaño total máximo de las
+imágenes, conservando las favoritas) desde un hilo en segundo plano. Los registros se
+borran por bloques, cada uno en una transacción del índice, y en cada barrido se eliminan
+también los archivos huérfanos: imágenes sin registro, JSON de registros borrados,
+miniaturas de imágenes que ya no existen y temporales abandonados.
+"""
+
+import os
+import time
+import datetime
+import threading
+
+from scripts.extension_config import load_section, save_section
+from scripts.layout import resolve_image_path
+
+CONFIG_SECTION = "retention"
+
+DEFAULT_CONFIG = {
+    "enabled": False,
+    # Borrar los registros con más días de antigüedad (0 = sin límite)
+    "max_age_days": 0,
+    # Tamaño total máximo de las imágenes guardadas en MB (0 = sin límite)
+    "max_total_mb": 0,
+    # No borrar nunca los registros marcados como favoritos
+    "keep_starred": True,
+    # Minutos entre barridos
+    "interval_minutes": 60,
+    # Registros que se borran por transacción
+    "batch_size": 500
+}
+
+# Espera antes del primer barrido para no competir con el arranque de la WebUI
+STARTUP_DELAY_SECONDS = 120
+
+# Antigüedad mínima (segundos) de un archivo sin registro antes de considerarlo huérfano:
+# un guardado escribe el JSON y el temporal de la imagen antes de registrarlos
+ORPHAN_GRACE_SECONDS = 3600
+
+# Las importaciones de archivos grandes pueden tardar horas: sus directorios temporales
+# solo se eliminan pasado un día
+STAGING_GRACE_SECONDS = 24 * 3600
+
+
+class RetentionSweeper:
+    """Configuración, barridos y contadores de la retención"""
+
+    def __init__(self, store, delete_batch, lock, saved_images_dir, metadata_dir, thumbnails):
+        self._store = store
+        # delete_batch(filenames) -> registros borrados (borra también sus archivos)
+        self._delete_batch = delete_batch
+        self._write_lock = lock
+        self._saved_images_dir = saved_images_dir
+        self._metadata_dir = metadata_dir
+        self._thumbnails = thumbnails
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.config = load_section(CONFIG_SECTION, DEFAULT_CONFIG)
+        self.counters = {"sweeps": 0, "deleted_age": 0, "deleted_size": 0, "orphans_removed": 0, "errors": 0}
+        self.last_sweep = None
+
+    def update_config(self, **values):
+        """Actualiza y persiste la configuración (y despierta al hilo para aplicarla)"""
+        with self._lock:
+            self.config.update({key: value for key, value in values.items() if key in DEFAULT_CONFIG})
+            self.config["max_age_days"] = max(0, float(self.config["max_age_days"] or 0))
+            self.config["max_total_mb"] = max(0, float(self.config["max_total_mb"] or 0))
+            self.config["interval_minutes"] = max(1, float(self.config["interval_minutes"] or 60))
+            self.config["batch_size"] = max(1, int(self.config["batch_size"] or 500))
+            config = dict(self.config)
+        save_section(CONFIG_SECTION, config)
+        self._wake.set()
+        return config
+
+    def stats(self):
+        """Configuración, contadores, último barrido y ocupación actual"""
+        image_bytes, unknown_sizes = self._store.image_bytes()
+        with self._lock:
+            return {
+                "config": dict(self.config),
+                "counters": dict(self.counters),
+                "last_sweep": self.last_sweep,
+                "usage": {"records": self._store.count(), "image_bytes": image_bytes, "unknown_sizes": unknown_sizes}
+            }
+
+    def start(self):
+        """Arranca el hilo de barridos periódicos (no hace nada si ya está en marcha)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="image-metadata-saver-retention", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Guardar la configuración lo adelanta (los barridos manuales no esperan)
+        self._wake.wait(STARTUP_DELAY_SECONDS)
+        self._wake.clear()
+        while True:
+            with self._lock:
+                config = dict(self.config)
+            if config["enabled"]:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    with self._lock:
+                        self.counters["errors"] += 1
+                    print(f"[Image Metadata Saver] Error en el barrido de retención: {e}")
+            self._wake.wait(config["interval_minutes"] * 60)
+            self._wake.clear()
+
+    def sweep(self):
+        """Aplica las reglas de retención y limpia los archivos huérfanos; devuelve un resumen"""
+        with self._sweep_lock:
+            with self._lock:
+                config = dict(self.config)
+            start = time.perf_counter()
+            summary = {"sizes_filled": self.fill_sizes(), "deleted_age": 0, "deleted_size": 0}
+
+            if config["max_age_days"]:
+                cutoff = (datetime.datetime.now() - datetime.timedelta(days=config["max_age_days"])).isoformat()
+                summary["deleted_age"] = self._delete_while(
+                    lambda: self._store.retention_candidates(
+                        before=cutoff, limit=config["batch_size"], keep_starred=config["keep_starred"]
+                    )
+                )
+
+            if config["max_total_mb"]:
+                summary["deleted_size"] = self._enforce_max_bytes(int(config["max_total_mb"] * 1024 * 1024), config)
+
+            summary.update(self.collect_garbage())
+            summary["seconds"] = round(time.perf_counter() - start, 3)
+            with self._lock:
+                self.counters["sweeps"] += 1
+                self.counters["deleted_age"] += summary["deleted_age"]
+                self.counters["deleted_size"] += summary["deleted_size"]
+                self.counters["orphans_removed"] += summary["orphans_removed"]
+                self.last_sweep = {"finished": datetime.datetime.now().isoformat(timespec="seconds"), **summary}
+            return summary
+
+    def _delete_while(self, next_batch):
+        """Borra bloques de registros mientras `next_batch` devuelva candidatos"""
+        deleted = 0
+        while True:
+            batch = next_batch()
+            if not batch:
+                return deleted
+            count = self._delete_batch([entry["filename"] for entry in batch])
+            deleted += count
+            if not count:
+                return deleted
+
+    def _enforce_max_bytes(self, max_bytes, config):
+        """Borra los registros más antiguos hasta que las imágenes ocupen como mucho `max_bytes`"""
+        def next_batch():
+            total, _ = self._store.image_bytes()
+            excess = total - max_bytes
+            if excess <= 0:
+                return []
+            candidates = self._store.retention_candidates(
+                limit=config["batch_size"], keep_starred=config["keep_starred"], stored_only=True
+            )
+            # Solo los necesarios para cubrir el exceso (las imágenes compartidas liberan
+            # menos de lo estimado; el bucle vuelve a medir tras cada bloque)
+            batch, freed = [], 0
+            for entry in candidates:
+                batch.append(entry)
+                freed += entry.get("image_size") or 0
+                if freed >= excess:
+                    break
+            return batch
+
+        return self._delete_while(next_batch)
+
+    def fill_sizes(self, batch_size=500):
+        """Completa el tamaño de imagen de los registros anteriores a que se guardara en el índice"""
+        filled = 0
+        while True:
+            rows = self._store.missing_sizes(batch_size)
+            if not rows:
+                return filled
+            sizes = []
+            for filename, image_file in rows:
+                try:
+                    size = os.path.getsize(resolve_image_path({"image_file": image_file}, self._saved_images_dir))
+                except OSError:
+                    size = 0
+                sizes.append((filename, size))
+            self._store.set_image_sizes(sizes)
+            filled += len(sizes)
+
+    def collect_garbage(self):
+        """Elimina imágenes, JSON y miniaturas sin registro y temporales abandonados"""
+        from scripts.archive import STAGING_PREFIX
+
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        removed = {"images": 0, "metadata": 0, "thumbnails": 0, "temporary": 0}
+
+        for path, name, mtime in _iter_files(self._saved_images_dir):
+            relative = os.path.relpath(path, self._saved_images_dir)
+            if relative.startswith(STAGING_PREFIX):
+                if mtime < time.time() - STAGING_GRACE_SECONDS:
+                    removed["temporary"] += _remove(path)
+            elif mtime > cutoff:
+                continue
+            elif name.endswith(".tmp"):
+                removed["temporary"] += _remove(path)
+            elif not self._image_referenced(path, name):
+                # Se vuelve a comprobar con el bloqueo: un guardado puede estar colocándola
+                with self._write_lock:
+                    if not self._image_referenced(path, name):
+                        removed["images"] += _remove(path)
+
+        for path, name, mtime in _iter_files(self._metadata_dir):
+            if mtime > cutoff:
+                continue
+            if name.endswith(".tmp"):
+                removed["temporary"] += _remove(path)
+            elif name.endswith(".json") and name != "history.json" and self._store.get_by_stem(name[:-5]) is None:
+                removed["metadata"] += _remove(path)
+
+        for path, name, mtime in _iter_files(self._thumbnails.cache_dir):
+            if mtime > cutoff:
+                continue
+            if name.endswith(".tmp"):
+                removed["temporary"] += _remove(path)
+            elif self._store.get_by_stem(os.path.splitext(name)[0]) is None:
+                # También lo quita del índice LRU de la caché
+                self._thumbnails.invalidate(name)
+                removed["thumbnails"] += 1
+
+        return {"orphans_removed": sum(removed.values()), "orphans": removed}
+
+    def _image_referenced(self, path, name):
+        stem = os.path.splitext(name)[0]
+        # Imágenes por contenido (referencias por archivo); las anteriores se llaman como su registro
+        if self._store.blob_referenced(os.path.relpath(path, self._saved_images_dir)):
+            return True
+        entry = self._store.get(name) or self._store.get_by_stem(stem)
+        return entry is not None and resolve_image_path(entry, self._saved_images_dir) == path
+
+
+def _iter_files(root):
+    """Recorre recursivamente un directorio devolviendo (ruta, nombre, mtime) de cada archivo"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        try:
+                            yield entry.path, entry.name, entry.stat().st_mtime
+                        except OSError:
+                            continue
+        except OSError:
+            continue
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return 1
+    except OSError:
+        return 0
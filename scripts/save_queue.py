@@ -0,0 +1,109 @@
+"""
+Cola de guardado en segundo plano para la extensión Image Metadata Saver
+Los trabajos se ejecutan en un hilo escritor para que los endpoints no bloqueen
+el event loop de FastAPI con la codificación PNG y las escrituras a disco.
+"""
+
+import queue
+import threading
+import traceback
+import uuid
+from collections import OrderedDict
+
+# Tamaño máximo de la cola antes de rechazar nuevos trabajos
+DEFAULT_MAX_PENDING = 64
+
+# Número de trabajos terminados cuyo estado se conserva para consultas
+DEFAULT_MAX_FINISHED = 1000
+
+# Estados posibles de un trabajo
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+
+
+class QueueFullError(Exception):
+    """La cola de guardado está llena; el cliente debe reintentar más tarde"""
+
+
+class SaveQueue:
+    """
+    Cola acotada de trabajos de guardado.
+    Un único hilo escritor procesa los trabajos en orden de llegada, de modo que
+    el historial se actualiza en el mismo orden en que se pidieron los guardados.
+    """
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING, max_finished=DEFAULT_MAX_FINISHED):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = OrderedDict()
+        self._max_finished = max_finished
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _ensure_worker(self):
+        """Arranca el hilo escritor la primera vez que se necesita"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="image-metadata-saver-writer", daemon=True)
+                self._worker.start()
+
+    def submit(self, fn, *args, **kwargs):
+        """Encola un trabajo y devuelve su id; lanza QueueFullError si no hay sitio"""
+        self._ensure_worker()
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "status": STATUS_QUEUED, "result": None, "error": None}
+
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            self._queue.put_nowait((job_id, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            raise QueueFullError("La cola de guardado está llena, inténtalo de nuevo en unos segundos")
+
+        return job_id
+
+    def status(self, job_id):
+        """Devuelve una copia del estado de un trabajo o None si no se conoce"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def pending(self):
+        """Número de trabajos en espera"""
+        return self._queue.qsize()
+
+    def join(self):
+        """Espera a que se hayan procesado todos los trabajos encolados"""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            job_id, fn, args, kwargs = self._queue.get()
+            self._set(job_id, status=STATUS_RUNNING)
+            try:
+                result = fn(*args, **kwargs)
+                self._set(job_id, status=STATUS_DONE, result=result)
+            except Exception as e:
+                traceback.print_exc()
+                self._set(job_id, status=STATUS_ERROR, error=str(e))
+            finally:
+                self._queue.task_done()
+
+    def _set(self, job_id, **changes):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(changes)
+            if job["status"] in (STATUS_DONE, STATUS_ERROR):
+                # Mover al final y descartar los trabajos terminados más antiguos
+                self._jobs.move_to_end(job_id)
+                self._trim_finished()
+
+    def _trim_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in (STATUS_DONE, STATUS_ERROR)]
+        for job_id in finished[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job_id]
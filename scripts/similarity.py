@@ -0,0 +1,253 @@
+"""
+Búsqueda de imágenes parecidas para la extensión Image Metadata Saver
+
+Cada imagen guardada o importada lleva un hash perceptual (dHash de 64 bits) en su
+registro y en el índice. Las consultas usan un índice en memoria de varias tablas: el
+hash se parte en 4 trozos de 16 bits y, por el principio del palomar, dos hashes a
+distancia de Hamming <= d coinciden en al menos un trozo a distancia <= d // 4, así que
+solo se comparan los candidatos de unas pocas entradas de cada tabla.
+
+Uso:
+    python scripts/similarity.py [--workers N]    (calcula los hashes que faltan)
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import functools
+
+from PIL import Image
+
+if __name__ == "__main__":
+    # Permite ejecutar el archivo directamente: python scripts/similarity.py
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scripts.layout import SAVED_IMAGES_DIR, resolve_image_path
+
+# Lado de la cuadrícula del dHash (8x8 comparaciones = 64 bits)
+HASH_SIZE = 8
+
+# Trozos en que se parte el hash para el índice y bits de cada uno
+CHUNKS = 4
+CHUNK_BITS = 16
+
+# Distancia de Hamming por defecto y máxima de las consultas
+DEFAULT_MAX_DISTANCE = 10
+MAX_DISTANCE = 16
+
+# Clave de la tabla meta que cambia cada vez que se rellenan hashes de registros existentes
+GENERATION_KEY = "phash_generation"
+
+# Registros que se procesan por transacción al calcular los hashes que faltan
+BACKFILL_BATCH_SIZE = 256
+
+
+def image_phash(image):
+    """dHash de 64 bits de una imagen PIL, como 16 dígitos hexadecimales"""
+    if image.mode not in ("L", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    # reducing_gap reduce primero por bloques: el coste apenas depende del tamaño de la imagen
+    small = image.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, reducing_gap=2.0).convert("L")
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:016x}"
+
+
+def file_phash(path):
+    """Hash perceptual de un archivo de imagen; None si no se puede leer"""
+    try:
+        with Image.open(path) as image:
+            # JPEG decodifica directamente a escala reducida
+            image.draft("RGB", (HASH_SIZE * 8, HASH_SIZE * 8))
+            return image_phash(image)
+    except Exception:
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+@functools.lru_cache(maxsize=None)
+def _chunk_masks(radius):
+    """Máscaras de CHUNK_BITS bits con como mucho `radius` bits a 1 (vecinos de un trozo)"""
+    masks = [0]
+    frontier = [0]
+    for _ in range(radius):
+        frontier = sorted({mask | (1 << bit) for mask in frontier for bit in range(CHUNK_BITS) if not mask >> bit & 1})
+        masks.extend(frontier)
+    return tuple(masks)
+
+
+def _chunks(value):
+    mask = (1 << CHUNK_BITS) - 1
+    return [(value >> (i * CHUNK_BITS)) & mask for i in range(CHUNKS)]
+
+
+class SimilarityIndex:
+    """
+    Índice en memoria de los hashes perceptuales del historial. Se carga la primera vez
+    que se consulta y después solo lee las filas nuevas (por id); si se rellenan hashes de
+    registros existentes (GENERATION_KEY cambia) se vuelve a cargar entero.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.Lock()
+        self._hashes = None  # filename -> hash
+        self._tables = [{} for _ in range(CHUNKS)]  # trozo -> {filename}
+        self._last_id = 0
+        self._generation = None
+
+    def _insert(self, filename, value):
+        if filename in self._hashes:
+            self._remove(filename)
+        self._hashes[filename] = value
+        for table, chunk in zip(self._tables, _chunks(value)):
+            bucket = table.get(chunk)
+            if bucket is None:
+                table[chunk] = {filename}
+            else:
+                bucket.add(filename)
+
+    def _remove(self, filename):
+        value = self._hashes.pop(filename, None)
+        if value is None:
+            return
+        for table, chunk in zip(self._tables, _chunks(value)):
+            bucket = table.get(chunk)
+            if bucket is not None:
+                bucket.discard(filename)
+                if not bucket:
+                    del table[chunk]
+
+    def _refresh(self):
+        """Incorpora las filas nuevas del índice (o lo recarga si cambió la generación)"""
+        generation = self._store.get_meta(GENERATION_KEY)
+        if self._hashes is None or generation != self._generation:
+            self._hashes = {}
+            self._tables = [{} for _ in range(CHUNKS)]
+            self._last_id = 0
+            self._generation = generation
+        for row_id, filename, phash in self._store.phashes_since(self._last_id):
+            self._insert(filename, int(phash, 16))
+            self._last_id = row_id
+
+    def discard(self, filenames):
+        """Quita registros del índice (por ejemplo al borrarlos)"""
+        with self._lock:
+            if self._hashes is not None:
+                for filename in filenames:
+                    self._remove(filename)
+
+    def count(self):
+        with self._lock:
+            return len(self._hashes) if self._hashes is not None else None
+
+    def similar(self, filename, max_distance=DEFAULT_MAX_DISTANCE, limit=50):
+        """
+        Registros cuyo hash está a distancia de Hamming <= max_distance del de `filename`,
+        del más al menos parecido. Devuelve [(entrada, distancia)].
+        Lanza KeyError si el registro no existe y ValueError si aún no tiene hash.
+        """
+        entry = self._store.get(filename)
+        if entry is None:
+            raise KeyError(filename)
+        if not entry.get("phash"):
+            raise ValueError(f"{filename} todavía no tiene hash perceptual")
+        max_distance = max(0, min(int(max_distance), MAX_DISTANCE))
+        target = int(entry["phash"], 16)
+
+        with self._lock:
+            self._refresh()
+            masks = _chunk_masks(max_distance // CHUNKS)
+            candidates = set()
+            for table, chunk in zip(self._tables, _chunks(target)):
+                for mask in masks:
+                    bucket = table.get(chunk ^ mask)
+                    if bucket:
+                        candidates.update(bucket)
+            matches = []
+            for candidate in candidates:
+                distance = hamming(target, self._hashes[candidate])
+                if distance <= max_distance and candidate != entry["filename"]:
+                    matches.append((distance, candidate))
+        matches.sort()
+
+        results, stale = [], []
+        for distance, candidate in matches:
+            if len(results) >= limit:
+                break
+            match = self._store.get(candidate)
+            if match is None:
+                # Borrado desde otro proceso
+                stale.append(candidate)
+            else:
+                results.append((match, distance))
+        if stale:
+            self.discard(stale)
+        return results
+
+
+def backfill_hashes(store, saved_images_dir=SAVED_IMAGES_DIR, workers=None, use_processes=True, on_progress=None):
+    """
+    Calcula en paralelo el hash perceptual de los registros que no lo tienen (guardados
+    antes de que existiera). Las imágenes que no se pueden leer quedan con hash vacío
+    para no reintentarlas. Devuelve un resumen con contadores y el rendimiento.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    summary = {"hashed": 0, "errors": 0}
+    start = time.perf_counter()
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        while True:
+            rows = store.missing_phashes(BACKFILL_BATCH_SIZE)
+            if not rows:
+                break
+            paths = [resolve_image_path({"image_file": image_file}, saved_images_dir) for _, image_file in rows]
+            hashes = list(executor.map(file_phash, paths, chunksize=16))
+            store.set_phashes([(filename, phash or "") for (filename, _), phash in zip(rows, hashes)])
+            store.set_meta(GENERATION_KEY, str(time.time()))
+            summary["hashed"] += sum(1 for phash in hashes if phash)
+            summary["errors"] += sum(1 for phash in hashes if not phash)
+            if on_progress:
+                on_progress(dict(summary))
+
+    elapsed = time.perf_counter() - start
+    total = summary["hashed"] + summary["errors"]
+    summary["seconds"] = round(elapsed, 3)
+    summary["images_per_s"] = round(total / elapsed, 1) if elapsed > 0 else None
+    return summary
+
+
+def main(argv=None):
+    import argparse
+    from scripts.history_store import HistoryStore
+    from scripts.layout import HISTORY_DB_FILE, METADATA_DIR
+
+    parser = argparse.ArgumentParser(description="Calcula el hash perceptual de las imágenes guardadas que no lo tienen")
+    parser.add_argument("--workers", type=int, default=None, help="Procesos (por defecto, uno por CPU)")
+    args = parser.parse_args(argv)
+
+    # Solo actualiza la columna del hash: no hace falta bloquear los guardados de la WebUI
+    store = HistoryStore(HISTORY_DB_FILE, metadata_dir=METADATA_DIR)
+    summary = backfill_hashes(
+        store,
+        workers=args.workers,
+        on_progress=lambda progress: print(f"\r{progress['hashed']} imágenes", end="", flush=True)
+    )
+    print()
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
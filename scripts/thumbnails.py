@@ -0,0 +1,134 @@
+"""
+Caché de miniaturas para la extensión Image Metadata Saver
+Genera miniaturas WebP pequeñas para la galería de guardados, las invalida por mtime
+y mantiene el tamaño total del directorio acotado descartando las menos usadas (LRU).
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from scripts.fileio import discard, temp_path_for
+
+# Lado máximo de las miniaturas (las tarjetas del historial miden 300px)
+THUMBNAIL_SIZE = 320
+
+# Formato y calidad de las miniaturas
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_EXTENSION = ".webp"
+THUMBNAIL_QUALITY = 80
+
+# Tamaño máximo de la caché en disco
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class ThumbnailCache:
+    """Directorio de miniaturas con invalidación por mtime y límite de tamaño LRU"""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, size=THUMBNAIL_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = None  # nombre de miniatura -> bytes, del menos al más usado
+        self._total_bytes = 0
+
+    def path_for(self, filename):
+        """Ruta de la miniatura correspondiente a una imagen guardada"""
+        return os.path.join(self.cache_dir, os.path.splitext(filename)[0] + THUMBNAIL_EXTENSION)
+
+    def _load_index(self):
+        """Construye el índice LRU a partir del directorio (solo la primera vez)"""
+        if self._entries is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        found = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith(THUMBNAIL_EXTENSION):
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, entry.name, stat.st_size))
+        found.sort()
+        self._entries = OrderedDict((name, size) for _, name, size in found)
+        self._total_bytes = sum(self._entries.values())
+
+    def get(self, source_path, filename, image=None):
+        """
+        Devuelve la ruta de una miniatura actualizada, generándola si no existe
+        o si la imagen original es más reciente. Retorna None si no hay imagen original.
+        """
+        thumb_path = self.path_for(filename)
+        name = os.path.basename(thumb_path)
+
+        try:
+            thumb_mtime = os.path.getmtime(thumb_path)
+        except OSError:
+            thumb_mtime = None
+
+        if thumb_mtime is not None and image is None:
+            try:
+                source_mtime = os.path.getmtime(source_path)
+            except OSError:
+                source_mtime = 0
+            if thumb_mtime >= source_mtime:
+                with self._lock:
+                    self._load_index()
+                    if name in self._entries:
+                        self._entries.move_to_end(name)
+                return thumb_path
+
+        if image is None:
+            if not os.path.exists(source_path):
+                return None
+            with Image.open(source_path) as source:
+                return self._write(source, thumb_path, name)
+        return self._write(image, thumb_path, name)
+
+    def _write(self, image, thumb_path, name):
+        thumb = image.copy()
+        thumb.thumbnail((self.size, self.size))
+        if thumb.mode not in ("RGB", "RGBA"):
+            thumb = thumb.convert("RGBA" if "A" in thumb.getbands() else "RGB")
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Temporal propio de cada escritura: un guardado y una petición de la galería pueden
+        # generar la misma miniatura a la vez
+        tmp_path = temp_path_for(thumb_path)
+        try:
+            thumb.save(tmp_path, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+            os.replace(tmp_path, thumb_path)
+        except BaseException:
+            discard(tmp_path)
+            raise
+
+        size = os.path.getsize(thumb_path)
+        with self._lock:
+            self._load_index()
+            self._total_bytes += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._prune()
+        return thumb_path
+
+    def invalidate(self, filename):
+        """Elimina la miniatura de una imagen (por ejemplo al borrarla)"""
+        thumb_path = self.path_for(filename)
+        name = os.path.basename(thumb_path)
+        with self._lock:
+            self._load_index()
+            self._total_bytes -= self._entries.pop(name, 0)
+        try:
+            os.remove(thumb_path)
+        except OSError:
+            pass
+
+    def _prune(self):
+        """Descarta las miniaturas menos usadas hasta quedar bajo el límite"""
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass